@@ -0,0 +1,309 @@
+#
+# Author:       Timothy Zimmerman (timothy.zimmerman@nist.gov)
+# Organization: National Institute of Standards and Technology
+#               U.S. Department of Commerce
+# License:      Public Domain
+#
+# Description:  The generators of pipeline.py run as three concurrent stages
+#               on an asyncio event loop, so reading, dissecting and writing
+#               overlap instead of taking turns:
+#
+#                   read      iterFrames + iterTcpPayloads (the PCAP, or
+#                             the tshark output of the pyshark backend)
+#                   dissect   iterRosMessages, with the reassembler
+#                   write     the sinks, e.g. the SQLite commits
+#
+#               Each stage works on batches of packets in its own executor
+#               thread; the loop only moves the batches along. The stages are
+#               connected by bounded queues, so a stage that gets ahead waits
+#               for the one behind it and at most a few batches per queue are
+#               held, however large the capture. The threads overlap where
+#               the work leaves the GIL: file and pipe reads, tshark, and
+#               SQLite.
+#
+#               The queue depths are sampled while the stages run, together
+#               with the time each stage was busy, waited for input and was
+#               held up by a full queue. A queue that stays full is waiting
+#               on the stage after it; the busiest stage is the bottleneck.
+#
+#               The write stage uses the sinks from its own thread, so the
+#               connection of a SqliteSink must be opened with
+#               check_same_thread=False (see ingest.createDatabase).
+#
+#               Usage:
+#
+#                   conn = ingest.createDatabase("unified.db", check_same_thread=False)
+#                   writer = db_writer.BatchWriter(conn)
+#                   stats = async_pipeline.runFile([pipeline.SqliteSink(writer)], "robot1.pcap")
+#
+#               or await runFileAsync(...) from a running event loop.
+#
+
+import asyncio
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
+import ingest
+import pcap_filter
+import pipeline
+import tcp_reassembly
+
+# Packets per batch passed between the stages
+DEFAULT_BATCH_SIZE = 500
+
+# Batches each queue holds before the stage in front of it has to wait
+DEFAULT_QUEUE_DEPTH = 4
+
+# Seconds between samples of the queue depths
+METRICS_INTERVAL = 0.01
+
+# Stages, in order, and the queues between them
+STAGES = ('read', 'dissect', 'write')
+QUEUES = ('read->dissect', 'dissect->write')
+
+
+class StageMetrics:
+    __slots__ = ('name', 'batches', 'packets', 'busy', 'waitInput', 'waitOutput')
+
+    def __init__(self, name):
+        self.name = name
+        self.batches = 0
+        self.packets = 0
+        # Seconds working, waiting for a batch, and waiting for room in the
+        # queue to the next stage
+        self.busy = 0.0
+        self.waitInput = 0.0
+        self.waitOutput = 0.0
+
+    def asDict(self):
+        return {
+            'stage': self.name,
+            'batches': self.batches,
+            'packets': self.packets,
+            'busy_seconds': self.busy,
+            'wait_input_seconds': self.waitInput,
+            'wait_output_seconds': self.waitOutput,
+        }
+
+
+class QueueMetrics:
+    __slots__ = ('name', 'maxsize', 'samples', 'depthSum', 'full', 'empty', 'maxDepth')
+
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.maxsize = maxsize
+        self.samples = 0
+        self.depthSum = 0
+        self.full = 0
+        self.empty = 0
+        self.maxDepth = 0
+
+    def sample(self, depth):
+        self.samples += 1
+        self.depthSum += depth
+        if depth >= self.maxsize:
+            self.full += 1
+        elif depth == 0:
+            self.empty += 1
+        if depth > self.maxDepth:
+            self.maxDepth = depth
+
+    def meanDepth(self):
+        return self.depthSum / self.samples if self.samples else 0.0
+
+    def asDict(self):
+        return {
+            'queue': self.name,
+            'maxsize': self.maxsize,
+            'samples': self.samples,
+            'mean_depth': self.meanDepth(),
+            'max_depth': self.maxDepth,
+            'full_percent': self.full / self.samples * 100 if self.samples else None,
+            'empty_percent': self.empty / self.samples * 100 if self.samples else None,
+        }
+
+
+class PipelineMetrics:
+    # Stage and queue metrics, added up over every file run with them
+
+    def __init__(self, queue_depth=DEFAULT_QUEUE_DEPTH):
+        self.stages = dict((name, StageMetrics(name)) for name in STAGES)
+        self.queues = dict((name, QueueMetrics(name, queue_depth)) for name in QUEUES)
+        self.seconds = 0.0
+
+    def bottleneck(self):
+        # The stage that was busy the longest
+        return max(self.stages.values(), key=lambda stage: stage.busy).name
+
+    def asDict(self):
+        return {
+            'seconds': self.seconds,
+            'bottleneck': self.bottleneck(),
+            'stages': [self.stages[name].asDict() for name in STAGES],
+            'queues': [self.queues[name].asDict() for name in QUEUES],
+        }
+
+    def summary(self):
+        lines = []
+        for name in STAGES:
+            stage = self.stages[name]
+            busyPercent = stage.busy / self.seconds * 100 if self.seconds > 0 else 0.0
+            lines.append("Stage {0:8s} busy {1:7.2f}s ({2:3.0f}%), ".format(name, stage.busy, busyPercent) + \
+                         "waiting for input {0:7.2f}s, for the next stage {1:7.2f}s, ".format(
+                             stage.waitInput, stage.waitOutput) + str(stage.batches) + " batches")
+        for name in QUEUES:
+            queue = self.queues[name]
+            if queue.samples:
+                lines.append("Queue {0:15s} mean depth {1:4.1f}/".format(name, queue.meanDepth()) + \
+                             str(queue.maxsize) + ", full {0:3.0f}%, empty {1:3.0f}% of ".format(
+                                 queue.full / queue.samples * 100, queue.empty / queue.samples * 100) + \
+                             str(queue.samples) + " samples")
+        lines.append("Bottleneck: " + self.bottleneck() + " stage")
+        return lines
+
+
+def nextBatch(iterator, batch_size):
+    return list(itertools.islice(iterator, batch_size))
+
+
+def dissectBatch(batch, reassembler, cache):
+    return list(pipeline.iterRosMessages(batch, reassembler, cache))
+
+
+def writeBatch(sinks, stats, batch):
+    for item in batch:
+        ingest.countFrame(stats, item.packet, item.messages)
+        for sink in sinks:
+            sink.write(item)
+
+
+async def readStage(loop, executor, metrics, payloads, outQueue, batch_size):
+    stage = metrics.stages['read']
+    while True:
+        start = time.perf_counter()
+        batch = await loop.run_in_executor(executor, nextBatch, payloads, batch_size)
+        stage.busy += time.perf_counter() - start
+        start = time.perf_counter()
+        # An empty batch tells the next stage that the capture has ended
+        await outQueue.put(batch)
+        stage.waitOutput += time.perf_counter() - start
+        if not batch:
+            return
+        stage.batches += 1
+        stage.packets += len(batch)
+
+
+async def dissectStage(loop, executor, metrics, inQueue, outQueue, reassembler, cache):
+    stage = metrics.stages['dissect']
+    while True:
+        start = time.perf_counter()
+        batch = await inQueue.get()
+        stage.waitInput += time.perf_counter() - start
+        if batch:
+            start = time.perf_counter()
+            batch = await loop.run_in_executor(executor, dissectBatch, batch, reassembler, cache)
+            stage.busy += time.perf_counter() - start
+        start = time.perf_counter()
+        await outQueue.put(batch)
+        stage.waitOutput += time.perf_counter() - start
+        if not batch:
+            return
+        stage.batches += 1
+        stage.packets += len(batch)
+
+
+async def writeStage(loop, executor, metrics, inQueue, sinks, stats):
+    stage = metrics.stages['write']
+    while True:
+        start = time.perf_counter()
+        batch = await inQueue.get()
+        stage.waitInput += time.perf_counter() - start
+        if not batch:
+            return
+        start = time.perf_counter()
+        await loop.run_in_executor(executor, writeBatch, sinks, stats, batch)
+        stage.busy += time.perf_counter() - start
+        stage.batches += 1
+        stage.packets += len(batch)
+
+
+async def sampleQueues(metrics, queues, done, interval):
+    while not done.is_set():
+        for name, queue in zip(QUEUES, queues):
+            metrics.queues[name].sample(queue.qsize())
+        try:
+            await asyncio.wait_for(done.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def runFileAsync(sinks, filename, file_id=None, backend="native", rules=None, resumeAfter=0, reassemble=False,
+                       cache=None, batch_size=DEFAULT_BATCH_SIZE, queue_depth=DEFAULT_QUEUE_DEPTH, metrics=None):
+    # pipeline.runFile with the stages running concurrently. Returns the
+    # ingest.FileStats of the capture, with metrics (a PipelineMetrics, new
+    # unless given) in its pipelineMetrics.
+    loop = asyncio.get_running_loop()
+    if metrics is None:
+        metrics = PipelineMetrics(queue_depth)
+    stats = ingest.FileStats(filename, file_id)
+    stats.resumeAfter = resumeAfter
+    start = time.monotonic()
+
+    packetFilter = pcap_filter.PacketFilter(rules, reassemble)
+    reassembler = tcp_reassembly.StreamReassembler(cache=cache) if reassemble else None
+    payloads = pipeline.iterTcpPayloads(pipeline.iterFrames(filename, packetFilter, backend, resumeAfter))
+    # One thread per stage keeps the batches, the generators and the
+    # reassembler in order
+    executors = [ThreadPoolExecutor(1, thread_name_prefix=name) for name in STAGES]
+    readExecutor, dissectExecutor, writeExecutor = executors
+    queues = [asyncio.Queue(queue_depth) for name in QUEUES]
+    done = asyncio.Event()
+    try:
+        for sink in sinks:
+            await loop.run_in_executor(writeExecutor, sink.beginFile, stats)
+        sampler = asyncio.ensure_future(sampleQueues(metrics, queues, done, METRICS_INTERVAL))
+        stages = asyncio.gather(
+            readStage(loop, readExecutor, metrics, payloads, queues[0], batch_size),
+            dissectStage(loop, dissectExecutor, metrics, queues[0], queues[1], reassembler, cache),
+            writeStage(loop, writeExecutor, metrics, queues[1], sinks, stats))
+        try:
+            await stages
+        except BaseException:
+            stages.cancel()
+            raise
+        finally:
+            done.set()
+            await sampler
+        for sink in sinks:
+            await loop.run_in_executor(writeExecutor, sink.endFile, stats)
+    finally:
+        for executor in executors:
+            executor.shutdown()
+
+    stats.elapsed = time.monotonic() - start
+    metrics.seconds += stats.elapsed
+    if backend != "pyshark":
+        stats.filterSummary = packetFilter.summary()
+    if reassembler is not None:
+        reassembler.close()
+        stats.reassemblySummary = reassembler.summary()
+    stats.pipelineMetrics = metrics
+    return stats
+
+
+def runFile(sinks, filename, file_id=None, backend="native", rules=None, resumeAfter=0, reassemble=False,
+            cache=None, batch_size=DEFAULT_BATCH_SIZE, queue_depth=DEFAULT_QUEUE_DEPTH, metrics=None):
+    # runFileAsync on a new event loop
+    return asyncio.run(runFileAsync(sinks, filename, file_id, backend, rules, resumeAfter, reassemble, cache,
+                                    batch_size, queue_depth, metrics))
+
+
+def run(filenames, sinks, backend="native", rules=None, reassemble=False, cache=None,
+        batch_size=DEFAULT_BATCH_SIZE, queue_depth=DEFAULT_QUEUE_DEPTH, metrics=None):
+    # pipeline.run with the concurrent stages
+    try:
+        return [runFile(sinks, filename, None, backend, rules, 0, reassemble, cache, batch_size, queue_depth, metrics)
+                for filename in filenames]
+    finally:
+        for sink in sinks:
+            sink.close()
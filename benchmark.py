@@ -0,0 +1,327 @@
+#
+# Author:       Timothy Zimmerman (timothy.zimmerman@nist.gov)
+# Organization: National Institute of Standards and Technology
+#               U.S. Department of Commerce
+# License:      Public Domain
+#
+# Description:  End-to-end benchmark of the ingest and analysis on synthetic
+#               captures (see synthetic_capture.py), so throughput can be
+#               compared between versions without the production captures.
+#               Every stage is timed on its own:
+#
+#                   read        walk the PCAP record headers
+#                   filter      run the prefilter over every record
+#                   decode      read, filter and decode the accepted frames
+#                   dissect     run the ROS dissector over every payload,
+#                               also with the dissection cache and with TCP
+#                               reassembly in front of it
+#                   hash        fingerprint every packet
+#                   db_write    store the dissected packets with the batch
+#                               writer into a new DB
+#                   ingest      the whole per-file ingest, as pcap_to_db.py
+#                               runs it, and the index build after it
+#                   analyze_*   each analysis stage of analyze.py
+#
+#               packets/s, MB/s and the peak RSS of every stage are written
+#               as JSON. The peak RSS is reset before each stage where the OS
+#               allows it (Linux), otherwise it is the peak of the process.
+#
+#               Usage: python benchmark.py [packets] [results.json]
+#
+#               packets is the number of ROS segments in each synthetic
+#               capture.
+#
+
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import db_schema
+import db_writer
+import dissect_cache
+import ingest
+import payload_store
+import pcap_filter
+import pcap_reader
+import pipeline
+import ros_analysis
+import ros_msg_dissector as rosDisector
+import synthetic_capture
+import tcp_reassembly
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+BENCH_PACKETS = 50000
+CAPTURE_POINTS = 2
+SEED = synthetic_capture.DEFAULT_SEED
+# Write the payloads to a payload store, as pcap_to_db.py does by default
+PAYLOAD_STORE = True
+RESULTS_FILE = "benchmark.json"
+# Keep the captures and DBs in this directory, or None for a temporary
+# directory that is removed afterwards
+WORK_DIR = None
+
+
+def peakRss():
+    # Peak resident set size of the process in MB, or None
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError, ValueError):
+        pass
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return maxrss / (1024.0 * 1024.0) if sys.platform == 'darwin' else maxrss / 1024.0
+
+
+def resetPeakRss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def codeVersion():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Benchmark:
+
+    def __init__(self):
+        self.stages = []
+
+    def run(self, name, stage, *args):
+        # stage returns (packets, bytes) processed
+        resetPeakRss()
+        start = time.perf_counter()
+        packets, nbytes = stage(*args)
+        elapsed = time.perf_counter() - start
+        result = {
+            'stage': name,
+            'seconds': elapsed,
+            'packets': packets,
+            'bytes': nbytes,
+            'packets_per_s': packets / elapsed if elapsed > 0 else None,
+            'mb_per_s': nbytes / elapsed / 1e6 if elapsed > 0 else None,
+            'peak_rss_mb': peakRss(),
+        }
+        self.stages.append(result)
+        print ("{0:22s} {1:8.3f}s {2:10.0f} packets/s {3:8.2f} MB/s".format(
+            name, elapsed, result['packets_per_s'] or 0, result['mb_per_s'] or 0) + \
+            ("  peak RSS {0:.0f} MB".format(result['peak_rss_mb']) if result['peak_rss_mb'] is not None else ""))
+        return result
+
+
+def stageRead(captures):
+    packets = 0
+    nbytes = 0
+    for mm, unpack_header, records in captures:
+        del records[:]
+        for frameNum, ts_sec, ts_frac, offset, caplen in pcap_reader.iterRecords(mm, unpack_header):
+            records.append((offset, caplen))
+        packets += len(records)
+        nbytes += len(mm)
+    return packets, nbytes
+
+
+def stageFilter(captures):
+    packets = 0
+    nbytes = 0
+    for mm, unpack_header, records in captures:
+        check = pcap_filter.PacketFilter().check
+        for offset, caplen in records:
+            check(mm, offset, caplen)
+        packets += len(records)
+        nbytes += sum(caplen for offset, caplen in records)
+    return packets, nbytes
+
+
+def stageDecode(filenames, frames):
+    # frames gets (capture number, unpack_header, Frame) for every packet
+    del frames[:]
+    nbytes = 0
+    for capture, filename in enumerate(filenames):
+        unpack_header = ingest.readEndianness(filename)
+        for packet in pcap_reader.iterFrames(filename):
+            frames.append((capture, unpack_header, packet))
+        nbytes += os.path.getsize(filename)
+    return len(frames), nbytes
+
+
+def payloadBytes(frames):
+    return sum(packet.data_len for capture, unpack_header, packet in frames)
+
+
+def stageDissect(frames, cache=None):
+    for capture, unpack_header, packet in frames:
+        ingest.dissectFrame(unpack_header, packet, cache)
+    return len(frames), payloadBytes(frames)
+
+
+def stageReassemble(frames):
+    # One reassembler per capture, as in the ingest; otherwise the copies in
+    # the next capture would look like retransmissions
+    reassemblers = {}
+    for capture, unpack_header, packet in frames:
+        reassembler = reassemblers.get(capture)
+        if reassembler is None:
+            reassembler = reassemblers[capture] = tcp_reassembly.StreamReassembler()
+        reassembler.feed(unpack_header, packet)
+    for reassembler in reassemblers.values():
+        reassembler.close()
+    return len(frames), payloadBytes(frames)
+
+
+def stageHash(frames, fingerprints):
+    del fingerprints[:]
+    for capture, unpack_header, packet in frames:
+        fingerprints.append(ingest.fingerprint(packet))
+    return len(frames), payloadBytes(frames)
+
+
+def openPayloads(db_filename):
+    return payload_store.PayloadStore(payload_store.storePath(db_filename)) if PAYLOAD_STORE else None
+
+
+def stageDbWrite(db_filename, frames, fingerprints, results):
+    conn = ingest.createDatabase(db_filename)
+    db_schema.beginBulkLoad(conn)
+    payloads = openPayloads(db_filename)
+    writer = db_writer.BatchWriter(conn, payloads=payloads)
+    stats = ingest.FileStats(db_filename, 1)
+    file_id = ingest.registerFile(conn.cursor(), db_filename)
+    for (capture, unpack_header, packet), packet_fingerprint, packetData in zip(frames, fingerprints, results):
+        ingest.countFrame(stats, packet, packetData)
+        ingest.storeFrame(writer, packet, file_id, packet_fingerprint, packetData)
+        writer.maybeFlush()
+    writer.flush()
+    conn.close()
+    if payloads is not None:
+        payloads.close()
+    return len(frames), payloadBytes(frames)
+
+
+def stageIngest(conn, filenames, payloads):
+    writer = db_writer.BatchWriter(conn, payloads=payloads)
+    cache = dissect_cache.DissectionCache()
+    packets = 0
+    nbytes = 0
+    for filename in filenames:
+        file_id = ingest.registerFile(conn.cursor(), filename, fingerprint=ingest.fileFingerprint(filename))
+        stats = pipeline.ingestFile(writer, filename, file_id, reassemble=True, cache=cache)
+        packets += stats.detectedPackets
+        nbytes += os.path.getsize(filename)
+    return packets, nbytes
+
+
+def stageIndexes(conn):
+    db_schema.endBulkLoad(conn)
+    return tableRows(conn, 'packets'), 0
+
+
+def tableRows(conn, table):
+    return conn.execute('''SELECT COUNT(*) FROM ''' + table).fetchone()[0]
+
+
+def stageAnalysis(conn, analysis, tables):
+    analysis(conn)
+    return sum(tableRows(conn, table) for table in tables), 0
+
+
+def main(argv):
+    packets = int(argv[1]) if len(argv) > 1 else BENCH_PACKETS
+    results_file = argv[2] if len(argv) > 2 else RESULTS_FILE
+    work_dir = WORK_DIR or tempfile.mkdtemp(prefix="benchmark_")
+    bench = Benchmark()
+    try:
+        filenames = []
+
+        def generate():
+            filenames.extend(synthetic_capture.generate(work_dir, packets, CAPTURE_POINTS, SEED))
+            return packets * CAPTURE_POINTS, sum(os.path.getsize(filename) for filename in filenames)
+        bench.run("generate", generate)
+
+        captures = []
+        for filename in filenames:
+            mm = pcap_reader.openCapture(filename)
+            captures.append((mm, pcap_reader.readGlobalHeader(mm)[0], []))
+        bench.run("read", stageRead, captures)
+        bench.run("filter", stageFilter, captures)
+        for mm, unpack_header, records in captures:
+            pcap_reader.closeCapture(mm)
+        del captures
+
+        frames = []
+        fingerprints = []
+        bench.run("decode", stageDecode, filenames, frames)
+        # Copy the payloads out of the memory maps
+        for capture, unpack_header, packet in frames:
+            packet.data = bytes(packet.data)
+        bench.run("dissect", stageDissect, frames)
+        bench.run("dissect_cached", stageDissect, frames, dissect_cache.DissectionCache())
+        bench.run("reassemble_dissect", stageReassemble, frames)
+        bench.run("hash", stageHash, frames, fingerprints)
+        # The rows to write are dissected outside of the timed stages, as
+        # holding on to them slows the dissect stages down
+        results = [ingest.dissectFrame(unpack_header, packet) for capture, unpack_header, packet in frames]
+        bench.run("db_write", stageDbWrite, os.path.join(work_dir, "db_write.db"), frames, fingerprints, results)
+        del frames, results, fingerprints
+
+        db_filename = os.path.join(work_dir, "unified.db")
+        conn = ingest.createDatabase(db_filename)
+        db_schema.beginBulkLoad(conn)
+        payloads = openPayloads(db_filename)
+        bench.run("ingest", stageIngest, conn, filenames, payloads)
+        bench.run("indexes", stageIndexes, conn)
+        bench.run("analyze_match", stageAnalysis, conn, ros_analysis.matchPackets, ('packets',))
+        bench.run("analyze_brics", stageAnalysis, conn, ros_analysis.markUniqueBrics,
+                  ('ros_BricsPositionMessages',))
+        bench.run("analyze_response_times", stageAnalysis, conn, ros_analysis.responseTimes,
+                  ('ros_BricsPositionMessages', 'ros_JointStateMessages'))
+        conn.close()
+        if payloads is not None:
+            payloads.close()
+    finally:
+        if WORK_DIR is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'date': datetime.datetime.now().isoformat(),
+        'version': codeVersion(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': rosDisector.numpy is not None,
+        'config': {
+            'packets': packets,
+            'capture_points': CAPTURE_POINTS,
+            'seed': SEED,
+            'batch_size': db_writer.DEFAULT_BATCH_SIZE,
+            'dissection_cache_size': dissect_cache.DEFAULT_MAX_ENTRIES,
+            'payload_store': PAYLOAD_STORE,
+        },
+        'stages': bench.stages,
+    }
+    with open(results_file, 'w') as f:
+        json.dump(report, f, indent=2)
+    print ("Results written to \"" + results_file + "\"")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
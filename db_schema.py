@@ -0,0 +1,323 @@
+#
+# Author:       Timothy Zimmerman (timothy.zimmerman@nist.gov)
+# Organization: National Institute of Standards and Technology
+#               U.S. Department of Commerce
+# License:      Public Domain
+#
+# Description:  Table and index definitions for the unified database, shared
+#               by pcap_to_db.py and analyze.py, plus the PRAGMA settings used
+#               while bulk loading a new database.
+#
+# Resource(s):  https://www.sqlite.org/pragma.html
+#
+
+INGEST_TABLES = [
+    '''CREATE TABLE IF NOT EXISTS packets (\
+                id INTEGER PRIMARY KEY AUTOINCREMENT, \
+                shark_timestamp REAL, \
+                shark_file_id INTEGER, \
+                shark_frame_num INTEGER, \
+                shark_eth_dst TEXT, \
+                shark_eth_src TEXT, \
+                shark_ip_dst TEXT, \
+                shark_ip_src TEXT, \
+                shark_tcp_port_dst INTEGER, \
+                shark_tcp_port_src INTEGER, \
+                shark_tcp_seq_num INTEGER, \
+                shark_tcp_next_seq_num INTEGER, \
+                shark_tcp_expected_ack INTEGER, \
+                shark_tcp_checksum INTEGER, \
+                shark_analysis_initial_rtt REAL, \
+                shark_data BLOB, \
+                shark_data_len INTEGER, \
+                md5_hash TEXT, \
+                fingerprint INTEGER, \
+                payload_offset INTEGER \
+                )''',
+
+    '''CREATE TABLE IF NOT EXISTS rosPackets (\
+                id INTEGER PRIMARY KEY AUTOINCREMENT, \
+                parent_id INTEGER, \
+                shark_frame_num INTEGER, \
+                shark_data BLOB, \
+                shark_data_len INTEGER, \
+                ros_msg_tuple TEXT, \
+                md5_hash TEXT, \
+                fingerprint INTEGER, \
+                payload_offset INTEGER \
+                )''',
+
+    '''CREATE TABLE IF NOT EXISTS pcapFiles (id INTEGER PRIMARY KEY AUTOINCREMENT, filename TEXT, machinename TEXT, \
+                file_size INTEGER, \
+                file_mtime REAL, \
+                header_hash TEXT, \
+                last_frame INTEGER DEFAULT 0, \
+                complete INTEGER DEFAULT 0 \
+                )''',
+
+    '''CREATE TABLE IF NOT EXISTS unclassifiedROSMessages ( id INTEGER PRIMARY KEY AUTOINCREMENT, \
+                                                    parent_id INTEGER, \
+                                                    pyshark_id INTEGER, \
+                                                    packet_data BLOB, \
+                                                    payload_offset INTEGER, \
+                                                    payload_len INTEGER \
+                                                    )''',
+]
+
+# Column order of the ingest tables, used when rows are copied between DBs
+PACKETS_COLUMNS = ('id', 'shark_timestamp', 'shark_file_id', 'shark_frame_num', 'shark_eth_dst',
+                   'shark_eth_src', 'shark_ip_dst', 'shark_ip_src', 'shark_tcp_port_dst',
+                   'shark_tcp_port_src', 'shark_tcp_seq_num', 'shark_tcp_next_seq_num',
+                   'shark_tcp_expected_ack', 'shark_tcp_checksum', 'shark_analysis_initial_rtt',
+                   'shark_data', 'shark_data_len', 'md5_hash', 'fingerprint', 'payload_offset')
+ROS_PACKETS_COLUMNS = ('id', 'parent_id', 'shark_frame_num', 'shark_data', 'shark_data_len',
+                       'ros_msg_tuple', 'md5_hash', 'fingerprint', 'payload_offset')
+UNCLASSIFIED_COLUMNS = ('id', 'parent_id', 'pyshark_id', 'packet_data', 'payload_offset', 'payload_len')
+
+# Columns added to pcapFiles for the incremental ingest: the content
+# fingerprint of the capture and the checkpoint of its ingest. DBs created
+# before they existed get them from upgradeIngestTables.
+PCAP_FILES_CHECKPOINT_COLUMNS = (
+    ('file_size', 'INTEGER'),
+    ('file_mtime', 'REAL'),
+    ('header_hash', 'TEXT'),
+    ('last_frame', 'INTEGER DEFAULT 0'),
+    ('complete', 'INTEGER DEFAULT 0'),
+)
+
+# Packets are identified by a 64-bit fingerprint of their binary headers and
+# payload (see ingest.fingerprint). DBs from before it only have md5_hash;
+# they get the column from upgradeIngestTables and the values from
+# ingest.backfillFingerprints.
+FINGERPRINT_COLUMNS = (
+    ('fingerprint', 'INTEGER'),
+)
+
+# With a payload_store.PayloadStore the payloads are kept in a file next to
+# the DB: the BLOB columns are NULL and payload_offset points into the store,
+# with shark_data_len (payload_len for unclassifiedROSMessages) as the length.
+# Without a store the BLOBs are filled and payload_offset is NULL.
+PAYLOAD_COLUMNS = (
+    ('payload_offset', 'INTEGER'),
+)
+UNCLASSIFIED_PAYLOAD_COLUMNS = (
+    ('payload_offset', 'INTEGER'),
+    ('payload_len', 'INTEGER'),
+)
+
+# Columns added to the ingest tables since the first release, in the order
+# of the CREATE TABLE statements
+UPGRADE_COLUMNS = (
+    ('pcapFiles', PCAP_FILES_CHECKPOINT_COLUMNS),
+    ('packets', FINGERPRINT_COLUMNS),
+    ('rosPackets', FINGERPRINT_COLUMNS),
+    ('packets', PAYLOAD_COLUMNS),
+    ('rosPackets', PAYLOAD_COLUMNS),
+    ('unclassifiedROSMessages', UNCLASSIFIED_PAYLOAD_COLUMNS),
+)
+
+# Joints of one arm, in the column order of the typed message tables. The
+# second arm's joints are stored under the same names, see ros_arm_num.
+JOINT_NAMES = ('arm_joint_1', 'arm_joint_2', 'arm_joint_3', 'arm_joint_4', 'arm_joint_5',
+               'gripper_finger_joint_l', 'gripper_finger_joint_r')
+
+ANALYSIS_TABLES = [
+    '''CREATE TABLE IF NOT EXISTS matchingPackets (\
+                id INTEGER PRIMARY KEY AUTOINCREMENT, \
+                packet_1_id INTEGER, packet_2_id INTEGER, \
+                packet_1_time REAL, packet_2_time, delta_t REAL)''',
+
+    '''CREATE TABLE IF NOT EXISTS misplacedPackets (\
+                id INTEGER PRIMARY KEY AUTOINCREMENT, packet_id_1 INTEGER)''',
+
+    '''CREATE TABLE IF NOT EXISTS ros_JointStateMessages (\
+                id INTEGER PRIMARY KEY AUTOINCREMENT, \
+                parent_id INTEGER, \
+                ros_time REAL, \
+                ros_frame_id TEXT, \
+                ros_msg_len INTEGER, \
+                ros_arm_num INTEGER, \
+                arm_joint_1_value REAL, \
+                arm_joint_2_value REAL, \
+                arm_joint_3_value REAL, \
+                arm_joint_4_value REAL, \
+                arm_joint_5_value REAL, \
+                gripper_finger_joint_l_value REAL, \
+                gripper_finger_joint_r_value REAL, \
+                arm_joint_1_velocity REAL, \
+                arm_joint_2_velocity REAL, \
+                arm_joint_3_velocity REAL, \
+                arm_joint_4_velocity REAL, \
+                arm_joint_5_velocity REAL, \
+                gripper_finger_joint_l_velocity REAL, \
+                gripper_finger_joint_r_velocity REAL, \
+                arm_joint_1_effort REAL, \
+                arm_joint_2_effort REAL, \
+                arm_joint_3_effort REAL, \
+                arm_joint_4_effort REAL, \
+                arm_joint_5_effort REAL, \
+                gripper_finger_joint_l_effort REAL, \
+                gripper_finger_joint_r_effort REAL \
+                )''',
+
+    '''CREATE TABLE IF NOT EXISTS ros_BricsPositionMessages (\
+                id INTEGER PRIMARY KEY AUTOINCREMENT, \
+                parent_id INTEGER, \
+                ros_msg_len INTEGER, \
+                ros_arm_num INTEGER, \
+                delta BOOLEAN, \
+                arm_joint_1_value REAL, \
+                arm_joint_2_value REAL, \
+                arm_joint_3_value REAL, \
+                arm_joint_4_value REAL, \
+                arm_joint_5_value REAL, \
+                arm_joint_1_unit TEXT, \
+                arm_joint_2_unit TEXT, \
+                arm_joint_3_unit TEXT, \
+                arm_joint_4_unit TEXT, \
+                arm_joint_5_unit TEXT  \
+                )''',
+
+    '''CREATE TABLE IF NOT EXISTS ros_BricsGripperMessages (\
+                id INTEGER PRIMARY KEY AUTOINCREMENT, \
+                parent_id INTEGER, \
+                ros_msg_len INTEGER, \
+                ros_arm_num INTEGER, \
+                gripper_finger_joint_l_value REAL, \
+                gripper_finger_joint_r_value REAL, \
+                gripper_finger_joint_l_unit TEXT, \
+                gripper_finger_joint_r_unit TEXT \
+                )''',
+
+    '''CREATE TABLE IF NOT EXISTS ros_DependencyMessages (\
+                id INTEGER PRIMARY KEY AUTOINCREMENT, \
+                parent_id INTEGER, \
+                ros_time REAL, \
+                ros_frame_id TEXT, \
+                ros_msg_len INTEGER, \
+                depend_name TEXT, \
+                depend_value INTEGER \
+                )''',
+
+    '''CREATE TABLE IF NOT EXISTS analyze_JointResponseTimes (\
+                id INTEGER PRIMARY KEY AUTOINCREMENT, \
+                brics_message_id INTEGER, \
+                joint_state_message_id INTEGER, \
+                delay REAL \
+                )''',
+]
+
+# Column order of the typed message tables, filled by the ingest
+JOINT_STATE_COLUMNS = ('id', 'parent_id', 'ros_time', 'ros_frame_id', 'ros_msg_len', 'ros_arm_num') + \
+                      tuple(j + '_value' for j in JOINT_NAMES) + \
+                      tuple(j + '_velocity' for j in JOINT_NAMES) + \
+                      tuple(j + '_effort' for j in JOINT_NAMES)
+BRICS_POSITION_COLUMNS = ('id', 'parent_id', 'ros_msg_len', 'ros_arm_num', 'delta') + \
+                         tuple(j + '_value' for j in JOINT_NAMES[:5]) + \
+                         tuple(j + '_unit' for j in JOINT_NAMES[:5])
+BRICS_GRIPPER_COLUMNS = ('id', 'parent_id', 'ros_msg_len', 'ros_arm_num') + \
+                        tuple(j + '_value' for j in JOINT_NAMES[5:]) + \
+                        tuple(j + '_unit' for j in JOINT_NAMES[5:])
+DEPENDENCY_COLUMNS = ('id', 'parent_id', 'ros_time', 'ros_frame_id', 'ros_msg_len', 'depend_name', 'depend_value')
+
+# Typed message tables and their columns, in insertion order
+TYPED_TABLES = (
+    ('ros_JointStateMessages', JOINT_STATE_COLUMNS),
+    ('ros_BricsPositionMessages', BRICS_POSITION_COLUMNS),
+    ('ros_BricsGripperMessages', BRICS_GRIPPER_COLUMNS),
+    ('ros_DependencyMessages', DEPENDENCY_COLUMNS),
+)
+
+# Every index analyze.py relies on. They are built once, after the bulk load,
+# rather than being maintained row by row during the ingest.
+INDEXES = [
+    '''CREATE INDEX IF NOT EXISTS seqNum ON packets ( shark_tcp_seq_num )''',
+    '''CREATE INDEX IF NOT EXISTS md5 ON packets ( md5_hash )''',
+    '''CREATE INDEX IF NOT EXISTS packets_id_idx ON packets ( id )''',
+    '''CREATE INDEX IF NOT EXISTS rosmsg_md5 ON rosPackets ( md5_hash )''',
+    '''CREATE INDEX IF NOT EXISTS fingerprint_idx ON packets ( fingerprint )''',
+    '''CREATE INDEX IF NOT EXISTS rosmsg_fingerprint_idx ON rosPackets ( fingerprint )''',
+    '''CREATE INDEX IF NOT EXISTS parent_id_idx ON rosPackets ( parent_id )''',
+    '''CREATE INDEX IF NOT EXISTS js_parent_id_idx ON ros_JointStateMessages ( parent_id )''',
+    '''CREATE INDEX IF NOT EXISTS brics_index_1 ON ros_BricsPositionMessages ( delta, parent_id, ros_arm_num )''',
+]
+
+# Settings used while a new database is being filled. Nothing in a fresh
+# unified DB is worth protecting until the ingest has finished, so the
+# rollback journal and fsyncs are switched off and the page cache and
+# memory map are enlarged.
+BULK_LOAD_PRAGMAS = [
+    '''PRAGMA journal_mode = OFF''',
+    '''PRAGMA synchronous = OFF''',
+    '''PRAGMA cache_size = -262144''',          # 256 MiB
+    '''PRAGMA mmap_size = 1073741824''',        # 1 GiB
+    '''PRAGMA temp_store = MEMORY''',
+]
+
+# SQLite defaults, restored once the bulk load is done
+DURABLE_PRAGMAS = [
+    '''PRAGMA journal_mode = DELETE''',
+    '''PRAGMA synchronous = FULL''',
+    '''PRAGMA cache_size = -2000''',
+    '''PRAGMA temp_store = DEFAULT''',
+]
+
+# Settings for a live ingest: readers (e.g. analyze.py) can query the DB
+# while it is being written, and commits do not wait for an fsync
+LIVE_PRAGMAS = [
+    '''PRAGMA journal_mode = WAL''',
+    '''PRAGMA synchronous = NORMAL''',
+]
+
+
+def createIngestTables(c):
+    for statement in INGEST_TABLES:
+        c.execute(statement)
+
+
+def upgradeIngestTables(c):
+    # Add the columns that older DBs are missing. Returns the (table, column)
+    # pairs that were added.
+    added = []
+    for table, columns in UPGRADE_COLUMNS:
+        existing = set(row[1] for row in c.execute('''PRAGMA table_info(''' + table + ''')'''))
+        for column, decltype in columns:
+            if column not in existing:
+                c.execute('''ALTER TABLE ''' + table + ''' ADD COLUMN ''' + column + ''' ''' + decltype)
+                added.append((table, column))
+    return added
+
+
+def createAnalysisTables(c):
+    for statement in ANALYSIS_TABLES:
+        c.execute(statement)
+
+
+def createIndexes(c):
+    for statement in INDEXES:
+        c.execute(statement)
+
+
+def beginBulkLoad(conn, journal_mode="OFF"):
+    # journal_mode may be "WAL" when the DB is shared with readers
+    for statement in BULK_LOAD_PRAGMAS:
+        if statement.startswith('''PRAGMA journal_mode'''):
+            statement = '''PRAGMA journal_mode = ''' + journal_mode
+        conn.execute(statement)
+
+
+def beginLiveIngest(conn):
+    for statement in LIVE_PRAGMAS:
+        conn.execute(statement)
+
+
+def endBulkLoad(conn):
+    # Build the deferred indexes in one pass, refresh the query planner
+    # statistics and go back to durable settings
+    conn.commit()
+    c = conn.cursor()
+    createIndexes(c)
+    c.execute('''ANALYZE''')
+    conn.commit()
+    for statement in DURABLE_PRAGMAS:
+        conn.execute(statement)
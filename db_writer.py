@@ -0,0 +1,190 @@
+#
+# Author:       Timothy Zimmerman (timothy.zimmerman@nist.gov)
+# Organization: National Institute of Standards and Technology
+#               U.S. Department of Commerce
+# License:      Public Domain
+#
+# Description:  Buffered writer for the unified SQLite database. Packet ids
+#               are assigned on the client so that rosPackets and
+#               unclassifiedROSMessages rows can be linked to their parent
+#               without asking SQLite for lastrowid, and the rows of all three
+#               tables are flushed together with executemany inside a single
+#               explicit transaction.
+#
+#               The typed ROS message tables (ros_JointStateMessages, ...) are
+#               filled in the same flush. Their rows are only written for the
+#               first sighting of a packet, identified by its fingerprint, since
+#               the same packet is captured on several machines.
+#
+#               The frame number of the last packet added is recorded in
+#               pcapFiles.last_frame in the same transaction as the rows, so
+#               an interrupted ingest can resume after the last flush.
+#
+#               With a payload_store.PayloadStore the payloads are appended to
+#               the store instead of being stored as BLOBs, see payloadColumns.
+#               The store is flushed before the rows pointing into it are
+#               committed.
+#
+#               By default every fingerprint in the DB is kept in memory. A
+#               writer that runs indefinitely (live_ingest.py) is given a
+#               fingerprint_window instead: only that many recent fingerprints
+#               are kept, and older ones are looked up in rosPackets, which
+#               needs the fingerprint index (db_schema.createIndexes). The
+#               window must hold at least one batch, so the fingerprints of
+#               rows not yet flushed are never evicted.
+#
+
+import time
+from collections import OrderedDict
+import db_schema
+
+# Number of packets buffered before the rows are written to the DB
+DEFAULT_BATCH_SIZE = 5000
+# Maximum number of seconds rows may sit in the buffer before a flush
+DEFAULT_FLUSH_INTERVAL = 5.0
+
+
+class BatchWriter:
+
+    def __init__(self, conn, batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL, payloads=None,
+                 fingerprint_window=None):
+        for window in (fingerprint_window, payloads.window if payloads is not None else None):
+            if window is not None and window < batch_size:
+                raise ValueError("Fingerprint window of " + str(window) + " is smaller than the batch size " + \
+                                 str(batch_size))
+        self.conn = conn
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.payloads = payloads
+        if payloads is not None:
+            payloads.loadIndex(conn)
+
+        self.packetRows = []
+        self.rosRows = []
+        self.unclassifiedRows = []
+        self.typedRows = dict((table, []) for table, columns in db_schema.TYPED_TABLES)
+        self.checkpointFile = None
+        self.checkpointFrame = None
+
+        # Fingerprints of the packets already dissected into the typed tables,
+        # all of them or the most recent fingerprint_window
+        self.fingerprint_window = fingerprint_window
+        if fingerprint_window is None:
+            self.seenFingerprints = set(row[0] for row in conn.execute('''SELECT DISTINCT fingerprint FROM rosPackets'''))
+        else:
+            self.seenFingerprints = OrderedDict()
+
+        # Continue numbering after whatever is already in the DB
+        self.nextPacketId = conn.execute('''SELECT IFNULL(MAX(id), 0) FROM packets''').fetchone()[0] + 1
+
+        self.lastFlush = time.monotonic()
+        self.resetStats()
+
+        # Called as onFlush(packets, ROS messages, seconds) after every flush
+        # that wrote rows, e.g. by instrumentation.Instrumentation
+        self.onFlush = None
+
+    def resetStats(self):
+        self.flushes = 0
+        self.flushTime = 0.0
+        self.packetsWritten = 0
+        self.rosWritten = 0
+        self.unclassifiedWritten = 0
+        self.typedWritten = 0
+
+    def addPacket(self, packetTuple):
+        # packetTuple holds every packets column except the id. Returns the id
+        # the packet will be stored under.
+        packet_id = self.nextPacketId
+        self.nextPacketId += 1
+        self.packetRows.append((packet_id,) + tuple(packetTuple))
+        return packet_id
+
+    def payloadColumns(self, packet_fingerprint, data):
+        # (BLOB, payload_offset) to store a payload under: the bytes and no
+        # offset without a payload store, otherwise no bytes and the offset of
+        # the payload in the store
+        if self.payloads is None:
+            return data, None
+        return None, self.payloads.add(packet_fingerprint, data)
+
+    def addRosPacket(self, rosTuple):
+        self.rosRows.append(rosTuple)
+
+    def addUnclassified(self, unclassifiedTuple):
+        self.unclassifiedRows.append(unclassifiedTuple)
+
+    def firstSighting(self, packet_fingerprint):
+        # True the first time a packet fingerprint is seen by this writer or
+        # its DB
+        if self.fingerprint_window is None:
+            if packet_fingerprint in self.seenFingerprints:
+                return False
+            self.seenFingerprints.add(packet_fingerprint)
+            return True
+        if packet_fingerprint in self.seenFingerprints:
+            self.seenFingerprints.move_to_end(packet_fingerprint)
+            return False
+        first = self.conn.execute('''SELECT 1 FROM rosPackets WHERE fingerprint = ? LIMIT 1''',
+                                  (packet_fingerprint,)).fetchone() is None
+        self.seenFingerprints[packet_fingerprint] = True
+        if len(self.seenFingerprints) > self.fingerprint_window:
+            self.seenFingerprints.popitem(last=False)
+        return first
+
+    def addTypedRow(self, table, typedTuple):
+        # typedTuple holds every column of the typed table except the id
+        self.typedRows[table].append(typedTuple)
+
+    def checkpoint(self, file_id, frame_num):
+        # Last frame of the capture whose rows have been added
+        self.checkpointFile = file_id
+        self.checkpointFrame = frame_num
+
+    def maybeFlush(self):
+        # Called once per packet by the ingest loop
+        if len(self.packetRows) >= self.batch_size or \
+           time.monotonic() - self.lastFlush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        start = time.monotonic()
+        if self.packetRows or self.rosRows or self.unclassifiedRows:
+            c = self.conn.cursor()
+            if self.payloads is not None:
+                self.payloads.flush()
+            if not self.conn.in_transaction:
+                c.execute('''BEGIN''')
+            c.executemany('''INSERT INTO packets VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''', self.packetRows)
+            c.executemany('''INSERT INTO rosPackets VALUES (NULL,?,?,?,?,?,?,?,?)''', self.rosRows)
+            c.executemany('''INSERT INTO unclassifiedROSMessages VALUES (NULL,?,?,?,?,?)''', self.unclassifiedRows)
+            for table, columns in db_schema.TYPED_TABLES:
+                rows = self.typedRows[table]
+                if rows:
+                    c.executemany('''INSERT INTO ''' + table + ''' VALUES (NULL''' + ''',?''' * (len(columns) - 1) + ''')''', rows)
+                    self.typedWritten += len(rows)
+                    self.typedRows[table] = []
+            if self.checkpointFile is not None:
+                c.execute('''UPDATE pcapFiles SET last_frame = ? WHERE id = ?''',
+                          (self.checkpointFrame, self.checkpointFile))
+            self.conn.commit()
+
+            self.flushes += 1
+            self.packetsWritten += len(self.packetRows)
+            self.rosWritten += len(self.rosRows)
+            self.unclassifiedWritten += len(self.unclassifiedRows)
+            if self.onFlush is not None:
+                self.onFlush(len(self.packetRows), len(self.rosRows), time.monotonic() - start)
+            self.packetRows = []
+            self.rosRows = []
+            self.unclassifiedRows = []
+        self.lastFlush = time.monotonic()
+        self.flushTime += self.lastFlush - start
+
+    def summary(self):
+        return ("DB writer: " + str(self.packetsWritten) + " packets, " + str(self.rosWritten) + \
+                " ROS messages (" + str(self.typedWritten) + " typed), " + \
+                str(self.unclassifiedWritten) + " unclassified in " + \
+                str(self.flushes) + " flushes ({0:.2f}s".format(self.flushTime) + \
+                ", batch size " + str(self.batch_size) + \
+                ", flush interval {0:g}s)".format(self.flush_interval))
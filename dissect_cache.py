@@ -0,0 +1,68 @@
+#
+# Author:       Timothy Zimmerman (timothy.zimmerman@nist.gov)
+# Organization: National Institute of Standards and Technology
+#               U.S. Department of Commerce
+# License:      Public Domain
+#
+# Description:  LRU cache in front of the ROS dissector. With several capture
+#               points the same payload is seen once per sniffer, and periodic
+#               messages (e.g. the dependency updates) repeat byte for byte,
+#               so the dissected messages are kept by payload digest and
+#               endianness instead of dissecting every copy again.
+#
+#               A cache belongs to one process and is not shared: the parallel
+#               workers each build their own and only their counters are sent
+#               back to be added up.
+#
+
+import hashlib
+from collections import OrderedDict
+import ros_msg_dissector as rosDisector
+
+# Payloads whose messages are kept
+DEFAULT_MAX_ENTRIES = 16384
+
+
+class DissectionCache:
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def dissect(self, unpack_header, data):
+        # Same as ros_msg_dissector.dissectPacket, but the messages come back
+        # as a tuple that is shared by every copy of the payload. A payload the
+        # dissector raises on is not cached.
+        key = (unpack_header, hashlib.blake2b(data, digest_size=16).digest())
+        messages = self.entries.get(key)
+        if messages is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return messages
+        self.misses += 1
+        messages = tuple(rosDisector.dissectPacket(unpack_header, data))
+        self.entries[key] = messages
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return messages
+
+    def clear(self):
+        # Drop the entries but keep the counters, e.g. before the cache is
+        # pickled back from a worker process
+        self.entries.clear()
+
+    def addCounters(self, other):
+        self.hits += other.hits
+        self.misses += other.misses
+        self.evictions += other.evictions
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        hitPercent = (self.hits / lookups) * 100 if lookups > 0 else 0.0
+        return ("Dissection cache: " + str(self.hits) + " hits, " + str(self.misses) + " misses " + \
+                "({0:.2f}% hit rate), ".format(hitPercent) + str(self.evictions) + " evictions " + \
+                "(" + str(self.max_entries) + " entries)")
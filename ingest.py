@@ -0,0 +1,311 @@
+#
+# Author:       Timothy Zimmerman (timothy.zimmerman@nist.gov)
+# Organization: National Institute of Standards and Technology
+#               U.S. Department of Commerce
+# License:      Public Domain
+#
+# Description:  Building blocks of the ingest used by pipeline.py, the
+#               parallel ingest workers and live_ingest.py: the unified DB
+#               and its pcapFiles bookkeeping, packet fingerprints, the ROS
+#               dissector call, and the rows stored for a packet through a
+#               db_writer.BatchWriter. The dissected messages go straight
+#               into the typed ros_* tables.
+#
+
+import hashlib
+import os
+import socket
+import sqlite3
+import struct
+import db_schema
+import pcap_reader
+import ros_msg_dissector as rosDisector
+
+
+class FileStats:
+
+    def __init__(self, filename, file_id):
+        self.filename = filename
+        self.file_id = file_id
+        self.detectedPackets = 0
+        self.dissectedPackets = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+        self.filterSummary = None
+        self.reassemblySummary = None
+        self.writerSummary = None
+        # DissectionCache of a parallel worker, for its counters
+        self.dissectionCache = None
+        # Seconds spent writing to SQLite, and the pid of the process that
+        # wrote the rows if it was a parallel worker
+        self.writeTime = 0.0
+        self.worker = None
+        # instrumentation.DissectorTimer counters of a parallel worker
+        self.dissectorCounters = None
+        # Frames skipped because an earlier ingest stored them
+        self.resumeAfter = 0
+        # async_pipeline.PipelineMetrics of a concurrent ingest
+        self.pipelineMetrics = None
+
+    def report(self):
+        lines = []
+        successPercent = (self.dissectedPackets/self.detectedPackets)*100 if self.detectedPackets > 0 else 0.0
+        lines.append("Successfully dissected " + str(self.dissectedPackets) + " out of " + str(self.detectedPackets) + \
+                     " packets ({0:.2f}".format(successPercent) + "%) in " + str(self.filename))
+        if self.filterSummary is not None:
+            lines.append(self.filterSummary)
+        if self.reassemblySummary is not None:
+            lines.append(self.reassemblySummary)
+        if self.writerSummary is not None:
+            lines.append(self.writerSummary)
+        if self.pipelineMetrics is not None:
+            lines.extend(self.pipelineMetrics.summary())
+        return lines
+
+    def throughput(self):
+        # (packets/s, MB/s) of payload for this file
+        if self.elapsed <= 0:
+            return 0.0, 0.0
+        return self.detectedPackets / self.elapsed, self.bytes / self.elapsed / 1e6
+
+
+def createDatabase(db_filename, check_same_thread=True):
+    # Creates the tables of a new DB, or upgrades an existing one in a single
+    # transaction, filling in the fingerprints of packets stored with only
+    # an md5_hash so they match the packets added from now on.
+    # check_same_thread=False lets another thread use the connection, as
+    # the write stage of async_pipeline.py does.
+    conn = sqlite3.connect(db_filename, check_same_thread=check_same_thread)
+    c = conn.cursor()
+    c.execute('''BEGIN''')
+    db_schema.createIngestTables(c)
+    db_schema.upgradeIngestTables(c)
+    backfillFingerprints(conn)
+    db_schema.createAnalysisTables(c)
+    conn.commit()
+    return conn
+
+
+def machineName(filename):
+    return filename.split('_')[0]
+
+
+def fileFingerprint(filename):
+    # (size, mtime, header hash) of a capture. The hash covers the global
+    # header and the first record, which do not change when packets are
+    # appended to the capture.
+    st = os.stat(filename)
+    with open(filename, 'rb') as f:
+        header = f.read(pcap_reader.PCAP_GLOBAL_HEADER_LEN + pcap_reader.PCAP_RECORD_HEADER_LEN)
+        try:
+            unpack_header = pcap_reader.readGlobalHeader(header)[0]
+            incl_len = struct.unpack_from(unpack_header + 'I', header, pcap_reader.PCAP_GLOBAL_HEADER_LEN + 8)[0]
+            header += f.read(incl_len)
+        except (pcap_reader.PcapFormatError, struct.error):
+            pass
+    return st.st_size, st.st_mtime, hashlib.md5(header).hexdigest()
+
+
+def registerFile(c, filename, machine_name=None, fingerprint=None, file_id=None):
+    # Insert the capture into pcapFiles and return its file number. file_id
+    # is the number to use, e.g. the one another DB gave the capture, or
+    # None for the next free one.
+    if machine_name is None:
+        machine_name = machineName(filename)
+    if fingerprint is None:
+        fingerprint = (None, None, None)
+    filetuple = (file_id, str(filename), str(machine_name)) + tuple(fingerprint)
+    c.execute('''INSERT INTO pcapFiles (id, filename, machinename, file_size, file_mtime, header_hash) \
+                 VALUES (?,?,?,?,?,?)''', filetuple)
+    c.execute('''SELECT last_insert_rowid()''')
+    return c.fetchone()[0]
+
+
+def findFile(c, filename, fingerprint):
+    # Look for an earlier ingest of the capture. Returns (file_id, last_frame,
+    # status) with status "done" if the capture is unchanged since it was
+    # completely ingested, "resume" if the ingest was interrupted or the
+    # capture has grown since, or None if the capture is new.
+    size, mtime, header_hash = fingerprint
+    c.execute('''SELECT id, file_size, file_mtime, last_frame, complete FROM pcapFiles \
+                 WHERE filename = ? AND header_hash = ? ORDER BY id DESC LIMIT 1''',
+              (str(filename), header_hash))
+    row = c.fetchone()
+    if row is None or row[1] is None or size < row[1]:
+        return None
+    file_id, file_size, file_mtime, last_frame, complete = tuple(row)
+    if complete and size == file_size and mtime == file_mtime:
+        return file_id, last_frame, "done"
+    return file_id, last_frame or 0, "resume"
+
+
+def completeFile(c, file_id, fingerprint=None):
+    # Mark the ingest of a capture as complete, refreshing its fingerprint
+    if fingerprint is not None:
+        c.execute('''UPDATE pcapFiles SET file_size = ?, file_mtime = ?, header_hash = ? WHERE id = ?''',
+                  tuple(fingerprint) + (file_id,))
+    c.execute('''UPDATE pcapFiles SET complete = 1 WHERE id = ?''', (file_id,))
+
+
+def readEndianness(filename):
+    # Check the global header for proper format and the endianness. Raises
+    # pcap_reader.PcapFormatError if the file does not look like a PCAP.
+    f = open(filename, 'rb')
+    global_header = f.read(pcap_reader.PCAP_GLOBAL_HEADER_LEN)
+    f.close()
+    return pcap_reader.readGlobalHeader(global_header)[0]
+
+
+# Canonical binary form of the fingerprinted header fields: MAC dst/src and
+# IPv4 dst/src addresses, TCP dst/src ports, seq, next seq, ack and the
+# payload length. The payload follows it.
+FINGERPRINT_HEADER = struct.Struct('!20sHHIIII')
+# Bytes of the blake2b digest, stored as a signed SQLite INTEGER
+FINGERPRINT_SIZE = 8
+
+
+def addressBytes(eth_dst, eth_src, ip_dst, ip_src):
+    # Raw addresses from their text form, for packets from pyshark or the DB
+    return bytes.fromhex(eth_dst.replace(':', '')) + bytes.fromhex(eth_src.replace(':', '')) + \
+           socket.inet_aton(ip_dst) + socket.inet_aton(ip_src)
+
+
+def packetFingerprint(addresses, tcp_dstport, tcp_srcport, tcp_seq, tcp_nxtseq, tcp_ack, data, data_len):
+    # The copies of a packet captured on different machines have the same
+    # fingerprint. Covers the same fields as the md5_hash of older DBs.
+    h = hashlib.blake2b(FINGERPRINT_HEADER.pack(addresses, tcp_dstport, tcp_srcport, tcp_seq,
+                                                tcp_nxtseq & 0xffffffff, tcp_ack, data_len),
+                        digest_size=FINGERPRINT_SIZE)
+    h.update(data)
+    return int.from_bytes(h.digest(), 'big', signed=True)
+
+
+def fingerprint(packet):
+    addresses = packet.addresses
+    if addresses is None:
+        addresses = addressBytes(packet.eth_dst, packet.eth_src, packet.ip_dst, packet.ip_src)
+    return packetFingerprint(addresses, packet.tcp_dstport, packet.tcp_srcport, packet.tcp_seq,
+                             packet.tcp_nxtseq, packet.tcp_ack, packet.data, packet.data_len)
+
+
+# Packets fingerprinted per query by backfillFingerprints
+BACKFILL_BATCH_SIZE = 10000
+
+
+def backfillFingerprints(conn, batch_size=BACKFILL_BATCH_SIZE):
+    # Compute the fingerprints of packets stored with only an md5_hash, from
+    # the header fields and payload in the DB. Returns the number of packets.
+    # The caller commits.
+    c = conn.cursor()
+    lastId = 0
+    count = 0
+    while True:
+        rows = c.execute('''SELECT id, shark_eth_dst, shark_eth_src, shark_ip_dst, shark_ip_src, \
+                            shark_tcp_port_dst, shark_tcp_port_src, shark_tcp_seq_num, shark_tcp_next_seq_num, \
+                            shark_tcp_expected_ack, shark_data, shark_data_len FROM packets \
+                            WHERE fingerprint IS NULL AND id > ? ORDER BY id LIMIT ?''',
+                         (lastId, batch_size)).fetchall()
+        if not rows:
+            break
+        updates = []
+        for row in rows:
+            updates.append((packetFingerprint(addressBytes(*row[1:5]), row[5], row[6], row[7], row[8] or 0,
+                                              row[9], row[10], row[11]), row[0]))
+        c.executemany('''UPDATE packets SET fingerprint = ? WHERE id = ?''', updates)
+        lastId = rows[-1][0]
+        count += len(rows)
+    c.execute('''UPDATE rosPackets SET fingerprint = (SELECT fingerprint FROM packets \
+                 WHERE packets.id = rosPackets.parent_id) WHERE fingerprint IS NULL''')
+    return count
+
+
+def dissectFrame(unpack_header, packet, cache=None):
+    # Run the packet data through the dissector to determine if it is a ROS
+    # packet of the types we are looking for. Returns None if the dissector
+    # failed on the payload.
+    try:
+        if cache is not None:
+            return cache.dissect(unpack_header, packet.data)
+        return rosDisector.dissectPacket(unpack_header, packet.data)
+    except:
+        return None
+
+
+def jointColumns(values, cols):
+    # The values of the joints at cols. A JointState may carry fewer
+    # velocities or efforts than names (often none at all); the joints
+    # without a value are NULL.
+    return tuple(values[i] if i < len(values) else None for i in cols)
+
+
+def typedRow(parent_id, msg):
+    # Returns (table, row) for a dissected message, or None if the message
+    # has no typed table or lacks one of the joints the table expects. A
+    # JointState must have the position of every joint, the analysis relies
+    # on them; its velocities and efforts may be missing.
+    msgType = msg.ros_msg_type
+    if msgType == "JointStateMsg":
+        idx = dict((name, i) for i, name in enumerate(msg.joint_names))
+        try:
+            cols = [idx[name] for name in db_schema.JOINT_NAMES]
+        except KeyError:
+            return None
+        if max(cols) >= len(msg.positions):
+            return None
+        return "ros_JointStateMessages", (parent_id, msg.ros_time, msg.ros_frame_id, msg.ros_msg_len, msg.ros_arm_num) + \
+                jointColumns(msg.positions, cols) + \
+                jointColumns(msg.velocities, cols) + \
+                jointColumns(msg.efforts, cols)
+    if msgType == "BricsPositionMsg" or msgType == "GripperMsg":
+        names = db_schema.JOINT_NAMES[:5] if msgType == "BricsPositionMsg" else db_schema.JOINT_NAMES[5:]
+        idx = dict((name, i) for i, name in enumerate(msg.joint_names))
+        try:
+            cols = [idx[name] for name in names]
+        except KeyError:
+            return None
+        values = tuple(msg.values[i] for i in cols) + tuple(msg.units[i] for i in cols)
+        if msgType == "BricsPositionMsg":
+            return "ros_BricsPositionMessages", (parent_id, msg.ros_msg_len, msg.ros_arm_num, 0) + values
+        return "ros_BricsGripperMessages", (parent_id, msg.ros_msg_len, msg.ros_arm_num) + values
+    if msgType == "DependencyMsg":
+        return "ros_DependencyMessages", (parent_id, msg.ros_time, msg.ros_frame_id, msg.ros_msg_len,
+                                          msg.depend_string, msg.depend_val)
+    return None
+
+
+def countFrame(stats, packet, packetData):
+    stats.detectedPackets += 1
+    stats.bytes += packet.data_len
+    if packetData:
+        stats.dissectedPackets += 1
+
+
+def storeFrame(writer, packet, pcap_filenumber, packet_fingerprint, packetData):
+    # md5_hash is only filled in DBs from before the fingerprint column. With
+    # a payload store the payload is stored once per fingerprint and only its
+    # offset is kept in the rows.
+    data, payload_offset = writer.payloadColumns(packet_fingerprint, packet.data)
+    packetTuple = ( packet.timestamp, pcap_filenumber, packet.number, packet.eth_dst, packet.eth_src, \
+            packet.ip_dst, packet.ip_src, packet.tcp_dstport, packet.tcp_srcport, packet.tcp_seq, \
+            packet.tcp_nxtseq, packet.tcp_ack, packet.tcp_checksum, packet.tcp_initial_rtt, \
+            data, packet.data_len, None, packet_fingerprint, payload_offset)
+
+    curr_id = writer.addPacket(packetTuple)
+    writer.checkpoint(pcap_filenumber, packet.number)
+    if packetData is None:
+        return
+
+    # Did the function return data? No data means it was not able to dissect
+    if len(packetData) > 0:
+        firstSighting = writer.firstSighting(packet_fingerprint)
+        for msg in packetData:
+            rosTuple = ( curr_id, packet.number, data, packet.data_len, msg.ros_msg_type, None,
+                         packet_fingerprint, payload_offset)
+            writer.addRosPacket(rosTuple)
+            if firstSighting:
+                row = typedRow(curr_id, msg)
+                if row is not None:
+                    writer.addTypedRow(*row)
+    else:
+        packetTuple = ( curr_id, packet.number, data, payload_offset, packet.data_len)
+        writer.addUnclassified(packetTuple)
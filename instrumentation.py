@@ -0,0 +1,340 @@
+#
+# Author:       Timothy Zimmerman (timothy.zimmerman@nist.gov)
+# Organization: National Institute of Standards and Technology
+#               U.S. Department of Commerce
+# License:      Public Domain
+#
+# Description:  Instrumentation that pcap_to_db.py and analyze.py report into:
+#               wall time of every stage, the calls, message bytes and time
+#               of each ros_msg_dissector dissect*Msg function per message
+#               type, the SQLite write time, and per-file ingest figures. A
+#               progress line is printed periodically while the DB is filled
+#               and everything can be written as a JSON or CSV report.
+#
+#               Stages are timed with a context manager, a handful of calls
+#               per run. The per-packet hooks (the dissector wrappers and the
+#               writer's flush callback) are only installed when enabled, so
+#               a disabled Instrumentation costs nothing on the hot path.
+#
+#               Optionally the whole run is profiled with cProfile, or with a
+#               sampling profiler that records the stack of the main thread
+#               at a fixed interval and writes it in the collapsed format of
+#               flamegraph.pl / speedscope.
+#
+
+import collections
+import csv
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+import ros_msg_dissector as rosDisector
+
+# Seconds between progress lines
+PROGRESS_INTERVAL = 10.0
+
+# Seconds between stack samples of the sampling profiler
+SAMPLE_INTERVAL = 0.005
+
+# Functions listed after a cProfile run
+PROFILE_TOP = 25
+
+# The dissectors as defined, before any timing wrappers are put in
+ORIGINAL_DISSECTORS = list(rosDisector.DISSECTORS)
+
+
+class Stage:
+    __slots__ = ('name', 'seconds', 'packets', 'bytes')
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.packets = 0
+        self.bytes = 0
+
+    def asDict(self):
+        return {
+            'stage': self.name,
+            'seconds': self.seconds,
+            'packets': self.packets,
+            'bytes': self.bytes,
+            'packets_per_s': self.packets / self.seconds if self.seconds > 0 else None,
+            'mb_per_s': self.bytes / self.seconds / 1e6 if self.seconds > 0 else None,
+        }
+
+
+class DissectorTimer:
+    # Replaces the entries of ros_msg_dissector.DISSECTORS with wrappers that
+    # count the calls, message bytes and time per message type. The counters
+    # are a plain dict {type: [calls, bytes, seconds]} so they can be sent
+    # back from a worker process.
+
+    def __init__(self):
+        self.counters = dict((msgType, [0, 0, 0.0]) for msgType in rosDisector.ROS_PACKET_TYPES)
+
+    def wrap(self, dissector, counter):
+        perf_counter = time.perf_counter
+        structs = rosDisector.STRUCTS
+
+        def timedDissector(unpack_header, d, offset=0):
+            counter[0] += 1
+            counter[1] += 4 + structs[unpack_header].uint32(d, offset)[0]
+            start = perf_counter()
+            try:
+                return dissector(unpack_header, d, offset)
+            finally:
+                counter[2] += perf_counter() - start
+        return timedDissector
+
+    def install(self):
+        for typeId, dissector in enumerate(ORIGINAL_DISSECTORS):
+            rosDisector.DISSECTORS[typeId] = self.wrap(dissector, self.counters[rosDisector.ROS_PACKET_TYPES[typeId]])
+
+    def uninstall(self):
+        rosDisector.DISSECTORS[:] = ORIGINAL_DISSECTORS
+
+    def addCounters(self, counters):
+        for msgType, (calls, nbytes, seconds) in counters.items():
+            counter = self.counters.setdefault(msgType, [0, 0, 0.0])
+            counter[0] += calls
+            counter[1] += nbytes
+            counter[2] += seconds
+
+    def rows(self):
+        rows = []
+        for msgType, (calls, nbytes, seconds) in self.counters.items():
+            rows.append({
+                'msg_type': msgType,
+                'calls': calls,
+                'bytes': nbytes,
+                'seconds': seconds,
+                'us_per_call': seconds / calls * 1e6 if calls else None,
+            })
+        return rows
+
+
+class SamplingProfiler:
+    # Samples the stack of one thread from a background thread. Only the
+    # interval and the stack depth cost anything; the sampled thread is not
+    # traced.
+
+    def __init__(self, interval=SAMPLE_INTERVAL, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.running = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.running.set()
+        self.thread = threading.Thread(target=self.run, name="sampler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while self.running.is_set():
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(code.co_name + " (" + code.co_filename.replace('\\', '/').split('/')[-1] + ":" + \
+                             str(code.co_firstlineno) + ")")
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+                self.samples += 1
+            time.sleep(self.interval)
+
+    def write(self, filename):
+        # One "outer;...;inner count" line per distinct stack
+        with open(filename, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(stack + " " + str(count) + "\n")
+
+    def top(self, n=PROFILE_TOP):
+        # (function, samples) of the innermost frames
+        functions = collections.Counter()
+        for stack, count in self.stacks.items():
+            functions[stack.rsplit(';', 1)[-1]] += count
+        return functions.most_common(n)
+
+
+class Instrumentation:
+
+    def __init__(self, name, enabled=True, progress_interval=PROGRESS_INTERVAL, profile=None, report=print):
+        # profile is None, "cprofile" or "sampling"
+        self.name = name
+        self.enabled = enabled
+        self.progress_interval = progress_interval
+        self.profile = profile if enabled else None
+        self.report = report
+        self.stages = collections.OrderedDict()
+        self.files = []
+        self.writeSeconds = 0.0
+        self.flushes = 0
+        self.packetsWritten = 0
+        self.rosWritten = 0
+        self.dissectors = None
+        self.profiler = None
+        self.started = time.monotonic()
+        self.lastProgress = self.started
+
+    def start(self):
+        # Install the per-packet hooks and start the profiler
+        if not self.enabled:
+            return
+        self.dissectors = DissectorTimer()
+        self.dissectors.install()
+        if self.profile == "cprofile":
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif self.profile == "sampling":
+            self.profiler = SamplingProfiler()
+            self.profiler.start()
+        elif self.profile is not None:
+            raise ValueError("Unknown profile mode: " + str(self.profile))
+
+    def stop(self):
+        if self.profiler is not None:
+            if self.profile == "cprofile":
+                self.profiler.disable()
+            else:
+                self.profiler.stop()
+        if self.dissectors is not None:
+            self.dissectors.uninstall()
+
+    @contextmanager
+    def stage(self, name):
+        # Time a stage; the caller may set packets and bytes on the Stage.
+        # A stage entered again adds to its time.
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = Stage(name)
+        start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            stage.seconds += time.perf_counter() - start
+
+    def watchWriter(self, writer):
+        # Have a db_writer.BatchWriter report every flush
+        if self.enabled:
+            writer.onFlush = self.flushed
+
+    def flushed(self, packets, rosMessages, seconds):
+        self.flushes += 1
+        self.packetsWritten += packets
+        self.rosWritten += rosMessages
+        self.writeSeconds += seconds
+        now = time.monotonic()
+        if self.report is not None and now - self.lastProgress >= self.progress_interval:
+            self.lastProgress = now
+            self.report(self.progress(now))
+
+    def progress(self, now=None):
+        elapsed = (now or time.monotonic()) - self.started
+        rate = self.packetsWritten / elapsed if elapsed > 0 else 0.0
+        writePercent = self.writeSeconds / elapsed * 100 if elapsed > 0 else 0.0
+        return ("[PROGRESS] {0:.0f}s: ".format(elapsed) + str(self.packetsWritten) + " packets, " + \
+                str(self.rosWritten) + " ROS messages ({0:.0f} packets/s), ".format(rate) + \
+                "SQLite writes {0:.1f}s ({1:.0f}%)".format(self.writeSeconds, writePercent))
+
+    def addFile(self, stats):
+        # FileStats of an ingested capture. The write time of captures that
+        # were written by another process (the parallel shards) is added to
+        # the total here, as their flushes were not seen.
+        if stats.dissectorCounters is not None and self.dissectors is not None:
+            self.dissectors.addCounters(stats.dissectorCounters)
+        if stats.worker is not None and stats.worker != os.getpid():
+            self.writeSeconds += stats.writeTime
+        row = {
+            'filename': str(stats.filename),
+            'file_id': stats.file_id,
+            'packets': stats.detectedPackets,
+            'dissected': stats.dissectedPackets,
+            'bytes': stats.bytes,
+            'seconds': stats.elapsed,
+            'write_seconds': stats.writeTime,
+        }
+        if stats.pipelineMetrics is not None:
+            # Stage and queue-depth figures of an async_pipeline.py ingest
+            row['pipeline'] = stats.pipelineMetrics.asDict()
+        self.files.append(row)
+
+    def results(self):
+        results = {
+            'name': self.name,
+            'date': datetime.datetime.now().isoformat(),
+            'seconds': time.monotonic() - self.started,
+            'stages': [stage.asDict() for stage in self.stages.values()],
+            'files': self.files,
+            'sqlite_write': {'seconds': self.writeSeconds, 'flushes': self.flushes},
+        }
+        if self.dissectors is not None:
+            results['dissectors'] = self.dissectors.rows()
+        return results
+
+    def summary(self):
+        lines = []
+        for stage in self.stages.values():
+            line = "{0:24s} {1:8.2f}s".format(stage.name, stage.seconds)
+            if stage.packets and stage.seconds > 0:
+                line += " {0:10.0f} packets/s".format(stage.packets / stage.seconds)
+            lines.append(line)
+        if self.flushes or self.writeSeconds:
+            lines.append("SQLite writes: {0:.2f}s in ".format(self.writeSeconds) + str(self.flushes) + " flushes")
+        if self.dissectors is not None:
+            for row in self.dissectors.rows():
+                if row['calls']:
+                    lines.append("{0:24s} {1:8.2f}s {2:10d} calls {3:8.1f} us/call {4:12d} bytes".format(
+                        row['msg_type'], row['seconds'], row['calls'], row['us_per_call'], row['bytes']))
+        return lines
+
+    def writeReport(self, filename):
+        # JSON, or CSV when filename ends in .csv. With a profiler the profile
+        # is written next to it (.prof for cProfile, .folded for sampling).
+        results = self.results()
+        if filename.lower().endswith('.csv'):
+            with open(filename, 'w', newline='') as f:
+                out = csv.writer(f)
+                out.writerow(['section', 'name', 'seconds', 'count', 'bytes'])
+                for stage in results['stages']:
+                    out.writerow(['stage', stage['stage'], stage['seconds'], stage['packets'], stage['bytes']])
+                for row in results.get('dissectors', []):
+                    out.writerow(['dissector', row['msg_type'], row['seconds'], row['calls'], row['bytes']])
+                for row in results['files']:
+                    out.writerow(['file', row['filename'], row['seconds'], row['packets'], row['bytes']])
+                out.writerow(['sqlite_write', '', self.writeSeconds, self.flushes, ''])
+        else:
+            with open(filename, 'w') as f:
+                json.dump(results, f, indent=2)
+
+        base = filename.rsplit('.', 1)[0]
+        if self.profile == "cprofile" and self.profiler is not None:
+            self.profiler.dump_stats(base + ".prof")
+        elif self.profile == "sampling" and self.profiler is not None:
+            self.profiler.write(base + ".folded")
+
+    def profileSummary(self, n=PROFILE_TOP):
+        if self.profile == "cprofile" and self.profiler is not None:
+            import io
+            import pstats
+            out = io.StringIO()
+            pstats.Stats(self.profiler, stream=out).sort_stats('cumulative').print_stats(n)
+            return out.getvalue().splitlines()
+        if self.profile == "sampling" and self.profiler is not None:
+            lines = [str(self.profiler.samples) + " samples"]
+            for function, count in self.profiler.top(n):
+                lines.append("{0:6.1f}% ".format(count / self.profiler.samples * 100) + function)
+            return lines
+        return []
@@ -0,0 +1,533 @@
+#
+# Author:       Timothy Zimmerman (timothy.zimmerman@nist.gov)
+# Organization: National Institute of Standards and Technology
+#               U.S. Department of Commerce
+# License:      Public Domain
+#
+# Description:  JointState time series per capture file and arm, so "what
+#               were the joint positions between t0 and t1" is a binary
+#               search instead of joining ros_JointStateMessages to packets
+#               and sorting by shark_timestamp. A series holds the capture
+#               timestamps, ROS header times and frame numbers of its
+#               samples plus the position, velocity and effort of the 7
+#               joints (db_schema.JOINT_NAMES order) in contiguous float64
+#               arrays, sorted by capture time.
+#
+#               The series are built at ingest by JointSeriesSink (see
+#               pipeline.py), or from the DB by writeStoredSeries, and
+#               stored one file per series:
+#
+#                   header   magic, version, joints, file id, arm, samples
+#                   float64  capture timestamps
+#                   float64  ROS header times
+#                   int64    frame numbers
+#                   float64  samples x joints x (position, velocity, effort)
+#
+#               all little endian, so openSeries maps a file and reads the
+#               arrays in place. With NumPy the arrays are ndarrays (values
+#               shaped (samples, joints, 3)), otherwise memoryviews.
+#
+#               Usage: python joint_series.py <directory> <capture.pcap> ...
+#
+#               writes the series of the captures without a DB.
+#
+
+import glob
+import heapq
+import mmap
+import os
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from struct import Struct
+import db_schema
+import pipeline
+
+# NumPy is optional. Without it the queries and resampling run in Python
+# over memoryviews of the file.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SERIES_MAGIC = b'YBJS'
+SERIES_VERSION = 1
+# magic, version, joints, file id, arm, samples
+SERIES_HEADER = Struct('<4sHHqqq')
+SERIES_EXTENSION = ".jts"
+
+JOINTS = len(db_schema.JOINT_NAMES)
+FIELDS = ('position', 'velocity', 'effort')
+NAN = float('nan')
+
+# Columns of ros_JointStateMessages with the values of a sample, in the
+# order JointSeriesBuilder.add takes them
+JOINT_SERIES_COLUMNS = tuple(joint + '_' + field for field in ('value', 'velocity', 'effort')
+                             for joint in db_schema.JOINT_NAMES)
+
+# Values can be read in place only on little-endian hosts
+NATIVE_LAYOUT = sys.byteorder == 'little'
+
+# Samples a JointSeriesWriter collects before it sorts them and appends them
+# to its spool file
+SERIES_CHUNK_SIZE = 16384
+# A sample in the spool file: capture timestamp, ROS time, frame, values
+SAMPLE_RECORD = Struct('<ddq' + str(JOINTS * 3) + 'd')
+# Samples read from the spool file at a time
+SPOOL_BLOCK = 4096
+
+
+def seriesPath(directory, file_id, arm):
+    return os.path.join(directory, "file" + str(file_id) + "_arm" + str(arm) + SERIES_EXTENSION)
+
+
+class JointSeries:
+
+    def __init__(self, file_id, arm, timestamps, ros_times, frames, values, mm=None):
+        # values holds samples x JOINTS x 3 floats, as an (n, JOINTS, 3)
+        # ndarray with NumPy and flat otherwise. mm is the map the arrays
+        # point into, if any.
+        self.file_id = file_id
+        self.arm = arm
+        self.timestamps = timestamps
+        self.ros_times = ros_times
+        self.frames = frames
+        self.values = values
+        self.mm = mm
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def indexRange(self, t0, t1):
+        # (start, stop) of the samples with t0 <= timestamp <= t1
+        if numpy is not None:
+            return (int(numpy.searchsorted(self.timestamps, t0, 'left')),
+                    int(numpy.searchsorted(self.timestamps, t1, 'right')))
+        return bisect_left(self.timestamps, t0), bisect_right(self.timestamps, t1)
+
+    def value(self, i, joint, field=0):
+        if numpy is not None:
+            return float(self.values[i, joint, field])
+        return self.values[(i * JOINTS + joint) * 3 + field]
+
+    def sample(self, i, field=0):
+        # The JOINTS values of one field of sample i
+        if numpy is not None:
+            return self.values[i, :, field]
+        return [self.values[(i * JOINTS + joint) * 3 + field] for joint in range(JOINTS)]
+
+    def between(self, t0, t1, field='position'):
+        # (timestamps, values) of the samples from t0 to t1, values being one
+        # row of JOINTS values per sample. With NumPy both are views into
+        # the series.
+        start, stop = self.indexRange(t0, t1)
+        column = FIELDS.index(field)
+        if numpy is not None:
+            return self.timestamps[start:stop], self.values[start:stop, :, column]
+        return list(self.timestamps[start:stop]), [self.sample(i, column) for i in range(start, stop)]
+
+    def nearest(self, t):
+        # Index of the sample closest in time to t, or None for an empty series
+        n = len(self)
+        if n == 0:
+            return None
+        i = self.indexRange(t, t)[0]
+        if i == 0:
+            return 0
+        if i == n:
+            return n - 1
+        return i if self.timestamps[i] - t < t - self.timestamps[i - 1] else i - 1
+
+    def resample(self, times, field='position', method='linear'):
+        # Values of the joints at each of times: interpolated between the
+        # neighbouring samples ("linear") or those of the last sample at or
+        # before the time ("previous"). Times outside the series get the
+        # first or last sample. Returns a (len(times), JOINTS) array with
+        # NumPy, a list of rows otherwise.
+        if method not in ('linear', 'previous'):
+            raise ValueError("Unknown resampling method: " + str(method))
+        if len(self) == 0:
+            raise ValueError("Cannot resample an empty series")
+        column = FIELDS.index(field)
+        if numpy is not None:
+            times = numpy.asarray(times, dtype=float)
+            if method == 'linear':
+                return numpy.stack([numpy.interp(times, self.timestamps, self.values[:, joint, column])
+                                    for joint in range(JOINTS)], axis=1)
+            idx = numpy.clip(numpy.searchsorted(self.timestamps, times, 'right') - 1, 0, len(self) - 1)
+            return self.values[idx, :, column]
+
+        rows = []
+        last = len(self) - 1
+        for t in times:
+            i = bisect_right(self.timestamps, t) - 1
+            if method == 'previous' or i < 0 or i >= last:
+                rows.append(self.sample(min(max(i, 0), last), column))
+            else:
+                t_a = self.timestamps[i]
+                t_b = self.timestamps[i + 1]
+                w = (t - t_a) / (t_b - t_a) if t_b > t_a else 0.0
+                a = self.sample(i, column)
+                b = self.sample(i + 1, column)
+                rows.append([a[joint] + (b[joint] - a[joint]) * w for joint in range(JOINTS)])
+        return rows
+
+    def resampleEvery(self, step, field='position', method='linear', t0=None, t1=None):
+        # (times, values) on a regular grid of step seconds from t0 to t1,
+        # by default the whole series
+        t0 = self.timestamps[0] if t0 is None else t0
+        t1 = self.timestamps[len(self) - 1] if t1 is None else t1
+        count = int((t1 - t0) / step) + 1
+        times = [t0 + k * step for k in range(count)]
+        return times, self.resample(times, field, method)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(SERIES_HEADER.pack(SERIES_MAGIC, SERIES_VERSION, JOINTS, self.file_id, self.arm, len(self)))
+            for data, typecode in ((self.timestamps, 'd'), (self.ros_times, 'd'), (self.frames, 'q'),
+                                   (self.values, 'd')):
+                if numpy is not None:
+                    f.write(numpy.ascontiguousarray(data, dtype='<i8' if typecode == 'q' else '<f8').tobytes())
+                else:
+                    data = array(typecode, data)
+                    if not NATIVE_LAYOUT:
+                        data.byteswap()
+                    f.write(data.tobytes())
+
+    def close(self):
+        # Release the views before the map they point into
+        if self.mm is not None:
+            for name in ('timestamps', 'ros_times', 'frames', 'values'):
+                data = getattr(self, name)
+                if isinstance(data, memoryview):
+                    data.release()
+                setattr(self, name, None)
+            try:
+                self.mm.close()
+            except BufferError:
+                # NumPy views handed out by between() are still alive; the
+                # map goes away with them
+                pass
+            self.mm = None
+
+
+def openSeries(path):
+    # Map a series file and return a JointSeries reading it in place. On a
+    # big-endian host without NumPy the arrays are copied instead.
+    with open(path, 'rb') as f:
+        header = f.read(SERIES_HEADER.size)
+        magic, version, joints, file_id, arm, count = SERIES_HEADER.unpack(header)
+        if magic != SERIES_MAGIC or version != SERIES_VERSION or joints != JOINTS:
+            raise ValueError("Not a JointState series file: " + str(path))
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    offset = SERIES_HEADER.size
+    arrays = []
+    for typecode, length in (('d', count), ('d', count), ('q', count), ('d', count * JOINTS * 3)):
+        if numpy is not None:
+            arrays.append(numpy.frombuffer(mm, dtype='<i8' if typecode == 'q' else '<f8', count=length,
+                                           offset=offset))
+        elif NATIVE_LAYOUT:
+            arrays.append(memoryview(mm)[offset:offset + 8 * length].cast(typecode))
+        else:
+            data = array(typecode, mm[offset:offset + 8 * length])
+            data.byteswap()
+            arrays.append(data)
+        offset += 8 * length
+    if numpy is not None:
+        arrays[3] = arrays[3].reshape(count, JOINTS, 3)
+    return JointSeries(file_id, arm, arrays[0], arrays[1], arrays[2], arrays[3], mm)
+
+
+def openDirectory(directory):
+    # {(file id, arm): JointSeries} of every series file in directory
+    series = {}
+    for path in sorted(glob.glob(os.path.join(directory, "*" + SERIES_EXTENSION))):
+        s = openSeries(path)
+        series[(s.file_id, s.arm)] = s
+    return series
+
+
+def jointValues(values, cols):
+    return [values[i] if i < len(values) else NAN for i in cols]
+
+
+class JointSeriesBuilder:
+    # Collects the samples of one series in typed arrays
+
+    def __init__(self, file_id, arm):
+        self.file_id = file_id
+        self.arm = arm
+        self.timestamps = array('d')
+        self.ros_times = array('d')
+        self.frames = array('q')
+        self.values = array('d')
+
+    def add(self, timestamp, ros_time, frame, positions, velocities, efforts):
+        # positions, velocities and efforts are in db_schema.JOINT_NAMES order
+        self.timestamps.append(timestamp)
+        self.ros_times.append(ros_time)
+        self.frames.append(frame)
+        for joint in range(JOINTS):
+            self.values.extend((positions[joint], velocities[joint], efforts[joint]))
+
+    def addMessage(self, timestamp, frame, msg):
+        # Add a ros_msg_dissector.JointStateMsg. Returns False if the message
+        # lacks one of the joints. Joints beyond the end of a short position,
+        # velocity or effort array are NaN.
+        idx = dict((name, i) for i, name in enumerate(msg.joint_names))
+        try:
+            cols = [idx[name] for name in db_schema.JOINT_NAMES]
+        except KeyError:
+            return False
+        self.add(timestamp, msg.ros_time, frame, jointValues(msg.positions, cols),
+                 jointValues(msg.velocities, cols), jointValues(msg.efforts, cols))
+        return True
+
+    def addRow(self, timestamp, ros_time, frame, values):
+        # A row of JOINT_SERIES_COLUMNS values, NULLs (None) becoming NaN
+        self.add(timestamp, ros_time, frame,
+                 *[[NAN if v is None else v for v in values[k * JOINTS:(k + 1) * JOINTS]] for k in range(3)])
+
+    def addSeries(self, series, lastFrame=None):
+        # Copy the samples of another series, up to lastFrame if given
+        for i in range(len(series)):
+            frame = int(series.frames[i])
+            if lastFrame is not None and frame > lastFrame:
+                continue
+            self.add(float(series.timestamps[i]), float(series.ros_times[i]), frame,
+                     *[[series.value(i, joint, field) for joint in range(JOINTS)] for field in range(3)])
+
+    def sortSamples(self):
+        # Sort the samples by capture time (and frame for equal times)
+        n = len(self.timestamps)
+        order = sorted(range(n), key=lambda i: (self.timestamps[i], self.frames[i]))
+        if order != list(range(n)):
+            self.timestamps = array('d', (self.timestamps[i] for i in order))
+            self.ros_times = array('d', (self.ros_times[i] for i in order))
+            self.frames = array('q', (self.frames[i] for i in order))
+            values = array('d')
+            for i in order:
+                values.extend(self.values[i * JOINTS * 3:(i + 1) * JOINTS * 3])
+            self.values = values
+
+    def build(self):
+        # The JointSeries of the samples, sorted by capture time (and frame
+        # for equal times)
+        self.sortSamples()
+        n = len(self.timestamps)
+        if numpy is not None:
+            return JointSeries(self.file_id, self.arm, numpy.frombuffer(self.timestamps),
+                               numpy.frombuffer(self.ros_times), numpy.frombuffer(self.frames, dtype='i8'),
+                               numpy.frombuffer(self.values).reshape(n, JOINTS, 3))
+        return JointSeries(self.file_id, self.arm, self.timestamps, self.ros_times, self.frames, self.values)
+
+
+def readSamples(spool, first, count):
+    # The SAMPLE_RECORDs first to first + count - 1 of a spool file
+    done = 0
+    while done < count:
+        n = min(SPOOL_BLOCK, count - done)
+        spool.seek((first + done) * SAMPLE_RECORD.size)
+        for record in SAMPLE_RECORD.iter_unpack(spool.read(n * SAMPLE_RECORD.size)):
+            yield record
+        done += n
+
+
+def columnBytes(block, column):
+    # One array of the series file (0 timestamps, 1 ROS times, 2 frames,
+    # 3 values) from a block of spooled SAMPLE_RECORDs, little endian
+    if numpy is not None:
+        records = numpy.frombuffer(block, dtype=[('timestamp', '<f8'), ('ros_time', '<f8'), ('frame', '<i8'),
+                                                 ('values', '<f8', (JOINTS * 3,))])
+        return records[records.dtype.names[column]].tobytes()
+    records = SAMPLE_RECORD.iter_unpack(block)
+    if column == 3:
+        data = [value for record in records for value in record[3:]]
+    else:
+        data = [record[column] for record in records]
+    return Struct('<' + str(len(data)) + ('q' if column == 2 else 'd')).pack(*data)
+
+
+class JointSeriesWriter(JointSeriesBuilder):
+    # Writes one series file without holding the whole series in memory.
+    # Every chunk_size samples, the collected samples are sorted and
+    # appended to a spool file next to the series file. close() merges the
+    # sorted chunks if they overlap in time, then writes the arrays of the
+    # series file from the spool file a block at a time.
+
+    def __init__(self, path, file_id, arm, chunk_size=SERIES_CHUNK_SIZE):
+        JointSeriesBuilder.__init__(self, file_id, arm)
+        self.path = path
+        self.chunk_size = chunk_size
+        self.spool = open(path + ".spool", 'w+b')
+        self.chunks = []
+        self.samples = 0
+        self.lastKey = None
+        self.ordered = True
+
+    def add(self, timestamp, ros_time, frame, positions, velocities, efforts):
+        JointSeriesBuilder.add(self, timestamp, ros_time, frame, positions, velocities, efforts)
+        if len(self.timestamps) >= self.chunk_size:
+            self.flushChunk()
+
+    def flushChunk(self):
+        # Append the collected samples to the spool file, sorted
+        n = len(self.timestamps)
+        if not n:
+            return
+        self.sortSamples()
+        if self.lastKey is not None and (self.timestamps[0], self.frames[0]) < self.lastKey:
+            self.ordered = False
+        self.lastKey = (self.timestamps[n - 1], self.frames[n - 1])
+        width = JOINTS * 3
+        self.spool.seek(0, os.SEEK_END)
+        self.spool.write(b''.join(SAMPLE_RECORD.pack(self.timestamps[i], self.ros_times[i], self.frames[i],
+                                                     *self.values[i * width:(i + 1) * width]) for i in range(n)))
+        self.chunks.append((self.samples, n))
+        self.samples += n
+        self.timestamps = array('d')
+        self.ros_times = array('d')
+        self.frames = array('q')
+        self.values = array('d')
+
+    def mergeChunks(self):
+        # Replace the spool file with one holding the samples of all chunks
+        # in order
+        merged = open(self.path + ".merge", 'w+b')
+        chunks = [readSamples(self.spool, first, count) for first, count in self.chunks]
+        for record in heapq.merge(*chunks, key=lambda record: (record[0], record[2])):
+            merged.write(SAMPLE_RECORD.pack(*record))
+        self.spool.close()
+        os.replace(self.path + ".merge", self.path + ".spool")
+        self.spool = merged
+
+    def close(self):
+        # Write the series file. Returns the number of samples.
+        self.flushChunk()
+        if not self.ordered:
+            self.mergeChunks()
+        with open(self.path + ".tmp", 'wb') as f:
+            f.write(SERIES_HEADER.pack(SERIES_MAGIC, SERIES_VERSION, JOINTS, self.file_id, self.arm, self.samples))
+            for column in range(4):
+                self.spool.seek(0)
+                while True:
+                    block = self.spool.read(SPOOL_BLOCK * SAMPLE_RECORD.size)
+                    if not block:
+                        break
+                    f.write(columnBytes(block, column))
+        self.spool.close()
+        os.remove(self.path + ".spool")
+        os.replace(self.path + ".tmp", self.path)
+        return self.samples
+
+
+def iterStoredSamples(conn, file_id, lastFrame=None):
+    # (timestamp, ROS time, frame, arm, JOINT_SERIES_COLUMNS values...) of
+    # the JointStates of a capture, up to lastFrame if given, from the DB. A
+    # typed row is stored once per packet fingerprint, under the first
+    # capture point that saw the packet, so the packets of the capture are
+    # matched to the rows by fingerprint.
+    query = '''SELECT p.shark_timestamp, j.ros_time, p.shark_frame_num, j.ros_arm_num, ''' + \
+            ', '.join('j.' + column for column in JOINT_SERIES_COLUMNS) + ''' \
+            FROM packets p JOIN packets q ON q.fingerprint = p.fingerprint \
+            JOIN ros_JointStateMessages j ON j.parent_id = q.id \
+            WHERE p.shark_file_id = ? AND j.ros_arm_num IS NOT NULL'''
+    params = (file_id,)
+    if lastFrame is not None:
+        query += ''' AND p.shark_frame_num <= ?'''
+        params += (lastFrame,)
+    return conn.execute(query + ''' ORDER BY p.shark_frame_num, j.id''', params)
+
+
+def writeStoredSeries(conn, directory, file_id):
+    # Write the series of a capture from its rows in the DB, e.g. of one
+    # ingested by parallel_ingest.py workers. Returns the number of samples.
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    writers = {}
+    for row in iterStoredSamples(conn, file_id):
+        writer = writers.get(row[3])
+        if writer is None:
+            writer = writers[row[3]] = JointSeriesWriter(seriesPath(directory, file_id, row[3]), file_id, row[3])
+        writer.addRow(row[0], row[1], row[2], row[4:])
+    return sum(writer.close() for arm, writer in sorted(writers.items()))
+
+
+class JointSeriesSink(pipeline.Sink):
+    # Builds the series of every capture from the dissected JointState
+    # messages with a JointSeriesWriter per arm, so they are spooled to disk
+    # as the capture is read, and writes them when it is done. Put it
+    # after a SqliteSink so the series get the file numbers of the DB. A
+    # resumed capture keeps the samples of its earlier run up to the frame
+    # the ingest resumes after: given the connection of the DB, they are
+    # rebuilt from the committed ros_JointStateMessages rows (the series
+    # file is only written when a capture is done), otherwise they are taken
+    # from the series file of a completed earlier run, if there is one.
+
+    def __init__(self, directory, conn=None):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.conn = conn
+        self.builders = {}
+        self.file_id = None
+        self.nextFileId = 1
+        self.samples = 0
+
+    def beginFile(self, stats):
+        if stats.file_id is None:
+            stats.file_id = self.nextFileId
+        self.nextFileId = max(self.nextFileId, stats.file_id + 1)
+        self.file_id = stats.file_id
+        self.builders = {}
+        if not stats.resumeAfter:
+            return
+        if self.conn is not None:
+            self.addStoredSamples(stats.resumeAfter)
+            return
+        for arm in (1, 2):
+            path = seriesPath(self.directory, self.file_id, arm)
+            if os.path.exists(path):
+                series = openSeries(path)
+                self.builder(arm).addSeries(series, stats.resumeAfter)
+                series.close()
+
+    def addStoredSamples(self, lastFrame):
+        # The samples of the capture's frames up to lastFrame, from the DB
+        for row in iterStoredSamples(self.conn, self.file_id, lastFrame):
+            self.builder(row[3]).addRow(row[0], row[1], row[2], row[4:])
+
+    def builder(self, arm):
+        builder = self.builders.get(arm)
+        if builder is None:
+            builder = self.builders[arm] = JointSeriesWriter(seriesPath(self.directory, self.file_id, arm),
+                                                             self.file_id, arm)
+        return builder
+
+    def write(self, item):
+        if not item.messages:
+            return
+        for msg in item.messages:
+            if msg.ros_msg_type == "JointStateMsg" and msg.ros_arm_num is not None:
+                if self.builder(msg.ros_arm_num).addMessage(item.packet.timestamp, item.packet.number, msg):
+                    self.samples += 1
+
+    def endFile(self, stats):
+        for arm, builder in sorted(self.builders.items()):
+            builder.close()
+        self.builders = {}
+
+
+def main(argv):
+    if len(argv) < 3:
+        print ("Usage: python joint_series.py <directory> <capture.pcap> ...")
+        return
+    sink = JointSeriesSink(argv[1])
+    for stats in pipeline.run(argv[2:], [sink], reassemble=True):
+        print ("File " + str(stats.file_id) + ": " + str(stats.filename))
+    print (str(sink.samples) + " JointState samples written to \"" + argv[1] + "\"")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,213 @@
+#
+# Author:       Timothy Zimmerman (timothy.zimmerman@nist.gov)
+# Organization: National Institute of Standards and Technology
+#               U.S. Department of Commerce
+# License:      Public Domain
+#
+# Description:  Live ingest of a capture that is still being written, so the
+#               arms can be watched while they operate. Frames are read from
+#               a growing PCAP file (tail-follow) or from a pipe, e.g.
+#
+#                   tcpdump -i eth0 -U -w - | python live_ingest.py - live.db
+#                   python live_ingest.py robot1.pcap live.db
+#
+#               and go through the same prefilter, dissector and batch writer
+#               as pcap_to_db.py. Batches are small and flushed on a short
+#               interval, also while no packets arrive, and only one batch is
+#               held in memory. The writer and the payload store keep a window
+#               of recent packet fingerprints and look older ones up in the
+#               DB, and the reader's TCP handshake tracker forgets unanswered
+#               SYNs and old connections (pcap_reader.STREAM_*), so memory
+#               stays bounded however long the capture runs.
+#               The latency from the capture timestamp of a packet to the
+#               commit of its row is reported periodically.
+#
+#               replay_capture.py feeds a recorded capture to this script at
+#               real-time or accelerated speed.
+#
+
+import os
+import sys
+import time
+from collections import deque
+import db_schema
+import db_writer
+import dissect_cache
+import ingest
+import payload_store
+import pcap_filter
+import pcap_reader
+import tcp_reassembly
+
+# Small batches keep the latency down
+LIVE_BATCH_SIZE = 100
+LIVE_FLUSH_INTERVAL = 0.25
+
+# Seconds between reads of a stream with no new data
+POLL_INTERVAL = 0.05
+
+# Stop after this many seconds without new data, or None to run until the
+# pipe is closed (or forever when following a file)
+IDLE_TIMEOUT = None
+
+# Seconds between latency reports
+REPORT_INTERVAL = 5.0
+
+# Number of recent latencies kept for the percentiles
+LATENCY_SAMPLES = 10000
+
+# Put ROS messages split over several TCP segments back together
+REASSEMBLE_TCP = True
+
+# Payloads whose dissected messages are kept, 0 for no cache
+DISSECTION_CACHE_SIZE = dissect_cache.DEFAULT_MAX_ENTRIES
+
+# Keep the payloads in a store file next to the DB, see payload_store.py. It
+# is flushed before every commit, so readers of the DB find the payloads of
+# the rows they see.
+PAYLOAD_STORE = True
+
+# Packet fingerprints the writer and the payload store keep in memory; older
+# ones are looked up by the fingerprint indexes. At least LIVE_BATCH_SIZE.
+FINGERPRINT_WINDOW = 65536
+
+
+class LatencyStats:
+    # Capture-to-commit latency of the packets written so far. Percentiles
+    # are taken over the most recent samples only, so memory stays bounded.
+
+    def __init__(self, samples=LATENCY_SAMPLES):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=samples)
+
+    def add(self, latency):
+        self.count += 1
+        self.total += latency
+        if latency > self.max:
+            self.max = latency
+        self.recent.append(latency)
+
+    def percentile(self, p):
+        if not self.recent:
+            return 0.0
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(p / 100.0 * len(ordered)))]
+
+    def summary(self):
+        mean = self.total / self.count if self.count else 0.0
+        return ("Latency over " + str(self.count) + " packets: mean {0:.1f} ms, p50 {1:.1f} ms, " \
+                "p95 {2:.1f} ms, p99 {3:.1f} ms, max {4:.1f} ms").format(
+                    mean * 1000, self.percentile(50) * 1000, self.percentile(95) * 1000,
+                    self.percentile(99) * 1000, self.max * 1000)
+
+
+def ingestStream(writer, stream, pcap_filenumber, rules=None, follow=False, poll_interval=POLL_INTERVAL,
+                 idle_timeout=IDLE_TIMEOUT, report_interval=REPORT_INTERVAL, report=print,
+                 reassemble=REASSEMBLE_TCP, cache=None):
+    # Returns (FileStats, LatencyStats) once the stream ends or has been idle
+    # for idle_timeout seconds
+    packetFilter = pcap_filter.PacketFilter(rules, reassemble)
+    capture = pcap_reader.PcapStream(stream, packetFilter, follow=follow, poll_interval=poll_interval)
+    stats = ingest.FileStats(capture.name, pcap_filenumber)
+    latency = LatencyStats()
+    start = time.monotonic()
+    lastData = lastReport = start
+    writer.resetStats()
+
+    # Capture timestamps of the packets waiting in the writer's buffer
+    pending = []
+    reassembler = tcp_reassembly.StreamReassembler(cache=cache) if reassemble else None
+
+    for packet in capture:
+        now = time.monotonic()
+        if packet is not None:
+            lastData = now
+            if reassembler is not None:
+                packetData = reassembler.feed(capture.unpack_header, packet)
+            else:
+                packetData = ingest.dissectFrame(capture.unpack_header, packet, cache)
+            ingest.countFrame(stats, packet, packetData)
+            ingest.storeFrame(writer, packet, pcap_filenumber, ingest.fingerprint(packet), packetData)
+            pending.append(packet.timestamp)
+        elif idle_timeout is not None and now - lastData >= idle_timeout:
+            break
+
+        flushes = writer.flushes
+        writer.maybeFlush()
+        if writer.flushes != flushes:
+            committed = time.time()
+            for timestamp in pending:
+                latency.add(committed - timestamp)
+            pending = []
+
+        if report is not None and now - lastReport >= report_interval:
+            lastReport = now
+            report(str(stats.detectedPackets) + " packets, " + str(stats.dissectedPackets) + " dissected. " + \
+                   latency.summary())
+
+    writer.flush()
+    committed = time.time()
+    for timestamp in pending:
+        latency.add(committed - timestamp)
+    stats.elapsed = time.monotonic() - start
+    stats.filterSummary = packetFilter.summary()
+    if reassembler is not None:
+        reassembler.close()
+        stats.reassemblySummary = reassembler.summary()
+    stats.writerSummary = writer.summary()
+    return stats, latency
+
+
+def openStream(source):
+    # "-" is standard input, made non-blocking so the batches are flushed
+    # while tcpdump has nothing to write
+    if source == "-":
+        stream = sys.stdin.buffer
+        os.set_blocking(stream.fileno(), False)
+        return stream, False
+    return open(source, 'rb'), True
+
+
+def main(argv):
+    if len(argv) < 2:
+        print ("Usage: python live_ingest.py <capture.pcap | -> [database]")
+        return
+    source = argv[1]
+    db_filename = argv[2] if len(argv) > 2 else "live.db"
+
+    conn = ingest.createDatabase(db_filename)
+    db_schema.beginLiveIngest(conn)
+    db_schema.createIndexes(conn.cursor())
+    conn.commit()
+
+    stream, follow = openStream(source)
+    pcap_filenumber = ingest.registerFile(conn.cursor(), source)
+    print ("[LIVE]: \"" + str(source) + "\" into \"" + db_filename + "\", file number " + str(pcap_filenumber))
+    payloads = payload_store.PayloadStore(payload_store.storePath(db_filename), window=FINGERPRINT_WINDOW) \
+        if PAYLOAD_STORE else None
+    writer = db_writer.BatchWriter(conn, LIVE_BATCH_SIZE, LIVE_FLUSH_INTERVAL, payloads, FINGERPRINT_WINDOW)
+    cache = dissect_cache.DissectionCache(DISSECTION_CACHE_SIZE) if DISSECTION_CACHE_SIZE > 0 else None
+    try:
+        stats, latency = ingestStream(writer, stream, pcap_filenumber, follow=follow, cache=cache)
+    except KeyboardInterrupt:
+        writer.flush()
+        print ("\nStopped")
+    else:
+        ingest.completeFile(conn.cursor(), pcap_filenumber)
+        conn.commit()
+        for line in stats.report():
+            print(line)
+        print(latency.summary())
+        if cache is not None:
+            print(cache.summary())
+    finally:
+        stream.close()
+        conn.close()
+        if payloads is not None:
+            payloads.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,113 @@
+#
+# Author:       Timothy Zimmerman (timothy.zimmerman@nist.gov)
+# Organization: National Institute of Standards and Technology
+#               U.S. Department of Commerce
+# License:      Public Domain
+#
+# Description:  Brings a unified DB written by an older pcap_to_db.py up to
+#               the current schema: adds the missing columns and computes the
+#               packet fingerprints from the stored headers and payloads, so
+#               analyze.py matches the packets by fingerprint instead of by
+#               md5_hash. The md5_hash values are kept.
+#
+#               The payload BLOBs are then moved into a payload store next to
+#               the DB (see payload_store.py), one copy per fingerprint, and
+#               the DB is vacuumed. The sizes before and after are reported.
+#               With --keep-payloads the BLOBs stay in the DB.
+#
+#               Usage: python migrate_db.py [--keep-payloads] <database>
+#
+
+import os
+import sqlite3
+import sys
+import db_schema
+import ingest
+import payload_store
+
+# Packets whose payloads are moved per query
+MOVE_BATCH_SIZE = 10000
+
+
+def fileSize(path):
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def movePayloads(conn, payloads, batch_size=MOVE_BATCH_SIZE):
+    # Move the payload BLOBs of every table into the store and return the
+    # number of packets moved. The rosPackets and unclassifiedROSMessages
+    # rows hold the payload of their parent packet and get its offset. The
+    # caller flushes the store and commits.
+    c = conn.cursor()
+    lastId = 0
+    count = 0
+    while True:
+        rows = c.execute('''SELECT id, fingerprint, shark_data FROM packets \
+                            WHERE shark_data IS NOT NULL AND id > ? ORDER BY id LIMIT ?''',
+                         (lastId, batch_size)).fetchall()
+        if not rows:
+            break
+        c.executemany('''UPDATE packets SET payload_offset = ?, shark_data = NULL WHERE id = ?''',
+                      [(payloads.add(packet_fingerprint, data), packet_id) for packet_id, packet_fingerprint, data in rows])
+        lastId = rows[-1][0]
+        count += len(rows)
+    c.execute('''UPDATE rosPackets SET payload_offset = (SELECT payload_offset FROM packets \
+                 WHERE packets.id = rosPackets.parent_id), shark_data = NULL WHERE shark_data IS NOT NULL''')
+    c.execute('''UPDATE unclassifiedROSMessages SET payload_offset = (SELECT payload_offset FROM packets \
+                 WHERE packets.id = unclassifiedROSMessages.parent_id), payload_len = length(packet_data), \
+                 packet_data = NULL WHERE packet_data IS NOT NULL''')
+    return count
+
+
+def migrate(db_filename, move_payloads=True):
+    # Returns (packets that got a fingerprint, packets whose payload was
+    # moved to the store)
+    conn = sqlite3.connect(db_filename)
+    payloads = None
+    moved = 0
+    try:
+        c = conn.cursor()
+        c.execute('''BEGIN''')
+        db_schema.upgradeIngestTables(c)
+        # The fingerprints are computed from the BLOBs, so before they move
+        packets = ingest.backfillFingerprints(conn)
+        db_schema.createAnalysisTables(c)
+        db_schema.createIndexes(c)
+        if move_payloads:
+            payloads = payload_store.PayloadStore(payload_store.storePath(db_filename))
+            payloads.loadIndex(conn)
+            moved = movePayloads(conn, payloads)
+            payloads.sync()
+        conn.commit()
+        if moved:
+            # Give the space of the BLOBs back to the file system
+            c.execute('''VACUUM''')
+    finally:
+        conn.close()
+        if payloads is not None:
+            payloads.close()
+    return packets, moved
+
+
+def main(argv):
+    args = [arg for arg in argv[1:] if arg != "--keep-payloads"]
+    if len(args) < 1:
+        print ("Usage: python migrate_db.py [--keep-payloads] <database>")
+        return
+    db_filename = args[0]
+    store_path = payload_store.storePath(db_filename)
+    before = fileSize(db_filename) + fileSize(store_path)
+    print ("Migrating \"" + db_filename + "\"...", end='')
+    packets, moved = migrate(db_filename, "--keep-payloads" not in argv)
+    print (" [DONE] " + str(packets) + " packets fingerprinted")
+    if moved:
+        after = fileSize(db_filename) + fileSize(store_path)
+        print ("Payloads of " + str(moved) + " packets moved to \"" + store_path + "\"")
+        print ("Size: {0:.2f} MB before, {1:.2f} MB after ({2:.2f} MB DB + {3:.2f} MB payload store), ".format(
+            before / 1e6, after / 1e6, fileSize(db_filename) / 1e6, fileSize(store_path) / 1e6) + \
+            "{0:.2f} MB saved ({1:.0f}%)".format((before - after) / 1e6,
+                                                 (before - after) / before * 100 if before else 0))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
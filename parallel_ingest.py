@@ -0,0 +1,311 @@
+#
+# Author:       Timothy Zimmerman (timothy.zimmerman@nist.gov)
+# Organization: National Institute of Standards and Technology
+#               U.S. Department of Commerce
+# License:      Public Domain
+#
+# Description:  Parallel ingest of several PCAP files. Each capture is
+#               independent until the packet matching in analyze.py, so a process
+#               pool parses and dissects the files at the same time, each
+#               worker writing to its own shard database. The parent process
+#               is the only writer of the unified DB: it merges the shards in
+#               file order, giving every shard a new pcapFiles id and shifting
+#               its packet ids past the ones already in the unified DB. Typed
+#               message rows are only kept for packets the unified DB has not
+#               seen yet, as in a sequential run.
+#
+#               A single large capture can also be split into chunks of
+#               roughly equal byte size that are dissected by the pool and
+#               stitched back together in frame order (ingestFileChunked).
+#
+#               Every job has its own dissection cache (cache_size entries,
+#               0 for none); only its hit/miss/eviction counters are sent
+#               back to the parent. The same goes for the dissector timings
+#               when the instrumentation is on (time_dissectors).
+#
+
+import os
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import db_schema
+import db_writer
+import dissect_cache
+import ingest
+import instrumentation
+import pcap_filter
+import pcap_reader
+import pipeline
+import tcp_reassembly
+
+# Default size of a chunk in ingestFileChunked
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+class ShardJob:
+
+    def __init__(self, filename, shard_path, backend, rules, batch_size, flush_interval, reassemble=False,
+                 cache_size=0, time_dissectors=False):
+        self.filename = filename
+        self.shard_path = shard_path
+        self.backend = backend
+        self.rules = rules
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.reassemble = reassemble
+        self.cache_size = cache_size
+        self.time_dissectors = time_dissectors
+
+
+def newCache(cache_size):
+    return dissect_cache.DissectionCache(cache_size) if cache_size > 0 else None
+
+
+def newDissectorTimer(time_dissectors):
+    # A worker forked from an instrumented parent inherits its wrappers, so
+    # they are always replaced by ones with counters of their own
+    if not time_dissectors:
+        return None
+    timer = instrumentation.DissectorTimer()
+    timer.install()
+    return timer
+
+
+def ingestShard(job):
+    # Runs in a worker process. Returns the FileStats for the capture, with
+    # the pid of the worker so throughput can be reported per worker, and
+    # the emptied dissection cache (or None) for its counters.
+    timer = newDissectorTimer(job.time_dissectors)
+    conn = ingest.createDatabase(job.shard_path)
+    db_schema.beginBulkLoad(conn)
+    try:
+        file_id = ingest.registerFile(conn.cursor(), job.filename, fingerprint=ingest.fileFingerprint(job.filename))
+        writer = db_writer.BatchWriter(conn, job.batch_size, job.flush_interval)
+        cache = newCache(job.cache_size)
+        stats = pipeline.ingestFile(writer, job.filename, file_id, job.backend, job.rules,
+                                    reassemble=job.reassemble, cache=cache)
+    finally:
+        conn.close()
+        if timer is not None:
+            timer.uninstall()
+    if cache is not None:
+        cache.clear()
+    stats.worker = os.getpid()
+    stats.dissectionCache = cache
+    if timer is not None:
+        stats.dissectorCounters = timer.counters
+    return stats
+
+
+def copyRows(c, table, columns, replacements, params, where=''''''):
+    # INSERT INTO main.<table> SELECT ... FROM shard.<table>, with some
+    # columns replaced by SQL expressions
+    select = [replacements.get(col, col) for col in columns]
+    c.execute('''INSERT INTO main.''' + table + ''' (''' + ', '.join(columns) + ''') SELECT ''' + \
+              ', '.join(select) + ''' FROM shard.''' + table + where + ''' ORDER BY id''', params)
+
+
+def mergeShard(conn, shard_path, filename, payloads=None):
+    # Append one shard to the unified DB and return the new file number. The
+    # shards keep their payloads as BLOBs; with a payload_store.PayloadStore
+    # they are moved into the store as the rows are copied.
+    conn.commit()
+    c = conn.cursor()
+    c.execute('''ATTACH DATABASE ? AS shard''', (shard_path,))
+    try:
+        row = c.execute('''SELECT machinename, file_size, file_mtime, header_hash, last_frame \
+                           FROM shard.pcapFiles''').fetchone()
+        file_id = ingest.registerFile(c, filename, row[0], row[1:4])
+        c.execute('''UPDATE main.pcapFiles SET last_frame = ? WHERE id = ?''', (row[4], file_id))
+        ingest.completeFile(c, file_id)
+        offset = c.execute('''SELECT IFNULL(MAX(id), 0) FROM main.packets''').fetchone()[0]
+
+        # Typed rows first, while main.rosPackets only holds earlier files
+        for table, columns in db_schema.TYPED_TABLES:
+            copyRows(c, table, columns[1:], {'parent_id': 'parent_id + :offset'}, {'offset': offset},
+                     ''' WHERE parent_id IN (SELECT id FROM shard.packets WHERE fingerprint NOT IN \
+                         (SELECT fingerprint FROM main.rosPackets WHERE fingerprint IS NOT NULL))''')
+        packetReplacements = {'id': 'id + :offset', 'shark_file_id': ':file_id'}
+        rosReplacements = {'parent_id': 'parent_id + :offset'}
+        unclassifiedReplacements = {'parent_id': 'parent_id + :offset'}
+        if payloads is not None:
+            payloads.registerFunctions(conn)
+            packetReplacements.update({'shark_data': 'NULL',
+                                       'payload_offset': 'storePayload(fingerprint, shark_data)'})
+            rosReplacements.update({'shark_data': 'NULL',
+                                    'payload_offset': 'storePayload(fingerprint, shark_data)'})
+            unclassifiedReplacements.update({
+                'packet_data': 'NULL',
+                'payload_offset': '''storePayload((SELECT fingerprint FROM shard.packets \
+                                     WHERE shard.packets.id = parent_id), packet_data)''',
+                'payload_len': 'length(packet_data)'})
+        copyRows(c, 'packets', db_schema.PACKETS_COLUMNS, packetReplacements,
+                 {'offset': offset, 'file_id': file_id})
+        copyRows(c, 'rosPackets', db_schema.ROS_PACKETS_COLUMNS[1:], rosReplacements, {'offset': offset})
+        copyRows(c, 'unclassifiedROSMessages', db_schema.UNCLASSIFIED_COLUMNS[1:], unclassifiedReplacements,
+                 {'offset': offset})
+        if payloads is not None:
+            payloads.flush()
+        conn.commit()
+    finally:
+        c.execute('''DETACH DATABASE shard''')
+    return file_id
+
+
+def ingestParallel(conn, filenames, workers, backend="native", rules=None,
+                   batch_size=db_writer.DEFAULT_BATCH_SIZE,
+                   flush_interval=db_writer.DEFAULT_FLUSH_INTERVAL, shard_dir=None, reassemble=False,
+                   cache_size=0, time_dissectors=False, payloads=None):
+    # Returns the FileStats of every file, in the order of filenames. Their
+    # writeTime includes merging the shard into the unified DB. payloads is
+    # the payload_store.PayloadStore of the unified DB, if it has one.
+    shard_dir = tempfile.mkdtemp(prefix="shards_", dir=shard_dir or ".")
+    jobs = [ShardJob(filename, os.path.join(shard_dir, "shard_" + str(n) + ".db"),
+                     backend, rules, batch_size, flush_interval, reassemble, cache_size, time_dissectors)
+            for n, filename in enumerate(filenames)]
+
+    allStats = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(ingestShard, job) for job in jobs]
+        # Merge in file order so the ids match a sequential run
+        for job, future in zip(jobs, futures):
+            stats = future.result()
+            mergeStart = time.monotonic()
+            stats.file_id = mergeShard(conn, job.shard_path, job.filename, payloads)
+            stats.writeTime += time.monotonic() - mergeStart
+            os.remove(job.shard_path)
+            allStats.append(stats)
+    os.rmdir(shard_dir)
+    return allStats
+
+
+class ChunkJob:
+
+    def __init__(self, filename, start, stop, firstFrame, unpack_header, rules, tracker, reassemble=False,
+                 cache_size=0, time_dissectors=False):
+        self.filename = filename
+        self.start = start
+        self.stop = stop
+        self.firstFrame = firstFrame
+        self.unpack_header = unpack_header
+        self.rules = rules
+        self.tracker = tracker
+        self.reassemble = reassemble
+        self.cache_size = cache_size
+        self.time_dissectors = time_dissectors
+
+
+def dissectChunk(job):
+    # Runs in a worker process. Returns ([(frame, fingerprint, messages), ...],
+    # accepted count, rejected counts, StreamReassembler or None, emptied
+    # DissectionCache or None, dissector timer counters or None) for the
+    # frames of one chunk. The payloads are
+    # copied out of the memory map so they can be pickled. Reassembly starts
+    # afresh in every chunk, so a message split over the boundary between
+    # two chunks is lost.
+    timer = newDissectorTimer(job.time_dissectors)
+    packetFilter = pcap_filter.PacketFilter(job.rules, job.reassemble)
+    cache = newCache(job.cache_size)
+    reassembler = tcp_reassembly.StreamReassembler(cache=cache) if job.reassemble else None
+    frames = (pipeline.CaptureFrame(job.unpack_header, packet)
+              for packet in pcap_reader.iterFrames(job.filename, packetFilter, job.tracker,
+                                                   job.start, job.stop, job.firstFrame))
+    results = []
+    for item in pipeline.iterRosMessages(pipeline.iterTcpPayloads(frames), reassembler, cache):
+        item.packet.data = bytes(item.packet.data)
+        results.append((item.packet, item.fingerprint, item.messages))
+    if reassembler is not None:
+        reassembler.close()
+        reassembler.cache = None
+    if cache is not None:
+        cache.clear()
+    if timer is not None:
+        timer.uninstall()
+    return results, packetFilter.accepted, packetFilter.rejected, reassembler, cache, \
+           timer.counters if timer is not None else None
+
+
+def ingestFileChunked(writer, filename, pcap_filenumber, pool, workers, chunk_size=DEFAULT_CHUNK_SIZE, rules=None,
+                      resumeAfter=0, reassemble=False, cache=None, time_dissectors=False, sinks=None):
+    # Dissect one capture with the pool and store the frames in frame order.
+    # Frame numbers, timestamps and initial RTTs match a sequential run.
+    # Frames up to resumeAfter are skipped, as in pipeline.runFile. With a
+    # DissectionCache given, every chunk is dissected with a cache of the
+    # same size and the counters are added to it. With time_dissectors set,
+    # the chunks' dissector timings are added up in stats.dissectorCounters.
+    # sinks are the pipeline sinks to write to, by default a SqliteSink of
+    # writer.
+    stats = ingest.FileStats(filename, pcap_filenumber)
+    start = time.monotonic()
+    if sinks is None:
+        sinks = [pipeline.SqliteSink(writer)]
+    stats.resumeAfter = resumeAfter
+    for sink in sinks:
+        sink.beginFile(stats)
+
+    packetFilter = pcap_filter.PacketFilter(rules, reassemble)
+    unpack_header, chunks, tracker = pcap_reader.scanChunks(filename, chunk_size,
+                                                            pcap_filter.PacketFilter(rules, reassemble))
+    tracker.freeze()
+    # Chunks that end before the resume point are not dissected at all
+    chunks = [chunk for n, chunk in enumerate(chunks) if n + 1 == len(chunks) or chunks[n + 1][2] > resumeAfter + 1]
+    cache_size = cache.max_entries if cache is not None else 0
+    jobs = deque(ChunkJob(filename, chunkStart, chunkStop, chunkFirst, unpack_header, rules, tracker, reassemble,
+                          cache_size, time_dissectors)
+                 for chunkStart, chunkStop, chunkFirst in chunks)
+
+    # Keep a couple of chunks per worker in flight so the results waiting to
+    # be written stay bounded
+    pending = deque()
+    reassembly = tcp_reassembly.StreamReassembler() if reassemble else None
+    timer = instrumentation.DissectorTimer() if time_dissectors else None
+    while jobs or pending:
+        while jobs and len(pending) < 2 * workers:
+            pending.append(pool.submit(dissectChunk, jobs.popleft()))
+        results, accepted, rejected, chunkReassembly, chunkCache, chunkTimes = pending.popleft().result()
+        if reassembly is not None:
+            reassembly.addCounters(chunkReassembly)
+        if cache is not None:
+            cache.addCounters(chunkCache)
+        if timer is not None:
+            timer.addCounters(chunkTimes)
+        packetFilter.accepted += accepted
+        for reason, count in rejected.items():
+            packetFilter.rejected[reason] += count
+        for packet, packet_fingerprint, packetData in results:
+            if packet.number <= resumeAfter:
+                continue
+            ingest.countFrame(stats, packet, packetData)
+            item = pipeline.DissectedPacket(unpack_header, packet, packet_fingerprint, packetData)
+            for sink in sinks:
+                sink.write(item)
+
+    for sink in sinks:
+        sink.endFile(stats)
+    stats.elapsed = time.monotonic() - start
+    stats.filterSummary = packetFilter.summary() + " in " + str(len(chunks)) + " chunks"
+    if reassembly is not None:
+        stats.reassemblySummary = reassembly.summary()
+    stats.worker = os.getpid()
+    if timer is not None:
+        stats.dissectorCounters = timer.counters
+    return stats
+
+
+def workerReport(allStats):
+    # One line per worker process: files, packets, payload MB and rates
+    workers = {}
+    for stats in allStats:
+        w = workers.setdefault(stats.worker, [0, 0, 0, 0.0])
+        w[0] += 1
+        w[1] += stats.detectedPackets
+        w[2] += stats.bytes
+        w[3] += stats.elapsed
+    lines = []
+    for pid, (files, packets, nbytes, elapsed) in sorted(workers.items()):
+        rate = packets / elapsed if elapsed > 0 else 0.0
+        mbRate = nbytes / elapsed / 1e6 if elapsed > 0 else 0.0
+        lines.append("Worker " + str(pid) + ": " + str(files) + " files, " + str(packets) + \
+                     " packets in {0:.2f}s ({1:.0f} packets/s, {2:.2f} MB/s)".format(elapsed, rate, mbRate))
+    return lines
@@ -0,0 +1,252 @@
+#
+# Author:       Timothy Zimmerman (timothy.zimmerman@nist.gov)
+# Organization: National Institute of Standards and Technology
+#               U.S. Department of Commerce
+# License:      Public Domain
+#
+# Description:  The analysis stages of ros_analysis.py run on the Parquet files
+#               written by parquet_store.py instead of the unified DB. Each
+#               stage reads the columns it needs (parquet_store.ANALYSIS_COLUMNS)
+#               as Arrow tables, works on whole columns with pyarrow.compute
+#               and numpy, and writes its results to the same directory:
+#
+#                   matchPackets      matchingPackets, misplacedPackets
+#                   markUniqueBrics   the delta column of ros_BricsPositionMessages
+#                   responseTimes     analyze_JointResponseTimes
+#
+#               The rows and their ids are the ones the ros_analysis stages
+#               store in the unified DB.
+#
+#               Requires pyarrow and numpy.
+#
+#               Usage: matches, misplaced = parquet_analysis.matchPackets("parquet")
+#
+
+import os
+import sqlite3
+import db_schema
+import parquet_store
+import ros_analysis
+
+BRICS_JOINTS = tuple(j + '_value' for j in db_schema.JOINT_NAMES[:5])
+# Joint 5 is not compared when looking for the start of a move, see
+# ros_analysis.moveStart
+MOVE_JOINTS = BRICS_JOINTS[:4]
+
+
+def readColumns(directory, table, columns=None):
+    # The analysis columns of <directory>/<table>.parquet, or the columns
+    # given, that the file has (files written before the fingerprint existed
+    # have no such column)
+    import pyarrow.parquet
+
+    path = parquet_store.tablePath(directory, table)
+    available = set(pyarrow.parquet.read_schema(path).names)
+    columns = [column for column in columns or parquet_store.ANALYSIS_COLUMNS[table] if column in available]
+    return pyarrow.parquet.read_table(path, columns=columns)
+
+
+def values(data, column):
+    # One column as a numpy array; NULLs become NaN
+    return data.column(column).to_numpy()
+
+
+def parentTimes(packets, parent_ids):
+    # (shark_timestamp of the parent packet, whether it is in packets) for
+    # every parent_id; rows without a parent are left out of the analysis, as
+    # by the INNER JOINs of ros_analysis
+    import numpy
+    import pyarrow.compute
+
+    index = pyarrow.compute.index_in(parent_ids, value_set=packets.column('id').combine_chunks())
+    found = index.is_valid().to_numpy()
+    times = values(packets, 'shark_timestamp')
+    if not len(times):
+        return numpy.zeros(len(found)), found
+    return times[index.fill_null(0).to_numpy()], found
+
+
+def outputWriter(directory, table):
+    # parquet_store.TableWriter of an analysis table, with the schema of the
+    # unified DB
+    c = sqlite3.connect(":memory:").cursor()
+    db_schema.createAnalysisTables(c)
+    return parquet_store.TableWriter(c, directory, table)
+
+
+def writeTable(directory, table, columns):
+    # Write <directory>/<table>.parquet with the columns after id, numbering
+    # the rows from 1 as the AUTOINCREMENT ids of the unified DB
+    import numpy
+
+    writer = outputWriter(directory, table)
+    try:
+        writer.writeColumns([numpy.arange(1, len(columns[0]) + 1)] + list(columns))
+    finally:
+        writer.close()
+    return writer.rows
+
+
+def matchPackets(directory):
+    # ros_analysis.matchPackets: the sightings of every packet are grouped by
+    # sorting the packets on (key, shark_timestamp, id) and paired as by
+    # ros_analysis.pairSightings. Returns (matches, misplaced).
+    import numpy
+    import pyarrow.compute
+
+    packets = readColumns(directory, 'packets')
+    # Column that identifies the copies of a packet, see ros_analysis.matchKey
+    key = 'md5_hash'
+    if 'fingerprint' in packets.column_names and packets.column('fingerprint').null_count == 0:
+        key = 'fingerprint'
+    # SQLite sorts NULLs first
+    valid = pyarrow.compute.is_valid(packets.column(key))
+    order = pyarrow.compute.sort_indices(packets.append_column('valid', valid),
+                                         sort_keys=[('valid', 'ascending'), (key, 'ascending'),
+                                                    ('shark_timestamp', 'ascending'), ('id', 'ascending')])
+    keys = packets.column(key).take(order)
+    ids = values(packets, 'id')[order]
+    times = values(packets, 'shark_timestamp')[order]
+    files = values(packets, 'shark_file_id')[order]
+    n = len(ids)
+
+    # A group starts where the key changes; the NULL keys are one group
+    origin = numpy.ones(n, dtype=bool)
+    if n > 1:
+        previous = keys.slice(0, n - 1)
+        current = keys.slice(1)
+        changed = pyarrow.compute.fill_null(pyarrow.compute.not_equal(current, previous), True)
+        bothNull = pyarrow.compute.and_(pyarrow.compute.is_null(current), pyarrow.compute.is_null(previous))
+        origin[1:] = pyarrow.compute.and_not(changed, bothNull).to_numpy()
+    group = numpy.cumsum(origin) - 1
+    starts = numpy.flatnonzero(origin)
+    size = numpy.diff(numpy.append(starts, n))[group]
+    originRow = starts[group]
+
+    # The first sighting of every group at every capture point; the origin is
+    # the first at its own
+    byFile = numpy.lexsort((numpy.arange(n), files, group))
+    firstAtFile = numpy.zeros(n, dtype=bool)
+    if n:
+        firstAtFile[byFile] = numpy.concatenate(([True], (group[byFile][1:] != group[byFile][:-1]) |
+                                                         (files[byFile][1:] != files[byFile][:-1])))
+
+    # Two sightings are paired whatever their capture points
+    match = ~origin & (firstAtFile | (size == 2))
+    misplaced = (~origin & ~match) | (origin & (size == 1))
+    time_1 = times[originRow[match]]
+    time_2 = times[match]
+    matches = writeTable(directory, 'matchingPackets', (ids[originRow[match]], ids[match], time_1, time_2,
+                                                         numpy.abs(time_2 - time_1)))
+    return matches, writeTable(directory, 'misplacedPackets', (ids[misplaced],))
+
+
+def markUniqueBrics(directory, arms=(1, 2)):
+    # ros_analysis.markUniqueBrics: ros_BricsPositionMessages.parquet is
+    # rewritten, a row group at a time, with delta = 1 on every message that
+    # commands a new position and delta = 0 on repeats. Returns the number of
+    # unique commands.
+    import numpy
+    import pyarrow
+    import pyarrow.parquet
+
+    table = 'ros_BricsPositionMessages'
+    packets = readColumns(directory, 'packets', ('id', 'shark_timestamp'))
+    brics = readColumns(directory, table)
+    times, found = parentTimes(packets, brics.column('parent_id'))
+    ids = values(brics, 'id')
+    arm = values(brics, 'ros_arm_num')
+    positions = numpy.column_stack([values(brics, column) for column in BRICS_JOINTS])
+    delta = numpy.asarray(values(brics, 'delta'), dtype=numpy.float64)
+    unique = 0
+    for arm_num in arms:
+        rows = numpy.flatnonzero((arm == arm_num) & found)
+        rows = rows[numpy.lexsort((ids[rows], times[rows]))]
+        changed = rows[numpy.asarray(ros_analysis.changeMask(positions[rows]), dtype=bool)]
+        delta[arm == arm_num] = 0
+        delta[changed] = 1
+        unique += len(changed)
+
+    path = parquet_store.tablePath(directory, table)
+    with pyarrow.parquet.ParquetFile(path) as source:
+        schema = source.schema_arrow
+        column = schema.get_field_index('delta')
+        nulls = numpy.isnan(delta)
+        delta = pyarrow.array(numpy.where(nulls, 0, delta).astype(numpy.int64), mask=nulls,
+                              type=schema.field(column).type)
+        writer = pyarrow.parquet.ParquetWriter(path + ".tmp", schema, compression=parquet_store.DEFAULT_COMPRESSION,
+                                               use_dictionary=True)
+        try:
+            offset = 0
+            for batch in source.iter_batches(batch_size=parquet_store.DEFAULT_ROW_GROUP_SIZE):
+                columns = batch.columns
+                columns[column] = delta.slice(offset, batch.num_rows)
+                writer.write_batch(pyarrow.RecordBatch.from_arrays(columns, schema=schema))
+                offset += batch.num_rows
+        finally:
+            writer.close()
+    os.replace(path + ".tmp", path)
+    return unique
+
+
+def responseTimes(directory, arms=(1, 2), tolerance=ros_analysis.MOVE_TOLERANCE):
+    # ros_analysis.responseTimes: the joint states of every arm are split into
+    # the windows between its unique Brics commands with searchsorted, and the
+    # first row of every window that moved away from the window's first row
+    # is the start of the move. Returns the number of rows.
+    import numpy
+
+    packets = readColumns(directory, 'packets', ('id', 'shark_timestamp'))
+    brics = readColumns(directory, 'ros_BricsPositionMessages')
+    bricsTimes, bricsFound = parentTimes(packets, brics.column('parent_id'))
+    bricsIds = values(brics, 'id')
+    bricsParents = values(brics, 'parent_id')
+    bricsArm = values(brics, 'ros_arm_num')
+    bricsDelta = values(brics, 'delta')
+
+    joints = readColumns(directory, 'ros_JointStateMessages')
+    jointTimes, jointFound = parentTimes(packets, joints.column('parent_id'))
+    jointIds = values(joints, 'id')
+    jointParents = values(joints, 'parent_id')
+    jointArm = values(joints, 'ros_arm_num')
+    positions = numpy.column_stack([values(joints, column) for column in MOVE_JOINTS])
+    # Joint states with NULL positions are left out
+    jointFound &= ~numpy.isnan(positions).any(axis=1)
+
+    brics_ids = []
+    joint_state_ids = []
+    delays = []
+    for arm_num in arms:
+        commands = numpy.flatnonzero((bricsArm == arm_num) & (bricsDelta == 1) & bricsFound)
+        commands = commands[numpy.lexsort((bricsIds[commands], bricsParents[commands]))]
+        commandIds = numpy.unique(bricsParents[commands])
+
+        # The window of a joint state is the last command before it; the ones
+        # in the same packet as a command or after the last command have none
+        rows = numpy.flatnonzero((jointArm == arm_num) & jointFound)
+        rows = rows[numpy.lexsort((jointIds[rows], jointParents[rows]))]
+        window = numpy.searchsorted(commandIds, jointParents[rows], 'right') - 1
+        inWindow = (window >= 0) & (window < len(commandIds) - 1)
+        inWindow[inWindow] = jointParents[rows[inWindow]] != commandIds[window[inWindow]]
+        rows = rows[inWindow]
+        window = window[inWindow]
+
+        first = rows[numpy.searchsorted(window, window, 'left')]
+        moved = (numpy.abs(positions[rows] - positions[first]) > tolerance).any(axis=1)
+        movedWindows, firstMove = numpy.unique(window[moved], return_index=True)
+        moves = rows[moved][firstMove]
+
+        # The commands of one packet share a window
+        commandWindow = numpy.searchsorted(commandIds, bricsParents[commands])
+        index = numpy.searchsorted(movedWindows, commandWindow)
+        hasMove = index < len(movedWindows)
+        hasMove[hasMove] = movedWindows[index[hasMove]] == commandWindow[hasMove]
+        commands = commands[hasMove]
+        moves = moves[index[hasMove]]
+        brics_ids.append(bricsParents[commands])
+        joint_state_ids.append(jointParents[moves])
+        delays.append(numpy.abs(jointTimes[moves] - bricsTimes[commands]))
+
+    return writeTable(directory, 'analyze_JointResponseTimes', (numpy.concatenate(brics_ids),
+                                                                numpy.concatenate(joint_state_ids),
+                                                                numpy.concatenate(delays)))
@@ -0,0 +1,128 @@
+#
+# Author:       Timothy Zimmerman (timothy.zimmerman@nist.gov)
+# Organization: National Institute of Standards and Technology
+#               U.S. Department of Commerce
+# License:      Public Domain
+#
+# Description:  Columnar copies of the unified database as Parquet files, one
+#               file per table, for analysis in pandas without going through
+#               SQLite rows. Strings (MACs, IPs, units) are dictionary encoded
+#               and every column is compressed, so the repeated addresses
+#               and payload BLOBs take a fraction of their size in the DB.
+#
+#               analyze.py can also run from the Parquet files, see
+#               parquet_analysis.py.
+#
+#               Requires pyarrow.
+#
+# Resource(s):  https://arrow.apache.org/docs/python/parquet.html
+#
+
+import os
+import db_schema
+
+# Tables written by pcap_to_db.py
+EXPORT_TABLES = ('packets', 'pcapFiles', 'ros_JointStateMessages', 'ros_BricsPositionMessages',
+                 'ros_BricsGripperMessages', 'ros_DependencyMessages')
+
+# Tables written by the analysis stages. Of ros_BricsPositionMessages only
+# the delta column is written.
+ANALYSIS_OUTPUT_TABLES = ('matchingPackets', 'misplacedPackets', 'ros_BricsPositionMessages',
+                          'analyze_JointResponseTimes')
+
+# Columns read by the analysis stages (see parquet_analysis.py)
+ANALYSIS_COLUMNS = {
+    'packets': ('id', 'fingerprint', 'md5_hash', 'shark_timestamp', 'shark_file_id'),
+    'ros_BricsPositionMessages': ('id', 'parent_id', 'ros_arm_num', 'delta') +
+                                 tuple(j + '_value' for j in db_schema.JOINT_NAMES[:5]),
+    'ros_JointStateMessages': ('id', 'parent_id', 'ros_arm_num') +
+                              tuple(j + '_value' for j in db_schema.JOINT_NAMES[:5]),
+}
+
+# Rows per Parquet row group
+DEFAULT_ROW_GROUP_SIZE = 65536
+DEFAULT_COMPRESSION = "zstd"
+
+
+def tablePath(directory, table):
+    return os.path.join(directory, table + ".parquet")
+
+
+def arrowSchema(c, table):
+    # Arrow schema from the declared SQLite column types
+    import pyarrow
+
+    types = {'INTEGER': pyarrow.int64(), 'BOOLEAN': pyarrow.int64(), 'REAL': pyarrow.float64(),
+             'TEXT': pyarrow.string(), 'BLOB': pyarrow.binary()}
+    fields = []
+    for cid, name, decltype, notnull, default, pk in c.execute('''PRAGMA table_info(''' + table + ''')'''):
+        # Columns declared without a type (matchingPackets.packet_2_time) hold REALs
+        fields.append(pyarrow.field(name, types.get(decltype.upper(), pyarrow.float64())))
+    return pyarrow.schema(fields)
+
+
+class TableWriter:
+    # Appends rows of one table to <directory>/<table>.parquet, a row group
+    # per write, so a table can be written while it is being produced
+
+    def __init__(self, c, directory, table, compression=DEFAULT_COMPRESSION):
+        import pyarrow.parquet
+
+        self.schema = arrowSchema(c, table)
+        self.writer = pyarrow.parquet.ParquetWriter(tablePath(directory, table), self.schema,
+                                                    compression=compression, use_dictionary=True)
+        self.rows = 0
+
+    def write(self, batch, row_group_size=DEFAULT_ROW_GROUP_SIZE):
+        # batch is a list of rows with the columns of the schema, in order
+        if not batch:
+            return
+        self.writeColumns(list(zip(*batch)), row_group_size)
+
+    def writeColumns(self, columns, row_group_size=DEFAULT_ROW_GROUP_SIZE):
+        # columns are arrays (pyarrow or numpy) of the columns of the schema,
+        # in order
+        import pyarrow
+
+        columns = [pyarrow.array(values, type=field.type) for values, field in zip(columns, self.schema)]
+        if not len(columns[0]):
+            return
+        self.writer.write_table(pyarrow.Table.from_arrays(columns, schema=self.schema), row_group_size)
+        self.rows += len(columns[0])
+
+    def close(self):
+        self.writer.close()
+
+
+def exportTable(conn, directory, table, row_group_size=DEFAULT_ROW_GROUP_SIZE, compression=DEFAULT_COMPRESSION,
+                payloads=None):
+    # Stream one table into <directory>/<table>.parquet, a row group at a
+    # time. Returns the number of rows. With the payload_store.PayloadStore
+    # of the DB, the payloads kept in the store are written as shark_data, so
+    # the files do not depend on the store.
+    c = conn.cursor()
+    writer = TableWriter(c, directory, table, compression)
+    columns = list(writer.schema.names)
+    if payloads is not None and 'shark_data' in columns and 'payload_offset' in columns:
+        payloads.registerFunctions(conn)
+        columns[columns.index('shark_data')] = '''IFNULL(shark_data, payloadBlob(payload_offset, shark_data_len))'''
+    c.execute('''SELECT ''' + ', '.join(columns) + ''' FROM ''' + table + ''' ORDER BY id''')
+    try:
+        while True:
+            batch = c.fetchmany(row_group_size)
+            if not batch:
+                break
+            writer.write(batch, row_group_size)
+    finally:
+        writer.close()
+    return writer.rows
+
+
+def exportDatabase(conn, directory, tables=EXPORT_TABLES, row_group_size=DEFAULT_ROW_GROUP_SIZE,
+                   compression=DEFAULT_COMPRESSION, payloads=None):
+    # Returns {table: rows}
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return dict((table, exportTable(conn, directory, table, row_group_size, compression, payloads))
+                for table in tables)
+
@@ -0,0 +1,164 @@
+#
+# Author:       Timothy Zimmerman (timothy.zimmerman@nist.gov)
+# Organization: National Institute of Standards and Technology
+#               U.S. Department of Commerce
+# License:      Public Domain
+#
+# Description:  Append-only store for the TCP payloads of a unified DB. A
+#               payload used to be kept as a BLOB in packets.shark_data, again
+#               in rosPackets.shark_data for every message in it and in
+#               unclassifiedROSMessages.packet_data, and once more for every
+#               capture point that saw the packet. The store keeps the bytes
+#               of each packet fingerprint once, in a file next to the DB
+#               ("<db>-payloads"), and the tables hold payload_offset plus the
+#               length they already had (shark_data_len, payload_len), with
+#               the BLOB columns left NULL.
+#
+#               Readers get the payloads as memoryviews of a read-only map of
+#               the file, without a copy. Payloads are appended and flushed
+#               before the rows that point at them are committed, so a crash
+#               can only leave unreferenced bytes at the end of the file.
+#
+#               migrate_db.py moves the BLOBs of an existing DB into a store.
+#
+#               The offsets of the stored fingerprints are kept in memory, all
+#               of them unless a window is given: then only the most recent
+#               window fingerprints are kept and older ones are looked up in
+#               the packets table of the DB given to loadIndex, by its
+#               fingerprint index. live_ingest.py runs with a window so its
+#               memory does not grow with the capture.
+#
+
+import mmap
+import os
+from collections import OrderedDict
+
+STORE_MAGIC = b'YBPAYLD1'
+STORE_SUFFIX = "-payloads"
+
+
+def storePath(db_filename):
+    return str(db_filename) + STORE_SUFFIX
+
+
+class PayloadStore:
+
+    def __init__(self, path, writable=True, window=None):
+        self.path = path
+        self.writable = writable
+        self.window = window
+        if writable:
+            self.file = open(path, 'a+b')
+            self.file.seek(0, os.SEEK_END)
+            if self.file.tell() == 0:
+                self.file.write(STORE_MAGIC)
+        else:
+            self.file = open(path, 'rb')
+        self.file.seek(0)
+        if self.file.read(len(STORE_MAGIC)) != STORE_MAGIC:
+            self.file.close()
+            raise ValueError("Not a payload store: " + str(path))
+        self.file.seek(0, os.SEEK_END)
+        self.end = self.file.tell()
+        # Offset of the payload of every fingerprint in the store, or of the
+        # most recent window fingerprints
+        self.index = {} if window is None else OrderedDict()
+        self.conn = None
+        self.buffer = None
+        self.mapped = 0
+        self.added = 0
+        self.addedBytes = 0
+        self.deduplicated = 0
+
+    def loadIndex(self, conn):
+        # Pick up the payloads the DB already points at, so they are not
+        # stored again. With a window they are looked up in the DB as needed.
+        if self.window is not None:
+            self.conn = conn
+            return
+        for fingerprint, offset in conn.execute('''SELECT fingerprint, MIN(payload_offset) FROM packets \
+                                                  WHERE payload_offset IS NOT NULL GROUP BY fingerprint'''):
+            self.index[fingerprint] = offset
+
+    def add(self, fingerprint, data):
+        # Returns the offset of the payload, appending it unless a payload
+        # with the same fingerprint is already stored
+        offset = self.lookup(fingerprint)
+        if offset is not None:
+            self.deduplicated += 1
+            return offset
+        offset = self.end
+        self.file.write(data)
+        self.end += len(data)
+        self.remember(fingerprint, offset)
+        self.added += 1
+        self.addedBytes += len(data)
+        return offset
+
+    def lookup(self, fingerprint):
+        # Offset of the stored payload of a fingerprint, or None
+        if self.window is None:
+            return self.index.get(fingerprint)
+        offset = self.index.get(fingerprint)
+        if offset is not None:
+            self.index.move_to_end(fingerprint)
+            return offset
+        if self.conn is None:
+            return None
+        offset = self.conn.execute('''SELECT MIN(payload_offset) FROM packets WHERE fingerprint = ?''',
+                                   (fingerprint,)).fetchone()[0]
+        if offset is not None:
+            self.remember(fingerprint, offset)
+        return offset
+
+    def remember(self, fingerprint, offset):
+        self.index[fingerprint] = offset
+        if self.window is not None and len(self.index) > self.window:
+            self.index.popitem(last=False)
+
+    def flush(self):
+        # Called before the rows pointing at the new payloads are committed
+        if self.writable:
+            self.file.flush()
+
+    def sync(self):
+        self.flush()
+        os.fsync(self.file.fileno())
+
+    def view(self, offset, length):
+        # The payload as a memoryview of the map. The map is renewed when the
+        # payload was appended after it was made; views of the old map stay
+        # valid.
+        if offset + length > self.mapped:
+            self.flush()
+            mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.buffer = memoryview(mm)
+            self.mapped = len(mm)
+        return self.buffer[offset:offset + length]
+
+    def payload(self, offset, length, blob=None):
+        # A payload column pair as stored in any DB: the BLOB of rows written
+        # without a store, otherwise the view of the stored bytes
+        if blob is not None:
+            return blob
+        if offset is None:
+            return None
+        return self.view(offset, length)
+
+    def registerFunctions(self, conn):
+        # payloadBlob(offset, length) for SQL that needs the bytes, e.g.
+        # SELECT IFNULL(shark_data, payloadBlob(payload_offset, shark_data_len))
+        conn.create_function('payloadBlob', 2,
+                             lambda offset, length: None if offset is None else bytes(self.view(offset, length)))
+        if self.writable:
+            conn.create_function('storePayload', 2, lambda fingerprint, data: self.add(fingerprint, data))
+
+    def summary(self):
+        return ("Payload store: " + str(self.added) + " payloads added (" + \
+                "{0:.2f} MB), ".format(self.addedBytes / 1e6) + str(self.deduplicated) + \
+                " deduplicated, {0:.2f} MB in \"".format(self.end / 1e6) + str(self.path) + "\"")
+
+    def close(self):
+        self.flush()
+        self.buffer = None
+        self.file.close()
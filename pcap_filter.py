@@ -0,0 +1,196 @@
+#
+# Author:       Timothy Zimmerman (timothy.zimmerman@nist.gov)
+# Organization: National Institute of Standards and Technology
+#               U.S. Department of Commerce
+# License:      Public Domain
+#
+# Description:  BPF-style prefilter for the native PCAP reader. Frames are
+#               rejected using only fixed-offset header checks (ethertype, IP
+#               protocol, TCP flags, ports, payload length) before any packet
+#               object is allocated. The rules are compiled once into a single
+#               Python function, and every rejection is counted by reason so
+#               the rules can be tuned.
+#
+#               TCP stacks set PSH only on the last segment of a message that
+#               is split, the earlier ones carry ACK alone. An ingest that
+#               reassembles the TCP streams needs those too, so its filter also
+#               accepts data-bearing ACK segments (see FilterRules.data_acks).
+#
+
+from struct import Struct
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_VLAN = 0x8100
+
+IPPROTO_TCP = 6
+
+TCP_FLAG_FIN = 0x01
+TCP_FLAG_SYN = 0x02
+TCP_FLAG_RST = 0x04
+TCP_FLAG_ACK = 0x10
+TCP_FLAGS_PSH_ACK = 0x18
+# Flags that must be ACK alone (PSH, URG and ECN may be set) for a segment
+# to count as a data-bearing ACK
+TCP_DATA_ACK_MASK = TCP_FLAG_FIN | TCP_FLAG_SYN | TCP_FLAG_RST | TCP_FLAG_ACK
+
+# Well-known ports of the protocols removed by "!nfs && !ssh && !http && !ntp"
+EXCLUDED_PORTS = frozenset([22, 80, 123, 2049, 3128, 8080])
+
+# Network byte order header layouts
+ETH_TYPE = Struct('>H')
+IPV4_HEADER = Struct('>BxHxxxxxBxx4s4s')    # ver/ihl, total len, proto, src, dst
+TCP_HEADER = Struct('>HHIIBBxxH')           # ports, seq, ack, data offset, flags, checksum
+
+# Rejection reasons, in the order the compiled filter checks them
+REJECT_TRUNCATED = 'truncated'
+REJECT_ETHERTYPE = 'ethertype'
+REJECT_IP_PROTOCOL = 'ip_protocol'
+REJECT_TCP_FLAGS = 'tcp_flags'
+REJECT_DENIED_PORT = 'denied_port'
+REJECT_NOT_ALLOWED_PORT = 'not_allowed_port'
+REJECT_NO_PAYLOAD = 'no_payload'
+
+REJECT_REASONS = (REJECT_TRUNCATED, REJECT_ETHERTYPE, REJECT_IP_PROTOCOL, REJECT_TCP_FLAGS,
+                  REJECT_DENIED_PORT, REJECT_NOT_ALLOWED_PORT, REJECT_NO_PAYLOAD)
+
+
+class FilterRules:
+    # The defaults reproduce the pyshark display filter that pcap_to_db.py has
+    # always used:
+    # "tcp && !nfs && !ssh && !http && !ntp && !ethercat && tcp.flags == 0x0018 && data"
+    #
+    #   tcp_flags       exact value of the TCP flags byte, or None for any
+    #   deny_ports      frames to/from any of these ports are rejected
+    #   allow_ports     if given, one of the ports must be in this set
+    #   require_payload reject segments without TCP payload
+    #   strip_vlan      look through a single 802.1Q tag
+    #   data_acks       also accept segments that carry payload with ACK set
+    #                   and no SYN, FIN or RST, whatever tcp_flags says
+
+    def __init__(self, tcp_flags=TCP_FLAGS_PSH_ACK, deny_ports=EXCLUDED_PORTS, allow_ports=None,
+                 require_payload=True, strip_vlan=True, data_acks=False):
+        self.tcp_flags = tcp_flags
+        self.deny_ports = frozenset(deny_ports or ())
+        self.allow_ports = frozenset(allow_ports) if allow_ports is not None else None
+        self.require_payload = require_payload
+        self.strip_vlan = strip_vlan
+        self.data_acks = data_acks
+
+    def withDataAcks(self):
+        # A copy of the rules that also accepts data-bearing ACK segments
+        return FilterRules(self.tcp_flags, self.deny_ports, self.allow_ports, self.require_payload,
+                           self.strip_vlan, True)
+
+
+class PacketFilter:
+    # With reassemble set the rules are applied with data_acks, so the
+    # leading segments of a split message reach the reassembler
+
+    def __init__(self, rules=None, reassemble=False):
+        rules = rules if rules is not None else FilterRules()
+        if reassemble and not rules.data_acks:
+            rules = rules.withDataAcks()
+        self.rules = rules
+        self.accepted = 0
+        self.rejected = dict.fromkeys(REJECT_REASONS, 0)
+        self.check = compileFilter(self.rules, self.rejected)
+
+    def resetCounters(self):
+        self.accepted = 0
+        for reason in self.rejected:
+            self.rejected[reason] = 0
+
+    def summary(self):
+        total = self.accepted + sum(self.rejected.values())
+        parts = [reason + "=" + str(count) for reason, count in self.rejected.items() if count > 0]
+        return ("Prefilter: accepted " + str(self.accepted) + " of " + str(total) + " frames" + \
+                ("; rejected " + ", ".join(parts) if parts else ""))
+
+
+def compileFilter(rules, rejected):
+    # Build the source of a check(buf, offset, caplen) function for the given
+    # rules and compile it. The function returns None when the frame is
+    # accepted, otherwise the rejection reason (which is also counted in the
+    # rejected dictionary). Checks that a rule disables are left out of the
+    # generated code entirely.
+    src = ["def check(buf, offset, caplen):",
+           "    end = offset + caplen",
+           "    if caplen < 14:",
+           "        return reject(REJECT_TRUNCATED)",
+           "    ethertype = eth_type(buf, offset + 12)[0]",
+           "    pos = offset + 14"]
+    if rules.strip_vlan:
+        src += ["    if ethertype == ETHERTYPE_VLAN:",
+                "        if caplen < 18:",
+                "            return reject(REJECT_TRUNCATED)",
+                "        ethertype = eth_type(buf, offset + 16)[0]",
+                "        pos += 4"]
+    src += ["    if ethertype != ETHERTYPE_IPV4:",
+            "        return reject(REJECT_ETHERTYPE)",
+            "    if pos + 20 > end:",
+            "        return reject(REJECT_TRUNCATED)",
+            "    ver_ihl, ip_len, proto, ip_src, ip_dst = ipv4_header(buf, pos)",
+            "    if proto != IPPROTO_TCP:",
+            "        return reject(REJECT_IP_PROTOCOL)",
+            "    ip_end = pos + ip_len",
+            "    if ip_end > end:",
+            "        ip_end = end",
+            "    pos += (ver_ihl & 0x0f) * 4",
+            "    if pos + 20 > ip_end:",
+            "        return reject(REJECT_TRUNCATED)",
+            "    sport, dport, seq, ack, data_off, flags, checksum = tcp_header(buf, pos)"]
+    if rules.tcp_flags is not None and rules.data_acks:
+        # Segments without payload keep failing the flags check, so the
+        # readers still see the handshake ACKs
+        src += ["    if flags != TCP_FLAGS and (flags & TCP_DATA_ACK_MASK != TCP_FLAG_ACK or",
+                "                               pos + (data_off >> 4) * 4 >= ip_end):",
+                "        return reject(REJECT_TCP_FLAGS)"]
+    elif rules.tcp_flags is not None:
+        src += ["    if flags != TCP_FLAGS:",
+                "        return reject(REJECT_TCP_FLAGS)"]
+    if rules.deny_ports:
+        src += ["    if sport in DENY_PORTS or dport in DENY_PORTS:",
+                "        return reject(REJECT_DENIED_PORT)"]
+    if rules.allow_ports is not None:
+        src += ["    if sport not in ALLOW_PORTS and dport not in ALLOW_PORTS:",
+                "        return reject(REJECT_NOT_ALLOWED_PORT)"]
+    if rules.require_payload:
+        src += ["    if pos + (data_off >> 4) * 4 >= ip_end:",
+                "        return reject(REJECT_NO_PAYLOAD)"]
+    src += ["    return None"]
+
+    def reject(reason):
+        rejected[reason] += 1
+        return reason
+
+    namespace = {'reject': reject,
+                 'eth_type': ETH_TYPE.unpack_from,
+                 'ipv4_header': IPV4_HEADER.unpack_from,
+                 'tcp_header': TCP_HEADER.unpack_from,
+                 'ETHERTYPE_IPV4': ETHERTYPE_IPV4,
+                 'ETHERTYPE_VLAN': ETHERTYPE_VLAN,
+                 'IPPROTO_TCP': IPPROTO_TCP,
+                 'TCP_FLAGS': rules.tcp_flags,
+                 'TCP_FLAG_ACK': TCP_FLAG_ACK,
+                 'TCP_DATA_ACK_MASK': TCP_DATA_ACK_MASK,
+                 'DENY_PORTS': rules.deny_ports,
+                 'ALLOW_PORTS': rules.allow_ports}
+    namespace.update((name, globals()[name]) for name in globals() if name.startswith('REJECT_'))
+    exec(compile("\n".join(src), "<pcap_filter>", "exec"), namespace)
+    return namespace['check']
+
+
+def decodeTcp(buf, offset, caplen, strip_vlan=True):
+    # Decode the IPv4/TCP headers of a frame that the prefilter has already
+    # validated up to the TCP header; strip_vlan is that of its FilterRules.
+    # Returns (ip_src, ip_dst, sport, dport, seq, ack, flags, checksum,
+    # payload offset, payload end).
+    end = offset + caplen
+    pos = offset + 14
+    if strip_vlan and ETH_TYPE.unpack_from(buf, offset + 12)[0] == ETHERTYPE_VLAN:
+        pos += 4
+    ver_ihl, ip_len, proto, ip_src, ip_dst = IPV4_HEADER.unpack_from(buf, pos)
+    ip_end = min(pos + ip_len, end)
+    pos += (ver_ihl & 0x0f) * 4
+    sport, dport, seq, ack, data_off, flags, checksum = TCP_HEADER.unpack_from(buf, pos)
+    return ip_src, ip_dst, sport, dport, seq, ack, flags, checksum, pos + (data_off >> 4) * 4, ip_end
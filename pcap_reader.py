@@ -0,0 +1,446 @@
+#
+# Author:       Timothy Zimmerman (timothy.zimmerman@nist.gov)
+# Organization: National Institute of Standards and Technology
+#               U.S. Department of Commerce
+# License:      Public Domain
+#
+# Description:  Native PCAP reader used by pcap_to_db.py. The capture file is
+#               memory-mapped and the record headers are walked in place; the
+#               Ethernet, IPv4 and TCP headers are decoded at fixed offsets and
+#               the TCP payload is handed out as a memoryview into the map, so
+#               no packet bytes are copied until they are written to the DB.
+#               Frames go through the pcap_filter prefilter before anything is
+#               decoded. The pyshark backend is kept as an optional fallback.
+#
+#               Captures that are still being written (a file tcpdump is
+#               appending to, or tcpdump -w - on a pipe) are read record by
+#               record with PcapStream instead.
+#
+# Resource(s):  http://www.kroosec.com/2012/10/a-look-at-pcap-file-format.html
+#               http://www.winpcap.org/ntar/draft/PCAP-DumpFileFormat.html
+#
+
+import mmap
+import time
+from collections import OrderedDict, deque
+from struct import Struct
+import pcap_filter
+from pcap_filter import TCP_FLAG_SYN, TCP_FLAG_ACK
+
+PCAP_GLOBAL_HEADER_LEN = 24
+PCAP_RECORD_HEADER_LEN = 16
+
+LINKTYPE_ETHERNET = 1
+
+# Bounds of the handshake tracker of a PcapStream: seconds (capture time) a
+# SYN waits for its handshake to complete, connections whose initial RTT is
+# kept, and handshakes kept per connection
+STREAM_SYN_TIMEOUT = 60.0
+STREAM_MAX_CONNECTIONS = 4096
+STREAM_MAX_HANDSHAKES = 4
+
+# Display filter used when falling back to pyshark. The native reader applies
+# the same rules through the pcap_filter prefilter.
+PYSHARK_FILTER = "tcp && !nfs && !ssh && !http && !ntp && !ethercat && tcp.flags == 0x0018 && data"
+
+
+class PcapFormatError(Exception):
+    pass
+
+
+class Frame:
+    # Decoded view of a single captured TCP segment. The field set mirrors the
+    # pyshark attributes that pcap_to_db.py used to read. addresses holds the
+    # raw MAC and IPv4 addresses (dst, src, dst, src) when the reader has
+    # them, so the packet fingerprint does not have to parse the strings.
+    __slots__ = ('number', 'timestamp', 'eth_dst', 'eth_src', 'ip_dst', 'ip_src',
+                 'tcp_dstport', 'tcp_srcport', 'tcp_seq', 'tcp_nxtseq', 'tcp_ack',
+                 'tcp_checksum', 'tcp_initial_rtt', 'data', 'data_len', 'addresses')
+
+    def __init__(self, number, timestamp, eth_dst, eth_src, ip_dst, ip_src,
+                 tcp_dstport, tcp_srcport, tcp_seq, tcp_nxtseq, tcp_ack,
+                 tcp_checksum, tcp_initial_rtt, data, data_len, addresses=None):
+        self.number = number
+        self.timestamp = timestamp
+        self.eth_dst = eth_dst
+        self.eth_src = eth_src
+        self.ip_dst = ip_dst
+        self.ip_src = ip_src
+        self.tcp_dstport = tcp_dstport
+        self.tcp_srcport = tcp_srcport
+        self.tcp_seq = tcp_seq
+        self.tcp_nxtseq = tcp_nxtseq
+        self.tcp_ack = tcp_ack
+        self.tcp_checksum = tcp_checksum
+        self.tcp_initial_rtt = tcp_initial_rtt
+        self.data = data
+        self.data_len = data_len
+        self.addresses = addresses
+
+
+class TcpHandshakeTracker:
+    # Reproduces Wireshark's tcp.analysis.initial_rtt: the time from the first
+    # SYN of a connection to the ACK that completes the three-way handshake.
+    # Completions are remembered with their frame numbers so lookups give the
+    # same answer no matter in which order frames are visited. A frozen
+    # tracker (see parallel_ingest) ignores further observations.
+    #
+    # By default everything is kept, which the chunked ingest needs to look
+    # up any frame of the capture. A tracker for a capture that never ends
+    # (PcapStream) is bounded instead: SYNs that get no answer within
+    # syn_timeout seconds of capture time are forgotten, only the last
+    # max_handshakes completions of a connection are kept, and at most
+    # max_connections connections, the ones used the longest ago being
+    # dropped first.
+
+    def __init__(self, syn_timeout=None, max_connections=None, max_handshakes=None):
+        self.syn_timeout = syn_timeout
+        self.max_connections = max_connections
+        self.max_handshakes = max_handshakes
+        # Kept in the order the SYNs were seen, so the oldest are in front
+        self.synTimes = OrderedDict()
+        self.synAckSeen = set()
+        self.initialRtt = OrderedDict()
+        self.frozen = False
+
+    def observe(self, frameNum, timestamp, src, sport, dst, dport, flags):
+        if self.frozen:
+            return
+        if self.syn_timeout is not None:
+            self.expireSyns(timestamp)
+        client = (src, sport, dst, dport)
+        if flags & (TCP_FLAG_SYN | TCP_FLAG_ACK) == TCP_FLAG_SYN:
+            self.synTimes.setdefault(client, timestamp)
+        elif flags & (TCP_FLAG_SYN | TCP_FLAG_ACK) == (TCP_FLAG_SYN | TCP_FLAG_ACK):
+            if (dst, dport, src, sport) in self.synTimes:
+                self.synAckSeen.add((dst, dport, src, sport))
+        elif flags & TCP_FLAG_ACK and client in self.synAckSeen:
+            self.synAckSeen.discard(client)
+            synTime = self.synTimes.pop(client)
+            key = connectionKey(src, sport, dst, dport)
+            completions = self.initialRtt.get(key)
+            if completions is None:
+                completions = self.initialRtt[key] = deque(maxlen=self.max_handshakes)
+                if self.max_connections is not None and len(self.initialRtt) > self.max_connections:
+                    self.initialRtt.popitem(last=False)
+            else:
+                self.initialRtt.move_to_end(key)
+            completions.append((frameNum, timestamp - synTime))
+
+    def expireSyns(self, timestamp):
+        # Forget the handshakes that were started more than syn_timeout ago
+        while self.synTimes:
+            client, synTime = next(iter(self.synTimes.items()))
+            if timestamp - synTime <= self.syn_timeout:
+                break
+            del self.synTimes[client]
+            self.synAckSeen.discard(client)
+
+    def freeze(self):
+        # Keep only the completed handshakes and stop observing
+        self.synTimes = OrderedDict()
+        self.synAckSeen = set()
+        self.frozen = True
+
+    def lookup(self, frameNum, src, sport, dst, dport):
+        # Latest handshake of this connection completed at or before frameNum
+        key = connectionKey(src, sport, dst, dport)
+        completions = self.initialRtt.get(key)
+        if completions is None:
+            return None
+        if self.max_connections is not None:
+            self.initialRtt.move_to_end(key)
+        for completedFrame, rtt in reversed(completions):
+            if completedFrame <= frameNum:
+                return rtt
+        return None
+
+
+def connectionKey(src, sport, dst, dport):
+    # Direction independent key for a TCP connection
+    if (src, sport) <= (dst, dport):
+        return (src, sport, dst, dport)
+    return (dst, dport, src, sport)
+
+
+def acceptedHandshakeFlags(packetFilter):
+    # (exact flags of the rules, whether accepted frames must be observed).
+    # A filter with data_acks accepts segments other than the exact flags,
+    # and one of them may complete a handshake.
+    rules = packetFilter.rules
+    return rules.tcp_flags, rules.data_acks and rules.tcp_flags is not None
+
+
+def formatMac(b):
+    return ':'.join('%02x' % x for x in b)
+
+
+def formatIPv4(b):
+    return '%d.%d.%d.%d' % (b[0], b[1], b[2], b[3])
+
+
+def readGlobalHeader(buf):
+    # Returns (unpack_header, ts_divisor, linktype) for the capture. The
+    # unpack_header is also what ros_msg_dissector expects for the payloads.
+    if len(buf) < PCAP_GLOBAL_HEADER_LEN:
+        raise PcapFormatError("File is too short to be a PCAP capture")
+    magic = Struct('>I').unpack_from(buf, 0)[0]
+    if magic == 0xd4c3b2a1:
+        unpack_header, ts_divisor = '<', 1e6
+    elif magic == 0xa1b2c3d4:
+        unpack_header, ts_divisor = '>', 1e6
+    elif magic == 0x4d3cb2a1:
+        unpack_header, ts_divisor = '<', 1e9
+    elif magic == 0xa1b23c4d:
+        unpack_header, ts_divisor = '>', 1e9
+    else:
+        raise PcapFormatError("Unrecognized PCAP magic number 0x%08x" % magic)
+    linktype = Struct(unpack_header + 'I').unpack_from(buf, 20)[0]
+    return unpack_header, ts_divisor, linktype
+
+
+def openCapture(filename):
+    # Memory-map a capture file read-only. Empty files cannot be mapped, so
+    # those are returned as an empty bytes object instead.
+    with open(filename, 'rb') as f:
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return b''
+
+
+def closeCapture(mm):
+    # Payload memoryviews handed out by iterFrames keep the map exported; in
+    # that case the map is closed when the last view is garbage collected.
+    if isinstance(mm, mmap.mmap):
+        try:
+            mm.close()
+        except BufferError:
+            pass
+
+
+def iterRecords(buf, unpack_header, start=PCAP_GLOBAL_HEADER_LEN, stop=None, firstFrame=1):
+    # Walk the PCAP record headers, yielding (frame_num, ts_sec, ts_frac,
+    # data offset, captured length). A truncated final record ends the walk.
+    # start/stop limit the walk to the records between two record offsets,
+    # the first of which is frame number firstFrame.
+    record = Struct(unpack_header + 'IIII')
+    end = len(buf) if stop is None else min(stop, len(buf))
+    offset = start
+    frameNum = firstFrame - 1
+    while offset + PCAP_RECORD_HEADER_LEN <= end:
+        ts_sec, ts_frac, incl_len, orig_len = record.unpack_from(buf, offset)
+        offset += PCAP_RECORD_HEADER_LEN
+        if offset + incl_len > end:
+            break
+        frameNum += 1
+        yield frameNum, ts_sec, ts_frac, offset, incl_len
+        offset += incl_len
+
+
+def iterFrames(filename, packetFilter=None, tracker=None, start=PCAP_GLOBAL_HEADER_LEN, stop=None, firstFrame=1):
+    # Yield a Frame for every packet accepted by the prefilter. The default
+    # rules match PYSHARK_FILTER: IPv4/TCP with PSH+ACK set, a non-empty
+    # payload, and not on an NFS/SSH/HTTP/NTP port; a filter made for
+    # reassembly also passes data-bearing ACK segments. EtherCAT has its own
+    # ethertype and never reaches the TCP checks. start, stop and firstFrame
+    # are passed on to iterRecords.
+    if packetFilter is None:
+        packetFilter = pcap_filter.PacketFilter()
+    if tracker is None:
+        tracker = TcpHandshakeTracker()
+    check = packetFilter.check
+    decodeTcp = pcap_filter.decodeTcp
+    strip_vlan = packetFilter.rules.strip_vlan
+    tcpFlags, observeAccepted = acceptedHandshakeFlags(packetFilter)
+
+    mm = openCapture(filename)
+    view = None
+    try:
+        unpack_header, ts_divisor, linktype = readGlobalHeader(mm)
+        if linktype != LINKTYPE_ETHERNET:
+            raise PcapFormatError("Unsupported link type " + str(linktype))
+        view = memoryview(mm)
+
+        for frameNum, ts_sec, ts_frac, offset, caplen in iterRecords(mm, unpack_header, start, stop, firstFrame):
+            reason = check(mm, offset, caplen)
+            if reason is not None:
+                # Handshake segments never pass the flags check, but they are
+                # needed to work out the initial RTT of the connection
+                if reason is pcap_filter.REJECT_TCP_FLAGS:
+                    ip_src, ip_dst, sport, dport, seq, ack, flags = decodeTcp(mm, offset, caplen, strip_vlan)[:7]
+                    tracker.observe(frameNum, ts_sec + ts_frac / ts_divisor, ip_src, sport, ip_dst, dport, flags)
+                continue
+
+            ip_src, ip_dst, sport, dport, seq, ack, flags, checksum, start, end = decodeTcp(mm, offset, caplen, strip_vlan)
+            if observeAccepted and flags != tcpFlags:
+                tracker.observe(frameNum, ts_sec + ts_frac / ts_divisor, ip_src, sport, ip_dst, dport, flags)
+            data_len = end - start
+            packetFilter.accepted += 1
+            yield Frame(frameNum, ts_sec + ts_frac / ts_divisor,
+                        formatMac(mm[offset:offset + 6]), formatMac(mm[offset + 6:offset + 12]),
+                        formatIPv4(ip_dst), formatIPv4(ip_src), dport, sport,
+                        seq, (seq + data_len) & 0xffffffff, ack, checksum,
+                        tracker.lookup(frameNum, ip_src, sport, ip_dst, dport),
+                        view[start:end], data_len, mm[offset:offset + 12] + ip_dst + ip_src)
+    finally:
+        # Also when the generator is closed early or the caller raised, so
+        # the map is closed right away unless payloads are still referenced
+        if view is not None:
+            view.release()
+        closeCapture(mm)
+
+
+def scanChunks(filename, chunk_size, packetFilter=None, tracker=None):
+    # One pass over the record headers of a capture that splits it into
+    # chunks of roughly chunk_size bytes, each starting on a record boundary.
+    # The handshakes are tracked on the way, so the chunks can be decoded
+    # independently and still get the initial RTT a sequential run would.
+    # Returns (unpack_header, [(start, stop, firstFrame), ...], tracker).
+    if packetFilter is None:
+        packetFilter = pcap_filter.PacketFilter()
+    if tracker is None:
+        tracker = TcpHandshakeTracker()
+    check = packetFilter.check
+    decodeTcp = pcap_filter.decodeTcp
+    strip_vlan = packetFilter.rules.strip_vlan
+    tcpFlags, observeAccepted = acceptedHandshakeFlags(packetFilter)
+
+    mm = openCapture(filename)
+    try:
+        unpack_header, ts_divisor, linktype = readGlobalHeader(mm)
+        if linktype != LINKTYPE_ETHERNET:
+            raise PcapFormatError("Unsupported link type " + str(linktype))
+
+        chunks = []
+        chunkStart = PCAP_GLOBAL_HEADER_LEN
+        chunkFirst = 1
+        for frameNum, ts_sec, ts_frac, offset, caplen in iterRecords(mm, unpack_header):
+            recordStart = offset - PCAP_RECORD_HEADER_LEN
+            if recordStart - chunkStart >= chunk_size:
+                chunks.append((chunkStart, recordStart, chunkFirst))
+                chunkStart = recordStart
+                chunkFirst = frameNum
+            reason = check(mm, offset, caplen)
+            if reason is pcap_filter.REJECT_TCP_FLAGS or (reason is None and observeAccepted):
+                ip_src, ip_dst, sport, dport, seq, ack, flags = decodeTcp(mm, offset, caplen, strip_vlan)[:7]
+                if reason is not None or flags != tcpFlags:
+                    tracker.observe(frameNum, ts_sec + ts_frac / ts_divisor, ip_src, sport, ip_dst, dport, flags)
+        chunks.append((chunkStart, None, chunkFirst))
+    finally:
+        closeCapture(mm)
+    return unpack_header, chunks, tracker
+
+
+class PcapStream:
+    # Like iterFrames, for a binary file object that is read sequentially.
+    # Iterating yields Frames, and None every poll_interval while no data is
+    # available so the consumer can flush its buffers: that is when a
+    # non-blocking pipe has nothing to read, and, with follow set, at the end
+    # of a file that is still growing (tail -f). Otherwise the end of the
+    # stream ends the capture. unpack_header is set once the global header
+    # has been read. Payloads are bytes objects. Unless a tracker is given,
+    # the handshakes are tracked within the STREAM_* bounds, so a capture
+    # that runs forever does not grow the tracker.
+
+    def __init__(self, stream, packetFilter=None, tracker=None, follow=False, poll_interval=0.05):
+        self.stream = stream
+        self.name = getattr(stream, 'name', '-')
+        self.packetFilter = packetFilter if packetFilter is not None else pcap_filter.PacketFilter()
+        if tracker is None:
+            tracker = TcpHandshakeTracker(STREAM_SYN_TIMEOUT, STREAM_MAX_CONNECTIONS, STREAM_MAX_HANDSHAKES)
+        self.tracker = tracker
+        self.follow = follow
+        self.poll_interval = poll_interval
+        self.unpack_header = None
+
+    def readExactly(self, n):
+        # Yields None while waiting, then n bytes, or fewer at the end of
+        # the stream
+        buf = b''
+        while len(buf) < n:
+            data = self.stream.read(n - len(buf))
+            if data:
+                buf += data
+                continue
+            if data is not None and not self.follow:
+                break
+            yield None
+            time.sleep(self.poll_interval)
+        yield buf
+
+    def __iter__(self):
+        check = self.packetFilter.check
+        decodeTcp = pcap_filter.decodeTcp
+        strip_vlan = self.packetFilter.rules.strip_vlan
+        tracker = self.tracker
+        tcpFlags, observeAccepted = acceptedHandshakeFlags(self.packetFilter)
+
+        for header in self.readExactly(PCAP_GLOBAL_HEADER_LEN):
+            if header is None:
+                yield None
+        unpack_header, ts_divisor, linktype = readGlobalHeader(header)
+        if linktype != LINKTYPE_ETHERNET:
+            raise PcapFormatError("Unsupported link type " + str(linktype))
+        record = Struct(unpack_header + 'IIII')
+        self.unpack_header = unpack_header
+
+        frameNum = 0
+        while True:
+            for recordHeader in self.readExactly(PCAP_RECORD_HEADER_LEN):
+                if recordHeader is None:
+                    yield None
+            if len(recordHeader) < PCAP_RECORD_HEADER_LEN:
+                return
+            ts_sec, ts_frac, incl_len, orig_len = record.unpack(recordHeader)
+            for buf in self.readExactly(incl_len):
+                if buf is None:
+                    yield None
+            if len(buf) < incl_len:
+                return
+            frameNum += 1
+            timestamp = ts_sec + ts_frac / ts_divisor
+
+            reason = check(buf, 0, incl_len)
+            if reason is not None:
+                if reason is pcap_filter.REJECT_TCP_FLAGS:
+                    ip_src, ip_dst, sport, dport, seq, ack, flags = decodeTcp(buf, 0, incl_len, strip_vlan)[:7]
+                    tracker.observe(frameNum, timestamp, ip_src, sport, ip_dst, dport, flags)
+                continue
+
+            ip_src, ip_dst, sport, dport, seq, ack, flags, checksum, start, end = decodeTcp(buf, 0, incl_len, strip_vlan)
+            if observeAccepted and flags != tcpFlags:
+                tracker.observe(frameNum, timestamp, ip_src, sport, ip_dst, dport, flags)
+            data_len = end - start
+            self.packetFilter.accepted += 1
+            yield Frame(frameNum, timestamp, formatMac(buf[0:6]), formatMac(buf[6:12]),
+                        formatIPv4(ip_dst), formatIPv4(ip_src), dport, sport,
+                        seq, (seq + data_len) & 0xffffffff, ack, checksum,
+                        tracker.lookup(frameNum, ip_src, sport, ip_dst, dport),
+                        buf[start:end], data_len, buf[0:12] + ip_dst + ip_src)
+
+
+def iterPysharkFrames(filename, display_filter=PYSHARK_FILTER):
+    # Fallback backend: let tshark do the dissection and convert its packets
+    # into Frames. Absolute sequence numbers are requested so fingerprints
+    # agree with the native reader.
+    import pyshark
+
+    captureFile = pyshark.FileCapture(filename, display_filter=display_filter,
+                                      override_prefs={'tcp.relative_sequence_numbers': 'FALSE'})
+    try:
+        for packet in captureFile:
+            try:
+                data = packet.data.data.binary_value
+                initial_rtt = getattr(packet.tcp, 'analysis_initial_rtt', None)
+                yield Frame(int(packet.frame_info.number), float(packet.sniff_timestamp),
+                            packet.eth.dst, packet.eth.src, packet.ip.dst, packet.ip.src,
+                            int(packet.tcp.dstport), int(packet.tcp.srcport),
+                            int(packet.tcp.seq), int(packet.tcp.nxtseq), int(packet.tcp.ack),
+                            int(packet.tcp.checksum, 16),
+                            float(initial_rtt) if initial_rtt is not None else None,
+                            data, len(data))
+            except AttributeError:
+                continue
+    finally:
+        captureFile.close()
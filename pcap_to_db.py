@@ -6,7 +6,10 @@
 #
 # Description:  Searches through the current directory for all PCAP files and
 #               unifies them into a single PCAP file, as well as inserting
-#               all the packets into a SQLite database.
+#               all the packets into a SQLite database. The reading and
+#               dissection are the generators of pipeline.py, which can be
+#               used on their own; this script only picks the captures and
+#               the ingest mode.
 #
 # Resource(s):  http://www.kroosec.com/2012/10/a-look-at-pcap-file-format.html
 #               http://www.winpcap.org/ntar/draft/PCAP-DumpFileFormat.html
@@ -15,169 +18,266 @@
 
 import datetime
 import glob
-import sqlite3
-from struct import unpack
-import pyshark
-import ros_msg_dissector as rosDisector
-import hashlib
-
-# Create the DB with the current date and time
-curr_date = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
-conn = sqlite3.connect("unified_" + curr_date + ".db")
-
-# Create the SQLite cursor and table
-c = conn.cursor()
-
-c.execute('''CREATE TABLE packets (\
-                id INTEGER PRIMARY KEY AUTOINCREMENT, \
-                shark_timestamp REAL, \
-                shark_file_id INTEGER, \
-                shark_frame_num INTEGER, \
-                shark_eth_dst TEXT, \
-                shark_eth_src TEXT, \
-                shark_ip_dst TEXT, \
-                shark_ip_src TEXT, \
-                shark_tcp_port_dst INTEGER, \
-                shark_tcp_port_src INTEGER, \
-                shark_tcp_seq_num INTEGER, \
-                shark_tcp_next_seq_num INTEGER, \
-                shark_tcp_expected_ack INTEGER, \
-                shark_tcp_checksum INTEGER, \
-                shark_analysis_initial_rtt REAL, \
-                shark_data BLOB, \
-                shark_data_len INTEGER, \
-                md5_hash TEXT \
-                )''')
-
-c.execute('''CREATE TABLE rosPackets (\
-                id INTEGER PRIMARY KEY AUTOINCREMENT, \
-                parent_id INTEGER, \
-                shark_frame_num INTEGER, \
-                shark_data BLOB, \
-                shark_data_len INTEGER, \
-                ros_msg_tuple TEXT, \
-                md5_hash TEXT \
-                )''')
-                
-c.execute('''CREATE TABLE pcapFiles (id INTEGER PRIMARY KEY AUTOINCREMENT, filename TEXT, machinename TEXT)''')
-c.execute('''CREATE TABLE unclassifiedROSMessages ( id INTEGER PRIMARY KEY AUTOINCREMENT, \
-                                                    parent_id INTEGER, \
-                                                    pyshark_id INTEGER, \
-                                                    packet_data BLOB \
-                                                    )''')
-
-# Iterate through the current directory for all PCAP files
-for filename in glob.glob(".\YoubotCycle1\*.pcap"):
-    # Open the current PCAP file...
-    f = open(filename, 'rb')
-    magic_num = f.read(4);
-    f.close()
-    
+import async_pipeline
+import pcap_filter
+import pcap_reader
+import db_writer
+import db_schema
+import dissect_cache
+import ingest
+import instrumentation
+import joint_series
+import parallel_ingest
+import parquet_store
+import payload_store
+import pipeline
+
+# Packet source: "native" walks the memory-mapped PCAP directly, "pyshark"
+# falls back to tshark (requires pyshark and Wireshark to be installed)
+PCAP_BACKEND = "native"
+
+# Prefilter rules for the native backend. The defaults are equivalent to the
+# pyshark display filter; e.g. allow_ports=[11311] would keep only ROS master
+# traffic.
+PREFILTER_RULES = pcap_filter.FilterRules()
+
+# Put ROS messages that are split over several TCP segments back together
+# before dissecting them. In the chunked mode a message split over two
+# chunks is lost.
+REASSEMBLE_TCP = True
+
+# Number of payloads whose dissected messages are kept, so the copies seen
+# by the other capture points and repeated messages are not dissected again
+# (0 turns the cache off). Every worker process has a cache of this size.
+DISSECTION_CACHE_SIZE = dissect_cache.DEFAULT_MAX_ENTRIES
+
+# Rows are buffered and written with executemany, one transaction per batch
+BATCH_SIZE = db_writer.DEFAULT_BATCH_SIZE
+FLUSH_INTERVAL = db_writer.DEFAULT_FLUSH_INTERVAL
+
+# Fill the DB with the journal off ("OFF") or in WAL mode ("WAL") and defer
+# index creation to the end of the ingest
+BULK_LOAD = True
+BULK_LOAD_JOURNAL_MODE = "OFF"
+
+# Number of worker processes. With more than one, the capture files are
+# parsed in parallel into shard DBs that are then merged into the unified DB.
+WORKERS = 1
+
+# With more than one worker, setting a chunk size (in bytes) switches to
+# splitting each capture into chunks that are dissected in parallel, which
+# helps when one capture is much larger than the others
+CHUNK_SIZE = None
+
+# Path of an existing DB to add the captures to instead of creating a new
+# one. Captures that were completely ingested before and have not changed
+# are skipped; an interrupted or grown capture resumes after the last frame
+# that was committed.
+INCREMENTAL_DB = None
+
+# Run the read, dissect and write stages of a sequential ingest (WORKERS = 1)
+# concurrently on an asyncio event loop, with ASYNC_QUEUE_DEPTH batches of
+# ASYNC_BATCH_SIZE packets between them (see async_pipeline.py). The stage
+# times and queue depths are reported for every capture.
+ASYNC_PIPELINE = False
+ASYNC_BATCH_SIZE = async_pipeline.DEFAULT_BATCH_SIZE
+ASYNC_QUEUE_DEPTH = async_pipeline.DEFAULT_QUEUE_DEPTH
+
+# Keep the TCP payloads in a store file next to the DB ("<db>-payloads"),
+# each distinct payload once, instead of as BLOBs in the packet tables (see
+# payload_store.py). Rows already in an INCREMENTAL_DB keep their BLOBs
+# until the DB is converted with migrate_db.py.
+PAYLOAD_STORE = True
+
+# Directory to also write the packets and typed ROS message tables to as
+# Parquet files (requires pyarrow), or None for the SQLite DB only
+PARQUET_DIR = None
+
+# Directory to write the JointState time series of every capture and arm to
+# (see joint_series.py), or None. The series are built while the captures are
+# read in this process; with WORKERS > 1 and no CHUNK_SIZE, the captures the
+# workers ingested get theirs from the unified DB once the shards are merged.
+JOINT_SERIES_DIR = None
+
+# Instrumentation: stage wall times, the time spent in each dissector per
+# message type, SQLite write time and a progress line every
+# PROGRESS_INTERVAL seconds. Off, nothing is hooked into the ingest.
+INSTRUMENT = False
+PROGRESS_INTERVAL = instrumentation.PROGRESS_INTERVAL
+# File to write the instrumentation results to (.json or .csv), or None
+REPORT_FILE = None
+# Profile the whole run with "cprofile" or "sampling" (requires INSTRUMENT),
+# or None. The profile is written next to REPORT_FILE.
+PROFILE_MODE = None
+
+
+def printFile(filename, pcap_filenumber):
     # Print the filename for diagnostics
     print ("\n[FOUND]: \"" + str(filename) + "\"")
-    
-    # Store the machine name for later reference
-    machine_name = filename.split('_')[0]
-    print ("Machine name: " + machine_name)
-    
-    # Insert it into the DB
-    filetuple = (str(filename), str(machine_name))
-    c.execute('''INSERT INTO pcapFiles VALUES (NULL, ?,?)''', filetuple)
-    c.execute('''SELECT last_insert_rowid()''')
-    pcap_filenumber = c.fetchone()[0]
-    print("File number: " + str(pcap_filenumber))
-
-    # Check the global header for proper format and the endianness
-    if unpack('>I', magic_num)[0] == 0xd4c3b2a1:
-        unpack_header = '<'
-    elif unpack('>I', magic_num)[0] == 0xa1b2c3d4:
-        unpack_header = '>'
-    else:
-        print ('This PCAP file doesn\'t seem right... exiting.')
-        exit()
-
-    detectedPackets = 0
-    dissectedPackets = 0
-	
-     # Filter for packets in pyshark (exactly as would be entered into Wireshark filter GUI)
-     # The filter "tcp && !nfs && !ssh &&!http && !ntp && tcp.flags == 0x0018" removes most
-     # unwanted packets that have been encountered during normal robotic enclave operation
-    pyshark_filter = "tcp && !nfs && !ssh && !http && !ntp && !ethercat && tcp.flags == 0x0018 && data"
-	
-    captureFile = pyshark.FileCapture(filename, display_filter=pyshark_filter)
-    for packet in captureFile:
-        
-        try:
-            detectedPackets += 1
-            
-            md5_string = (packet.eth.dst, packet.eth.src, packet.ip.dst, packet.ip.src, packet.tcp.dstport, packet.tcp.srcport, \
-                          packet.tcp.seq, packet.tcp.nxtseq, packet.tcp.ack, packet.data.data.binary_value, packet.data.len)
-            md5_string = bytes(str(md5_string),'utf-8')
-            packet_md5 = hashlib.md5(md5_string).hexdigest()
-            
-            packetTuple = ( packet.sniff_timestamp, pcap_filenumber, packet.frame_info.number, packet.eth.dst, packet.eth.src, \
-                    packet.ip.dst, packet.ip.src, packet.tcp.dstport, packet.tcp.srcport, packet.tcp.seq, \
-                    packet.tcp.nxtseq, packet.tcp.ack, packet.tcp.checksum, packet.tcp.analysis_initial_rtt, \
-                    packet.data.data.binary_value, packet.data.len, packet_md5)
-            
-            c.execute('''INSERT INTO packets VALUES (NULL, ?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''', packetTuple)
-            curr_id = c.lastrowid
-    
-            # Run the packet data through the dissector to determine if it is a ROS
-            # packet of the types we are looking for, and if so store the data
-            packetData = rosDisector.dissectPacket(unpack_header, packet.data.data.binary_value)
-            
-            # Did the function return data? No data means it was not able to dissect
-            if len(packetData) > 0:
-                dissectedPackets += 1
-                for msg in packetData:
-                    rosTuple = ( curr_id, packet.frame_info.number, packet.data.data.binary_value, packet.data.len, str(msg), packet_md5)
-                    c.execute('''INSERT INTO rosPackets VALUES (NULL, ?,?,?,?,?,?)''', rosTuple)
-            else:
-                packetTuple = ( curr_id, packet.frame_info.number, packet.data.data.binary_value)
-                c.execute('''INSERT INTO unclassifiedROSMessages VALUES (NULL, ?,?,?)''', packetTuple)
-                # Then we will insert all of this into the database
-                
-        except:
-            pass
-        
-    successPercent = (dissectedPackets/detectedPackets)*100
-    print(  "Successfully dissected " + str(dissectedPackets) + " out of " + str(detectedPackets) + \
-            " packets ({0:.2f}".format(successPercent) + "%) in " + str(filename))
-    
-    # Commit the changes we have made to the DB before we open a new file
-    conn.commit()
-    #print("[DONE]")
-    
-c.execute('''SELECT last_insert_rowid()''')
-pcap_filenumber = c.fetchone()[0]
-
-# Now we have a database and a PCAP file with the same data, close everything!
-conn.close()
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+    print ("Machine name: " + ingest.machineName(filename))
+    print ("File number: " + str(pcap_filenumber))
+
+
+def planFiles(c, filenames):
+    # Returns [(filename, file number or None, resumeAfter)] for the captures
+    # that still need to be ingested. New captures have no file number yet.
+    plan = []
+    for filename in filenames:
+        file_fingerprint = ingest.fileFingerprint(filename)
+        found = ingest.findFile(c, filename, file_fingerprint)
+        if found is None:
+            plan.append((filename, None, 0))
+        elif found[2] == "done":
+            print ("\n[SKIPPED]: \"" + str(filename) + "\" was already ingested as file number " + str(found[0]))
+        else:
+            print ("\n[RESUMING]: \"" + str(filename) + "\" after frame " + str(found[1]))
+            plan.append((filename, found[0], found[1]))
+    return plan
+
+
+def startFile(c, filename, pcap_filenumber):
+    # Register a new capture, or reuse the file number of a resumed one
+    if pcap_filenumber is None:
+        pcap_filenumber = ingest.registerFile(c, filename, fingerprint=ingest.fileFingerprint(filename))
+    printFile(filename, pcap_filenumber)
+    return pcap_filenumber
+
+
+def reportFile(instr, stats):
+    instr.addFile(stats)
+    for line in stats.report():
+        print(line)
+
+
+def main():
+    instr = instrumentation.Instrumentation("pcap_to_db", INSTRUMENT, PROGRESS_INTERVAL, PROFILE_MODE)
+    instr.start()
+    try:
+        ingestCaptures(instr)
+    finally:
+        instr.stop()
+    if INSTRUMENT:
+        print ("")
+        for line in instr.summary() + instr.profileSummary():
+            print(line)
+        if REPORT_FILE:
+            instr.writeReport(REPORT_FILE)
+            print ("Instrumentation written to \"" + str(REPORT_FILE) + "\"")
+
+
+def ingestCaptures(instr):
+    with instr.stage("setup"):
+        if INCREMENTAL_DB:
+            db_filename = INCREMENTAL_DB
+        else:
+            # Create the DB with the current date and time
+            curr_date = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+            db_filename = "unified_" + curr_date + ".db"
+        # The async write stage uses the connection from its own thread
+        conn = ingest.createDatabase(db_filename, check_same_thread=not ASYNC_PIPELINE)
+        c = conn.cursor()
+        payloads = payload_store.PayloadStore(payload_store.storePath(db_filename)) if PAYLOAD_STORE else None
+
+        # Bulk-load mode: relaxed journal/sync settings while filling the DB, with
+        # analyze.py's indexes built once at the end. An incremental ingest keeps
+        # a journal (WAL) so an interrupted run leaves a usable DB to resume.
+        if BULK_LOAD:
+            db_schema.beginBulkLoad(conn, "WAL" if INCREMENTAL_DB else BULK_LOAD_JOURNAL_MODE)
+
+        # Iterate through the current directory for all PCAP files
+        filenames = glob.glob(".\YoubotCycle1\*.pcap")
+        plan = planFiles(c, filenames)
+        cache = dissect_cache.DissectionCache(DISSECTION_CACHE_SIZE) if DISSECTION_CACHE_SIZE > 0 else None
+
+    writer = db_writer.BatchWriter(conn, BATCH_SIZE, FLUSH_INTERVAL, payloads)
+    instr.watchWriter(writer)
+    sinks = [pipeline.SqliteSink(writer)]
+    if JOINT_SERIES_DIR:
+        sinks.append(joint_series.JointSeriesSink(JOINT_SERIES_DIR, conn))
+    time_dissectors = instr.dissectors is not None
+    # File numbers of the captures ingested into shard DBs
+    shardFiles = []
+    with instr.stage("ingest") as stage:
+        if WORKERS > 1 and CHUNK_SIZE:
+            with parallel_ingest.ProcessPoolExecutor(max_workers=WORKERS) as pool:
+                for filename, pcap_filenumber, resumeAfter in plan:
+                    pcap_filenumber = startFile(c, filename, pcap_filenumber)
+                    stats = parallel_ingest.ingestFileChunked(writer, filename, pcap_filenumber, pool, WORKERS,
+                                                              CHUNK_SIZE, PREFILTER_RULES, resumeAfter,
+                                                              REASSEMBLE_TCP, cache, time_dissectors, sinks)
+                    reportFile(instr, stats)
+        elif WORKERS > 1:
+            # Resumed captures continue in this process, new ones go to the pool
+            for filename, pcap_filenumber, resumeAfter in plan:
+                if pcap_filenumber is not None:
+                    printFile(filename, pcap_filenumber)
+                    stats = pipeline.runFile(sinks, filename, pcap_filenumber, PCAP_BACKEND, PREFILTER_RULES,
+                                             resumeAfter, REASSEMBLE_TCP, cache)
+                    reportFile(instr, stats)
+            newFiles = [filename for filename, pcap_filenumber, resumeAfter in plan if pcap_filenumber is None]
+            allStats = parallel_ingest.ingestParallel(conn, newFiles, WORKERS, PCAP_BACKEND, PREFILTER_RULES,
+                                                      BATCH_SIZE, FLUSH_INTERVAL, reassemble=REASSEMBLE_TCP,
+                                                      cache_size=DISSECTION_CACHE_SIZE,
+                                                      time_dissectors=time_dissectors, payloads=payloads)
+            for stats in allStats:
+                if cache is not None:
+                    cache.addCounters(stats.dissectionCache)
+                printFile(stats.filename, stats.file_id)
+                reportFile(instr, stats)
+                shardFiles.append(stats.file_id)
+            print ("")
+            for line in parallel_ingest.workerReport(allStats):
+                print(line)
+        else:
+            for filename, pcap_filenumber, resumeAfter in plan:
+                # Insert it into the DB
+                pcap_filenumber = startFile(c, filename, pcap_filenumber)
+                try:
+                    if ASYNC_PIPELINE:
+                        stats = async_pipeline.runFile(sinks, filename, pcap_filenumber, PCAP_BACKEND,
+                                                       PREFILTER_RULES, resumeAfter, REASSEMBLE_TCP, cache,
+                                                       ASYNC_BATCH_SIZE, ASYNC_QUEUE_DEPTH)
+                    else:
+                        stats = pipeline.runFile(sinks, filename, pcap_filenumber, PCAP_BACKEND, PREFILTER_RULES,
+                                                 resumeAfter, REASSEMBLE_TCP, cache)
+                except pcap_reader.PcapFormatError:
+                    print ('This PCAP file doesn\'t seem right... exiting.')
+                    exit()
+                reportFile(instr, stats)
+        stage.packets = sum(f['packets'] for f in instr.files)
+        stage.bytes = sum(f['bytes'] for f in instr.files)
+
+    if cache is not None:
+        print ("\n" + cache.summary())
+    if payloads is not None:
+        print (payloads.summary())
+
+    if BULK_LOAD:
+        print ("\nBuilding indexes...", end='')
+        with instr.stage("indexes"):
+            db_schema.endBulkLoad(conn)
+        print (" [DONE]")
+
+    if JOINT_SERIES_DIR and shardFiles:
+        # After the indexes, which the lookup of the typed rows by fingerprint uses
+        print ("\nWriting JointState series to \"" + str(JOINT_SERIES_DIR) + "\"...", end='')
+        with instr.stage("joint_series") as stage:
+            samples = sum(joint_series.writeStoredSeries(conn, JOINT_SERIES_DIR, file_id) for file_id in shardFiles)
+            stage.packets = samples
+        print (" [DONE] " + str(samples) + " samples")
+
+    if PARQUET_DIR:
+        print ("\nWriting Parquet files to \"" + str(PARQUET_DIR) + "\"...", end='')
+        with instr.stage("parquet") as stage:
+            rows = parquet_store.exportDatabase(conn, PARQUET_DIR, payloads=payloads)
+            stage.packets = sum(rows.values())
+        print (" [DONE] " + str(sum(rows.values())) + " rows")
+
+    # Now we have a database and a PCAP file with the same data, close everything!
+    conn.close()
+    if payloads is not None:
+        payloads.close()
+
+
+if __name__ == "__main__":
+    main()
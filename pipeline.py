@@ -0,0 +1,313 @@
+#
+# Author:       Timothy Zimmerman (timothy.zimmerman@nist.gov)
+# Organization: National Institute of Standards and Technology
+#               U.S. Department of Commerce
+# License:      Public Domain
+#
+# Description:  The ingest as a chain of lazy generators, so the captures can
+#               be read and dissected without going through the unified DB:
+#
+#                   iterFrames        frames accepted by the prefilter
+#                   iterTcpPayloads   their TCP payloads, fingerprinted
+#                   iterRosMessages   the ROS messages in every payload
+#
+#               and sinks that consume the dissected packets: SqliteSink (the
+#               unified DB, as pcap_to_db.py writes it), ParquetSink (the
+#               tables parquet_store.py exports, written directly), CsvSink
+#               (one message type as CSV) and CallbackSink. Only one packet
+#               and the sinks' batches are held at a time, so memory does not
+#               grow with the size of a capture. Importing this module opens
+#               nothing.
+#
+#               Usage:
+#
+#                   for unpack_header, packet, fingerprint, messages in \
+#                           pipeline.iterRosMessages(pipeline.iterTcpPayloads(
+#                               pipeline.iterFrames("robot1.pcap"))):
+#                       ...
+#
+#                   pipeline.run(["robot1.pcap"], [pipeline.CsvSink("joints.csv")])
+#
+
+import csv
+import os
+import time
+from collections import namedtuple
+import db_writer
+import ingest
+import parquet_store
+import pcap_filter
+import pcap_reader
+import ros_msg_dissector as rosDisector
+import tcp_reassembly
+
+# Items passed down the chain; each stage adds a field
+CaptureFrame = namedtuple('CaptureFrame', 'unpack_header packet')
+TcpPayload = namedtuple('TcpPayload', 'unpack_header packet fingerprint')
+DissectedPacket = namedtuple('DissectedPacket', 'unpack_header packet fingerprint messages')
+
+# Message records by ros_msg_type, for CsvSink
+MESSAGE_RECORDS = dict((record.ros_msg_type, record) for record in (
+    rosDisector.JointStateMsg, rosDisector.BricsPositionMsg, rosDisector.RosgraphDebugMsg,
+    rosDisector.DependencyMsg, rosDisector.GripperMsg))
+
+
+def iterFrames(path, packetFilter=None, backend="native", resumeAfter=0):
+    # Yield a CaptureFrame for every frame the prefilter accepts (see
+    # pcap_reader.iterFrames), skipping the frames up to resumeAfter. The
+    # pyshark backend applies its display filter instead. Raises
+    # pcap_reader.PcapFormatError if the file does not look like a PCAP.
+    unpack_header = ingest.readEndianness(path)
+    if backend == "pyshark":
+        frames = pcap_reader.iterPysharkFrames(path)
+    else:
+        frames = pcap_reader.iterFrames(path, packetFilter)
+    for packet in frames:
+        if packet.number <= resumeAfter:
+            continue
+        yield CaptureFrame(unpack_header, packet)
+
+
+def iterTcpPayloads(frames):
+    # Yield a TcpPayload for every frame that carries data. The payload is a
+    # view into the capture, valid while the packet is referenced.
+    for unpack_header, packet in frames:
+        if packet.data_len:
+            yield TcpPayload(unpack_header, packet, ingest.fingerprint(packet))
+
+
+def iterRosMessages(payloads, reassembler=None, cache=None):
+    # Yield a DissectedPacket for every payload. messages is the list of ROS
+    # messages found in it, empty if there were none and None if the
+    # dissector failed. With a tcp_reassembly.StreamReassembler, messages
+    # split over several segments are put back together and come with the
+    # segment that completed them. cache is an optional
+    # dissect_cache.DissectionCache.
+    for unpack_header, packet, packet_fingerprint in payloads:
+        if reassembler is not None:
+            messages = reassembler.feed(unpack_header, packet)
+        else:
+            messages = ingest.dissectFrame(unpack_header, packet, cache)
+        yield DissectedPacket(unpack_header, packet, packet_fingerprint, messages)
+
+
+class Sink:
+    # Consumes the DissectedPackets of one capture after another. beginFile
+    # and endFile get the ingest.FileStats of the capture; a sink that
+    # numbers the captures sets its file_id if it is still None.
+
+    def beginFile(self, stats):
+        pass
+
+    def write(self, item):
+        pass
+
+    def endFile(self, stats):
+        pass
+
+    def close(self):
+        pass
+
+
+class SqliteSink(Sink):
+    # Stores the packets in the unified DB through a db_writer.BatchWriter,
+    # with the pcapFiles checkpoints of an incremental ingest. The connection
+    # belongs to the caller.
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.file_id = None
+        self.file_fingerprint = None
+
+    def beginFile(self, stats):
+        self.file_fingerprint = ingest.fileFingerprint(stats.filename)
+        if stats.file_id is None:
+            stats.file_id = ingest.registerFile(self.writer.conn.cursor(), stats.filename,
+                                                fingerprint=self.file_fingerprint)
+        self.file_id = stats.file_id
+        self.writer.resetStats()
+
+    def write(self, item):
+        ingest.storeFrame(self.writer, item.packet, self.file_id, item.fingerprint, item.messages)
+        self.writer.maybeFlush()
+
+    def endFile(self, stats):
+        # Commit the changes we have made to the DB before we open a new file
+        self.writer.flush()
+        ingest.completeFile(self.writer.conn.cursor(), self.file_id, self.file_fingerprint)
+        self.writer.conn.commit()
+        stats.writerSummary = self.writer.summary()
+        stats.writeTime = self.writer.flushTime
+
+    def close(self):
+        self.writer.flush()
+
+
+class ParquetSink(Sink):
+    # Writes the tables of parquet_store.EXPORT_TABLES to a directory without
+    # a unified DB. The rows are built as for SqliteSink in an in-memory DB
+    # that is emptied into the Parquet files every row_group_size packets,
+    # so the files hold what exporting the unified DB would give. Requires
+    # pyarrow.
+
+    def __init__(self, directory, row_group_size=parquet_store.DEFAULT_ROW_GROUP_SIZE,
+                 compression=parquet_store.DEFAULT_COMPRESSION):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.row_group_size = row_group_size
+        self.conn = ingest.createDatabase(":memory:")
+        c = self.conn.cursor()
+        self.tables = dict((table, parquet_store.TableWriter(c, directory, table, compression))
+                           for table in parquet_store.EXPORT_TABLES)
+        self.writer = db_writer.BatchWriter(self.conn, row_group_size, float('inf'))
+        self.file_id = None
+
+    def beginFile(self, stats):
+        c = self.conn.cursor()
+        if stats.file_id is None:
+            stats.file_id = c.execute('''SELECT IFNULL(MAX(id), 0) + 1 FROM pcapFiles''').fetchone()[0]
+        self.file_id = ingest.registerFile(c, stats.filename, fingerprint=ingest.fileFingerprint(stats.filename),
+                                           file_id=stats.file_id)
+
+    def write(self, item):
+        ingest.storeFrame(self.writer, item.packet, self.file_id, item.fingerprint, item.messages)
+        flushes = self.writer.flushes
+        self.writer.maybeFlush()
+        if self.writer.flushes != flushes:
+            self.moveRows()
+
+    def moveRows(self):
+        # Append the flushed rows to the Parquet files and drop them
+        c = self.conn.cursor()
+        for table, tableWriter in self.tables.items():
+            if table == 'pcapFiles':
+                continue
+            tableWriter.write(c.execute('''SELECT ''' + ', '.join(tableWriter.schema.names) + ''' FROM ''' + \
+                                        table + ''' ORDER BY id''').fetchall(), self.row_group_size)
+            c.execute('''DELETE FROM ''' + table)
+        c.execute('''DELETE FROM rosPackets''')
+        c.execute('''DELETE FROM unclassifiedROSMessages''')
+        self.conn.commit()
+
+    def endFile(self, stats):
+        self.writer.flush()
+        self.moveRows()
+        ingest.completeFile(self.conn.cursor(), self.file_id)
+        self.conn.commit()
+
+    def close(self):
+        self.writer.flush()
+        self.moveRows()
+        tableWriter = self.tables['pcapFiles']
+        tableWriter.write(self.conn.execute('''SELECT ''' + ', '.join(tableWriter.schema.names) + \
+                                            ''' FROM pcapFiles ORDER BY id''').fetchall())
+        for tableWriter in self.tables.values():
+            tableWriter.close()
+        self.conn.close()
+
+
+def csvValue(value):
+    if value is None:
+        return ''
+    if isinstance(value, (tuple, list)):
+        return ' '.join(str(csvValue(v)) for v in value)
+    if isinstance(value, (bytes, memoryview)):
+        return bytes(value).decode('utf-8', 'replace')
+    return value
+
+
+class CsvSink(Sink):
+    # One row per message of msg_type (a ros_msg_dissector.ROS_PACKET_TYPES
+    # name) with the packet it came in and the fields of the message. Every
+    # copy of a message is written, with the file it was captured in.
+
+    PACKET_COLUMNS = ('file_id', 'frame', 'timestamp', 'ip_src', 'tcp_srcport', 'ip_dst', 'tcp_dstport',
+                      'fingerprint')
+
+    def __init__(self, path, msg_type="JointStateMsg"):
+        self.msg_type = msg_type
+        self.file = open(path, 'w', newline='')
+        self.out = csv.writer(self.file)
+        self.out.writerow(self.PACKET_COLUMNS + MESSAGE_RECORDS[msg_type]._fields)
+        self.file_id = None
+
+    def beginFile(self, stats):
+        self.file_id = stats.file_id
+
+    def write(self, item):
+        if not item.messages:
+            return
+        packet = item.packet
+        for msg in item.messages:
+            if msg.ros_msg_type == self.msg_type:
+                self.out.writerow((self.file_id, packet.number, packet.timestamp, packet.ip_src, packet.tcp_srcport,
+                                   packet.ip_dst, packet.tcp_dstport, item.fingerprint) + \
+                                  tuple(csvValue(value) for value in msg))
+
+    def close(self):
+        self.file.close()
+
+
+class CallbackSink(Sink):
+    # Calls callback(DissectedPacket) for every packet
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def write(self, item):
+        self.callback(item)
+
+
+def runFile(sinks, filename, file_id=None, backend="native", rules=None, resumeAfter=0, reassemble=False,
+            cache=None):
+    # Run one capture through the chain into every sink and return its
+    # ingest.FileStats. resumeAfter is the pcapFiles.last_frame of an
+    # interrupted ingest; the frames up to it are skipped. With reassemble
+    # set, messages split over several TCP segments are put back together.
+    # cache is an optional dissect_cache.DissectionCache, which may be
+    # shared by several files.
+    stats = ingest.FileStats(filename, file_id)
+    stats.resumeAfter = resumeAfter
+    start = time.monotonic()
+    for sink in sinks:
+        sink.beginFile(stats)
+
+    # The native reader applies the same rules as the pyshark display filter
+    # ("tcp && !nfs && !ssh && !http && !ntp && !ethercat && tcp.flags == 0x0018 && data"),
+    # which removes most unwanted packets that have been encountered during
+    # normal robotic enclave operation. When reassembling, the ACK-only
+    # segments that lead a split message are let through as well.
+    packetFilter = pcap_filter.PacketFilter(rules, reassemble)
+    reassembler = tcp_reassembly.StreamReassembler(cache=cache) if reassemble else None
+    frames = iterFrames(filename, packetFilter, backend, resumeAfter)
+    for item in iterRosMessages(iterTcpPayloads(frames), reassembler, cache):
+        ingest.countFrame(stats, item.packet, item.messages)
+        for sink in sinks:
+            sink.write(item)
+
+    for sink in sinks:
+        sink.endFile(stats)
+    stats.elapsed = time.monotonic() - start
+    if backend != "pyshark":
+        stats.filterSummary = packetFilter.summary()
+    if reassembler is not None:
+        reassembler.close()
+        stats.reassemblySummary = reassembler.summary()
+    return stats
+
+
+def ingestFile(writer, filename, pcap_filenumber, backend="native", rules=None, resumeAfter=0, reassemble=False,
+               cache=None):
+    # runFile into the unified DB of a db_writer.BatchWriter
+    return runFile([SqliteSink(writer)], filename, pcap_filenumber, backend, rules, resumeAfter, reassemble, cache)
+
+
+def run(filenames, sinks, backend="native", rules=None, reassemble=False, cache=None):
+    # Run the captures one after another into the sinks and close them.
+    # Returns the FileStats of every capture.
+    try:
+        return [runFile(sinks, filename, None, backend, rules, 0, reassemble, cache) for filename in filenames]
+    finally:
+        for sink in sinks:
+            sink.close()
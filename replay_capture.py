@@ -0,0 +1,80 @@
+#
+# Author:       Timothy Zimmerman (timothy.zimmerman@nist.gov)
+# Organization: National Institute of Standards and Technology
+#               U.S. Department of Commerce
+# License:      Public Domain
+#
+# Description:  Test harness for live_ingest.py: replays a recorded capture
+#               into a file or onto standard output at its recorded pace,
+#               sped up, or as fast as possible. The packets are stamped with
+#               the time they are replayed at, so the latency reported by
+#               live_ingest.py is measured from the replay.
+#
+#               Usage: python replay_capture.py <capture.pcap> <out.pcap | -> [speed]
+#
+#               speed 1 replays in real time, 10 ten times faster and 0 as
+#               fast as possible. For example:
+#
+#                   python replay_capture.py robot1.pcap - 10 | python live_ingest.py - live.db
+#
+
+import sys
+import time
+from struct import Struct
+import pcap_reader
+
+
+def replay(filename, out, speed=1.0, clock=time.time, sleep=time.sleep):
+    # Write the capture to the binary file object out, flushing after every
+    # packet. Returns the number of packets written.
+    mm = pcap_reader.openCapture(filename)
+    try:
+        unpack_header, ts_divisor, linktype = pcap_reader.readGlobalHeader(mm)
+        record = Struct(unpack_header + 'IIII')
+        out.write(mm[:pcap_reader.PCAP_GLOBAL_HEADER_LEN])
+        out.flush()
+
+        firstTime = None
+        replayStart = clock()
+        packets = 0
+        for frameNum, ts_sec, ts_frac, offset, caplen in pcap_reader.iterRecords(mm, unpack_header):
+            timestamp = ts_sec + ts_frac / ts_divisor
+            if firstTime is None:
+                firstTime = timestamp
+            if speed > 0:
+                due = replayStart + (timestamp - firstTime) / speed
+                wait = due - clock()
+                if wait > 0:
+                    sleep(wait)
+            now = clock()
+            orig_len = record.unpack_from(mm, offset - pcap_reader.PCAP_RECORD_HEADER_LEN)[3]
+            out.write(record.pack(int(now), int((now % 1) * ts_divisor), caplen, orig_len))
+            out.write(mm[offset:offset + caplen])
+            out.flush()
+            packets += 1
+    finally:
+        pcap_reader.closeCapture(mm)
+    return packets
+
+
+def main(argv):
+    if len(argv) < 3:
+        print ("Usage: python replay_capture.py <capture.pcap> <out.pcap | -> [speed]")
+        return
+    speed = float(argv[3]) if len(argv) > 3 else 1.0
+    if argv[2] == "-":
+        out = sys.stdout.buffer
+    else:
+        out = open(argv[2], 'wb')
+    try:
+        packets = replay(argv[1], out, speed)
+    except BrokenPipeError:
+        return
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+    print ("Replayed " + str(packets) + " packets", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
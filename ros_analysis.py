@@ -0,0 +1,237 @@
+#
+# Author:       Timothy Zimmerman (timothy.zimmerman@nist.gov)
+# Organization: National Institute of Standards and Technology
+#               U.S. Department of Commerce
+# License:      Public Domain
+#
+# Description:  Analysis stages run by analyze.py over the unified database.
+#               Each stage reads its input with a single streaming query and
+#               writes its results with executemany, replacing whatever an
+#               earlier run of the stage left in its output table.
+#
+
+from itertools import groupby
+import db_schema
+import ingest
+
+# numpy is optional; without it the Brics change masks are computed with a
+# plain Python loop
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Number of result rows buffered before they are written to the DB
+ANALYSIS_BATCH_SIZE = 10000
+
+
+def pairSightings(sightings):
+    # sightings are the (id, timestamp, file_id) of one packet, in time
+    # order. Returns ([(id_1, id_2, time_1, time_2, delta_t)], [misplaced id]).
+    #
+    # A single sighting was only seen at one capture point. Two sightings are
+    # the originator and its received copy. With more than two (the packet
+    # was captured at several points) the earliest sighting is the originator
+    # and it is paired with the first sighting at every other capture point;
+    # later sightings at an already paired capture point are misplaced.
+    if len(sightings) == 1:
+        return [], [sightings[0][0]]
+    origin = sightings[0]
+    if len(sightings) == 2:
+        other = sightings[1]
+        return [(origin[0], other[0], origin[1], other[1], abs(other[1] - origin[1]))], []
+    matches = []
+    misplaced = []
+    seenFiles = set([origin[2]])
+    for other in sightings[1:]:
+        if other[2] in seenFiles:
+            misplaced.append(other[0])
+        else:
+            seenFiles.add(other[2])
+            matches.append((origin[0], other[0], origin[1], other[1], abs(other[1] - origin[1])))
+    return matches, misplaced
+
+
+def prepareDatabase(conn):
+    # Create whatever tables and indexes the stages need and fill in the
+    # fingerprints of packets stored with only an md5_hash, as migrate_db.py
+    # does, so every packet of the DB is matched by the same key. For a DB
+    # written by pcap_to_db.py this is a no-op.
+    c = conn.cursor()
+    db_schema.upgradeIngestTables(c)
+    packets = ingest.backfillFingerprints(conn)
+    db_schema.createAnalysisTables(c)
+    db_schema.createIndexes(c)
+    conn.commit()
+    return packets
+
+
+def matchKey(conn):
+    # Column that identifies the copies of a packet: the fingerprint, or the
+    # md5_hash for the whole DB if any packet lacks a fingerprint, which only
+    # happens to DBs from before the fingerprint that were not opened with
+    # prepareDatabase or migrate_db.py
+    columns = set(row[1] for row in conn.execute('''PRAGMA table_info(packets)'''))
+    if 'fingerprint' not in columns:
+        return 'md5_hash'
+    if conn.execute('''SELECT 1 FROM packets WHERE fingerprint IS NULL LIMIT 1''').fetchone() is not None:
+        return 'md5_hash'
+    return 'fingerprint'
+
+
+def matchPackets(conn):
+    # Pair the originator of every packet with its received copies and store
+    # the time-of-flight in matchingPackets. Returns (matches, misplaced).
+    c = conn.cursor()
+    c.execute('''DELETE FROM matchingPackets''')
+    c.execute('''DELETE FROM misplacedPackets''')
+
+    key = matchKey(conn)
+    reader = conn.cursor()
+    reader.execute('''SELECT ''' + key + ''', id, shark_timestamp, shark_file_id FROM packets \
+                      ORDER BY ''' + key + ''', shark_timestamp, id''')
+
+    matchRows = []
+    misplacedRows = []
+    totalMatches = 0
+    totalMisplaced = 0
+    for packet_key, rows in groupby(reader, key=lambda row: row[0]):
+        matches, misplaced = pairSightings([row[1:] for row in rows])
+        matchRows.extend(matches)
+        misplacedRows.extend((packet_id,) for packet_id in misplaced)
+        if len(matchRows) + len(misplacedRows) >= ANALYSIS_BATCH_SIZE:
+            totalMatches += len(matchRows)
+            totalMisplaced += len(misplacedRows)
+            c.executemany('''INSERT INTO matchingPackets VALUES (NULL,?,?,?,?,?)''', matchRows)
+            c.executemany('''INSERT INTO misplacedPackets VALUES (NULL,?)''', misplacedRows)
+            matchRows = []
+            misplacedRows = []
+
+    totalMatches += len(matchRows)
+    totalMisplaced += len(misplacedRows)
+    c.executemany('''INSERT INTO matchingPackets VALUES (NULL,?,?,?,?,?)''', matchRows)
+    c.executemany('''INSERT INTO misplacedPackets VALUES (NULL,?)''', misplacedRows)
+    conn.commit()
+    return totalMatches, totalMisplaced
+
+
+def changeMask(positions):
+    # positions are the rows of joint 1..5 values of one arm, in time order.
+    # Returns a flag per row: True if any value differs from the previous row
+    # (the first row is compared to all zeros). positions may be a numpy
+    # array.
+    if len(positions) == 0:
+        return []
+    if numpy is not None:
+        values = numpy.array(positions, dtype=numpy.float64)
+        previous = numpy.vstack((numpy.zeros((1, values.shape[1])), values[:-1]))
+        return (values != previous).any(axis=1).tolist()
+    mask = []
+    previous = (0, 0, 0, 0, 0)
+    for row in positions:
+        mask.append(row != previous)
+        previous = row
+    return mask
+
+
+def markUniqueBrics(conn, arms=(1, 2)):
+    # Set delta = 1 on every Brics position message that commands a new
+    # position, and delta = 0 on repeats. Returns the number of unique
+    # commands.
+    c = conn.cursor()
+    unique = 0
+    for arm_num in arms:
+        c.execute('''SELECT ros_BricsPositionMessages.id, arm_joint_1_value, arm_joint_2_value, \
+                     arm_joint_3_value, arm_joint_4_value, arm_joint_5_value FROM ros_BricsPositionMessages \
+                     INNER JOIN packets WHERE ros_BricsPositionMessages.parent_id = packets.id AND \
+                     ros_BricsPositionMessages.ros_arm_num = ? \
+                     ORDER BY packets.shark_timestamp ASC, ros_BricsPositionMessages.id ASC''', (arm_num,))
+        rows = c.fetchall()
+        mask = changeMask([tuple(row[1:]) for row in rows])
+        changed = [(row[0],) for row, flag in zip(rows, mask) if flag]
+        c.execute('''UPDATE ros_BricsPositionMessages SET delta = 0 WHERE ros_arm_num = ?''', (arm_num,))
+        c.executemany('''UPDATE ros_BricsPositionMessages SET delta = 1 WHERE id = ?''', changed)
+        unique += len(changed)
+    conn.commit()
+    return unique
+
+
+# Movement tolerance of 1 degree
+MOVE_TOLERANCE = 0.0174
+
+
+def moveStart(jointStates, tolerance=MOVE_TOLERANCE):
+    # jointStates are the (parent_id, joint 1..4 values, timestamp) after one
+    # Brics command. Returns the first one where a joint is more than the
+    # tolerance away from the first joint state, or None. Joint 5 is not
+    # compared because one of the robots currently has encoder issues.
+    first = jointStates[0]
+    for m in jointStates:
+        if abs(m[1] - first[1]) > tolerance or \
+           abs(m[2] - first[2]) > tolerance or \
+           abs(m[3] - first[3]) > tolerance or \
+           abs(m[4] - first[4]) > tolerance:
+            return m
+    return None
+
+
+def jointResponseTimes(conn, arm_num, tolerance=MOVE_TOLERANCE):
+    # Merge the unique Brics commands of one arm with its joint states, both
+    # in parent_id order, and yield (brics parent_id, joint state parent_id,
+    # delay) for every command followed by a move. The joint states of a
+    # command are the ones strictly between it and the next unique command;
+    # the last command has no such window and is skipped.
+    c = conn.cursor()
+    c.execute('''SELECT parent_id, shark_timestamp from ros_BricsPositionMessages \
+                 INNER JOIN packets WHERE ros_BricsPositionMessages.parent_id = packets.id \
+                 AND ros_BricsPositionMessages.delta = 1 AND ros_BricsPositionMessages.ros_arm_num = ? \
+                 ORDER BY ros_BricsPositionMessages.parent_id ASC''', (arm_num,))
+    brics_messages = [tuple(row) for row in c.fetchall()]
+    commandIds = sorted(set(row[0] for row in brics_messages))
+    nextCommand = dict(zip(commandIds, commandIds[1:]))
+
+    # DBs written while short position arrays were stored may have NULL
+    # positions; those joint states are left out
+    c.execute('''SELECT parent_id, arm_joint_1_value, arm_joint_2_value, \
+                 arm_joint_3_value, arm_joint_4_value, shark_timestamp \
+                 FROM ros_JointStateMessages INNER JOIN packets \
+                 WHERE ros_JointStateMessages.parent_id = packets.id \
+                 AND ros_JointStateMessages.ros_arm_num = ? \
+                 AND arm_joint_1_value IS NOT NULL AND arm_joint_2_value IS NOT NULL \
+                 AND arm_joint_3_value IS NOT NULL AND arm_joint_4_value IS NOT NULL \
+                 ORDER BY ros_JointStateMessages.parent_id ASC, ros_JointStateMessages.id ASC''', (arm_num,))
+    jointStates = iter(c)
+    m = next(jointStates, None)
+
+    # The commands of one packet share a window, so it is only read once
+    window = []
+    windowStart = None
+    for parent_id, brics_packet_time in brics_messages:
+        next_id = nextCommand.get(parent_id)
+        if next_id is None:
+            continue
+        if parent_id != windowStart:
+            windowStart = parent_id
+            window = []
+            while m is not None and m[0] <= parent_id:
+                m = next(jointStates, None)
+            while m is not None and m[0] < next_id:
+                window.append(m)
+                m = next(jointStates, None)
+        if window:
+            move = moveStart(window, tolerance)
+            if move is not None:
+                yield parent_id, move[0], abs(move[5] - brics_packet_time)
+
+
+def responseTimes(conn, arms=(1, 2), tolerance=MOVE_TOLERANCE):
+    # Time from every unique Brics command to the start of the move, stored
+    # in analyze_JointResponseTimes. Returns the number of rows.
+    c = conn.cursor()
+    c.execute('''DELETE FROM analyze_JointResponseTimes''')
+    rows = []
+    for arm_num in arms:
+        rows.extend(jointResponseTimes(conn, arm_num, tolerance))
+    c.executemany('''INSERT INTO analyze_JointResponseTimes VALUES (NULL,?,?,?)''', rows)
+    conn.commit()
+    return len(rows)
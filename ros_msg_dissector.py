@@ -8,7 +8,20 @@
 #
 
 from string import *
-from struct import *
+from collections import namedtuple
+from functools import lru_cache
+from struct import Struct, error as StructError
+
+# NumPy is optional and only used by dissectJointStateBatch, which decodes
+# the arrays of many messages into one ndarray. A single message's float
+# arrays are decoded with one struct unpack per array: for the few joints of
+# an arm that is several times faster than numpy.frombuffer(...).tolist(),
+# which only catches up at about a thousand values, far more than fit in a
+# message the JointState dissector accepts.
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # List of lists that specifies specific message text to look for in the 
 # packet data for identification. Format: [id, [idx, "text"], ... , [idx, "text"]]
@@ -30,277 +43,367 @@ ROS_PACKETS = [ [0, [28, "arm_joint_1"], [43, "arm_joint_2"]],      # JointState
 ]  
 ROS_PACKET_TYPES = "JointStateMsg", "BricsPositionMsg", "rosgraphDebugMsg", "DependencyMsg", "GripperMsg"
 
-def dissectJointStateMsg(unpack_header, packet_data):
+# Typed records returned by the dissectors, one per message type. Joint names
+# are stored without the "_2_" of the second arm (e.g. "arm_joint_1"), with
+# the arm number in ros_arm_num. ros_time is the ROS header stamp in seconds.
+class JointStateMsg(namedtuple('JointStateMsg', 'ros_msg_len ros_frame_id ros_time ros_seq_num ros_arm_num '
+                                                'joint_names positions velocities efforts')):
+    __slots__ = ()
+    ros_msg_type = ROS_PACKET_TYPES[0]
+
+class BricsPositionMsg(namedtuple('BricsPositionMsg', 'ros_msg_len ros_originator ros_description ros_arm_num '
+                                                      'joint_names units values')):
+    __slots__ = ()
+    ros_msg_type = ROS_PACKET_TYPES[1]
+
+class RosgraphDebugMsg(namedtuple('RosgraphDebugMsg', '')):
+    __slots__ = ()
+    ros_msg_type = ROS_PACKET_TYPES[2]
+
+class DependencyMsg(namedtuple('DependencyMsg', 'ros_msg_len ros_frame_id ros_time ros_seq_num '
+                                                'depend_string depend_val')):
+    __slots__ = ()
+    ros_msg_type = ROS_PACKET_TYPES[3]
+
+class GripperMsg(namedtuple('GripperMsg', BricsPositionMsg._fields)):
+    __slots__ = ()
+    ros_msg_type = ROS_PACKET_TYPES[4]
+
+def _armNumber(joint_name):
+    return 2 if joint_name.count("_2_") > 0 else 1
+
+# The dissectors walk a single memoryview with a moving offset instead of
+# re-slicing the remaining data after every field, which used to copy the
+# rest of the payload each time. The struct layouts are compiled once per
+# endianness.
+class _Structs:
+    def __init__(self, unpack_header):
+        self.uint32 = Struct(unpack_header + 'I').unpack_from
+        self.double = Struct(unpack_header + 'd').unpack_from
+        self.header = Struct(unpack_header + 'IIIII').unpack_from
+
+STRUCTS = dict((h, _Structs(h)) for h in '<>!=@')
+
+# NumPy dtypes for the float64 arrays, per endianness
+FLOAT64_DTYPES = {'<': '<f8', '>': '>f8', '!': '>f8', '=': '=f8', '@': '=f8'}
+
+@lru_cache(maxsize=64)
+def _doubleArray(unpack_header, count):
+    return Struct(unpack_header + str(count) + 'd').unpack_from
+
+def _readDoubles(unpack_header, packet_data, offset, count):
+    # Decode count float64 values starting at offset, as a list of floats
+    if offset + 8 * count > len(packet_data):
+        raise StructError("JointState array runs past the end of the packet")
+    return list(_doubleArray(unpack_header, count)(packet_data, offset))
+
+def dissectJointStateMsg(unpack_header, packet_data, offset=0):
+
+    st = STRUCTS[unpack_header]
+    packet_data = memoryview(packet_data)
 
-    # Clear the output dictionary, and add the msg type
-    returnInfo = {'ros_msg_type': ROS_PACKET_TYPES[0]}    
-    
     # Unpack the header
-    ros_header = unpack(unpack_header + 'IIIII', packet_data[0:20])
+    ros_header = st.header(packet_data, offset)
 
     # If our packet size is larger than 3500, we can guess it's a false positive
     if ros_header[0] > 3500:
-        return {}
+        return None
 
-    returnInfo['ros_msg_len'] = str(ros_header[0])
-    returnInfo['ros_frame_id'] = str(ros_header[1])
-    returnInfo['ros_time'] = str(ros_header[2]) + "." + str(ros_header[3])
-    
     # Is there a sequence number?
+    ros_seq_num = None
     if ros_header[4] > 0:
         # If so, let's store the value
-        returnInfo['ros_seq_num'] = str(packet_data[20:20+ros_header[4]])
-    # Remove the ROS header
-    packet_data = packet_data[20 + ros_header[4]:]
+        ros_seq_num = bytes(packet_data[offset+20:offset+20+ros_header[4]])
+    # Skip the ROS header
+    offset += 20 + ros_header[4]
 
     #######################
     # Get the joint names #
     #######################
 
     # What size is this array?
-    array_size = unpack(unpack_header + 'I', packet_data[0:4])[0]
-    packet_data = packet_data[4:]
+    array_size = st.uint32(packet_data, offset)[0]
+    offset += 4
     joint_names = []
     for i in range(0,array_size):
-        string_len = unpack(unpack_header + 'I', packet_data[0:4])[0]
-        joint_names.append(packet_data[4:4+string_len])
-        joint_names[i] = joint_names[i].decode("utf-8")
-        packet_data = packet_data[4+string_len:]
+        string_len = st.uint32(packet_data, offset)[0]
+        joint_names.append(str(packet_data[offset+4:offset+4+string_len], "utf-8"))
+        offset += 4 + string_len
 
     ########################
     # Get the joint values #
     ########################
 
     # What size is this array?
-    array_size = unpack(unpack_header + 'I', packet_data[0:4])[0]
-    packet_data = packet_data[4:]
-    joint_values = []
-    for i in range(0,array_size):
-        joint_values.append(unpack(unpack_header + 'd', packet_data[0:8])[0])
-        packet_data = packet_data[8:]
+    array_size = st.uint32(packet_data, offset)[0]
+    offset += 4
+    joint_values = _readDoubles(unpack_header, packet_data, offset, array_size)
+    offset += 8 * array_size
 
     ###########################
     # Get the velocity values #
     ###########################
 
     # What size is this array?
-    array_size = unpack(unpack_header + 'I', packet_data[0:4])[0]
-    packet_data = packet_data[4:]
-    joint_velocities = []
-    for i in range(0,array_size):
-        joint_velocities.append(unpack(unpack_header + 'd', packet_data[0:8])[0])
-        packet_data = packet_data[8:]
+    array_size = st.uint32(packet_data, offset)[0]
+    offset += 4
+    joint_velocities = _readDoubles(unpack_header, packet_data, offset, array_size)
+    offset += 8 * array_size
         
     #########################
     # Get the effort values #
     #########################
 
     # What size is this array?
-    array_size = unpack(unpack_header + 'I', packet_data[0:4])[0]
-    packet_data = packet_data[4:]
-    joint_efforts = []
+    array_size = st.uint32(packet_data, offset)[0]
+    offset += 4
     if array_size > 0:
-        for i in range(0,array_size):
-            joint_efforts.append(unpack(unpack_header + 'd', packet_data[0:8])[0])
-            packet_data = packet_data[8:]
+        joint_efforts = _readDoubles(unpack_header, packet_data, offset, array_size)
+        offset += 8 * array_size
     else:
-        joint_efforts = [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
-        
-    ###########################################
-    # Insert all the data into the dictionary #
-    ###########################################
-    
-    for idx, j in enumerate(joint_names):
-        returnInfo[str(j) + "_value"] = joint_values[idx]
-        returnInfo[str(j) + "_velocity"] = joint_velocities[idx]
-        returnInfo[str(j) + "_effort"] = joint_efforts[idx]
-    
-    return returnInfo
+        joint_efforts = [0.0] * len(joint_names)
+
+    ros_arm_num = _armNumber(joint_names[0]) if joint_names else None
+    return JointStateMsg(ros_header[0], ros_header[1], ros_header[2] + ros_header[3] * 1e-9, ros_seq_num,
+                         ros_arm_num, tuple(j.replace("_2_", "_") for j in joint_names),
+                         tuple(joint_values), tuple(joint_velocities), tuple(joint_efforts))
+
+def dissectJointStateBatch(unpack_header, messages, joints=7, out=None):
+    # Decode the position, velocity and effort arrays of many JointState
+    # messages into one (N, joints, 3) array. messages is a sequence of
+    # (packet_data, offset) pairs pointing at the start of each message, and
+    # out may be a preallocated array to fill. Messages that cannot be
+    # decoded are left as NaN; a missing effort array is stored as zeros,
+    # as dissectJointStateMsg does. Joints are in message order. Without
+    # NumPy a list of N lists of [position, velocity, effort] is returned.
+    st = STRUCTS[unpack_header]
+    if numpy is not None:
+        if out is None:
+            out = numpy.empty((len(messages), joints, 3))
+        out.fill(numpy.nan)
+    else:
+        out = [[[float('nan')] * 3 for j in range(joints)] for i in range(len(messages))]
+
+    for row, (packet_data, offset) in enumerate(messages):
+        packet_data = memoryview(packet_data)
+        try:
+            ros_header = st.header(packet_data, offset)
+            if ros_header[0] > 3500:
+                continue
+            offset += 20 + ros_header[4]
+
+            # Skip the joint names
+            array_size = st.uint32(packet_data, offset)[0]
+            offset += 4
+            for i in range(0,array_size):
+                offset += 4 + st.uint32(packet_data, offset)[0]
 
-def dissectBricsActuatorJointValueMsg(unpack_header, packet_data):
+            # Positions, velocities and efforts
+            for column in range(3):
+                array_size = st.uint32(packet_data, offset)[0]
+                offset += 4
+                if offset + 8 * array_size > len(packet_data):
+                    raise StructError("JointState array runs past the end of the packet")
+                count = min(array_size, joints)
+                if array_size == 0 and column == 2:
+                    values = [0.0] * joints
+                    count = joints
+                elif numpy is not None:
+                    values = numpy.frombuffer(packet_data, dtype=FLOAT64_DTYPES[unpack_header], count=count, offset=offset)
+                else:
+                    values = _doubleArray(unpack_header, count)(packet_data, offset)
+                if numpy is not None:
+                    out[row, :count, column] = values
+                else:
+                    for j in range(count):
+                        out[row][j][column] = values[j]
+                offset += 8 * array_size
+        except (StructError, ValueError):
+            continue
+
+    return out
+
+def dissectBricsActuatorJointValueMsg(unpack_header, packet_data, offset=0, recordType=BricsPositionMsg):
     
-    # Clear the output dictionary, and add the msg type
-    returnInfo = {'ros_msg_type': ROS_PACKET_TYPES[1]}    
+    st = STRUCTS[unpack_header]
+    packet_data = memoryview(packet_data)
 
-    ros_pkt_len = unpack(unpack_header + 'I', packet_data[0:4])[0]
-    returnInfo['ros_msg_len'] = str(ros_pkt_len)
-    packet_data = packet_data[4:]
+    ros_pkt_len = st.uint32(packet_data, offset)[0]
+    offset += 4
 
     # If our packet size is later than 3500, we can guess it's a false positive
     if ros_pkt_len > 3500:
-        return ""
+        return None
 
-    originator_len = unpack(unpack_header + 'I', packet_data[0:4])[0]
+    ros_originator = None
+    originator_len = st.uint32(packet_data, offset)[0]
     if originator_len > 0:
-        returnInfo['ros_originator'] = str(packet_data[4:4+originator_len])
-    packet_data = packet_data[4+originator_len:]
+        ros_originator = bytes(packet_data[offset+4:offset+4+originator_len])
+    offset += 4 + originator_len
 
-    description_len = unpack(unpack_header + 'I', packet_data[0:4])[0]
+    ros_description = None
+    description_len = st.uint32(packet_data, offset)[0]
     if description_len > 0:
-         returnInfo['ros_desription'] = str(packet_data[4:4+description_len])
-    packet_data = packet_data[4+description_len:]
+        ros_description = bytes(packet_data[offset+4:offset+4+description_len])
+    offset += 4 + description_len
 
-    #Strip away the QoS (not used)
-    packet_data = packet_data[4:]
+    #Skip the QoS (not used)
+    offset += 4
 
     # What size is this array?
-    array_size = unpack(unpack_header + 'I', packet_data[0:4])[0]
-    packet_data = packet_data[4:]
+    array_size = st.uint32(packet_data, offset)[0]
+    offset += 4
 
-    #####################################################
-    # Get the joint info and insert into the dictionary #
-    #####################################################
+    ######################
+    # Get the joint info #
+    ######################
 
+    ros_arm_num = None
+    joint_names = []
+    joint_units = []
+    joint_values = []
     for i in range(0,array_size):
-        packet_data = packet_data[8:]    #Strip the timestamp (not used)
+        offset += 8    #Skip the timestamp (not used)
         
-        joint_uri_len = unpack(unpack_header + 'I', packet_data[0:4])[0]    #How long is the string?
-        joint_uri = packet_data[4:4+joint_uri_len].decode("utf-8")
-        returnInfo["ros_arm_num"] = 0
-        if joint_uri.count("_2_") > 0 and returnInfo["ros_arm_num"] == 0:
-            returnInfo["ros_arm_num"] = 2
-            joint_uri = joint_uri.replace("_2_", "_")
-        else:
-            returnInfo["ros_arm_num"] = 1
-        packet_data = packet_data[4+joint_uri_len:]    #Strip the string from the data
+        joint_uri_len = st.uint32(packet_data, offset)[0]    #How long is the string?
+        joint_uri = str(packet_data[offset+4:offset+4+joint_uri_len], "utf-8")
+        ros_arm_num = _armNumber(joint_uri)
+        joint_names.append(joint_uri.replace("_2_", "_"))
+        offset += 4 + joint_uri_len    #Skip the string
 
-        joint_unit_len = unpack(unpack_header + 'I', packet_data[0:4])[0]    #How long is the string?
-        returnInfo[str(joint_uri) + '_unit'] = packet_data[4:4+joint_unit_len].decode("utf-8")
-        packet_data = packet_data[4+joint_unit_len:]    #Strip the string from the data
+        joint_unit_len = st.uint32(packet_data, offset)[0]    #How long is the string?
+        joint_units.append(str(packet_data[offset+4:offset+4+joint_unit_len], "utf-8"))
+        offset += 4 + joint_unit_len    #Skip the string
 
-        returnInfo[str(joint_uri) + '_value'] = unpack(unpack_header + 'd', packet_data[0:8])[0]
-        packet_data = packet_data[8:]    #Strip the value
-    
-    return returnInfo
+        joint_values.append(st.double(packet_data, offset)[0])
+        offset += 8    #Skip the value
     
+    return recordType(ros_pkt_len, ros_originator, ros_description, ros_arm_num,
+                      tuple(joint_names), tuple(joint_units), tuple(joint_values))
     
     
-def dissectDependencyMsg(unpack_header, packet_data):
     
-    # Clear the output dictionary, and add the msg type
-    returnInfo = {'ros_msg_type': ROS_PACKET_TYPES[3]}
+def dissectDependencyMsg(unpack_header, packet_data, offset=0):
     
+    st = STRUCTS[unpack_header]
+    packet_data = memoryview(packet_data)
+
     # Unpack the header
-    ros_header = unpack(unpack_header + 'IIIII', packet_data[0:20])
+    ros_header = st.header(packet_data, offset)
 
     # If our packet size is larger than 3500, we can guess it's a false positive
     if ros_header[0] > 3500:
-        return {}
+        return None
 
-    returnInfo['ros_msg_len'] = str(ros_header[0])
-    returnInfo['ros_frame_id'] = str(ros_header[1])
-    returnInfo['ros_time'] = str(ros_header[2]) + "." + str(ros_header[3])
-    
     # Is there a sequence number?
+    ros_seq_num = None
     if ros_header[4] > 0:
         # If so, let's store the value
-        returnInfo['ros_seq_num'] = str(packet_data[20:20+ros_header[4]])
-    # Remove the ROS header
-    packet_data = packet_data[20 + ros_header[4]:]
+        ros_seq_num = bytes(packet_data[offset+20:offset+20+ros_header[4]])
+    # Skip the ROS header
+    offset += 20 + ros_header[4]
     
-    depend_len = unpack(unpack_header + 'I', packet_data[0:4])[0]    # How long is the string?
-    returnInfo['depend_string'] = packet_data[4:4+depend_len].decode("utf-8")
-    packet_data = packet_data[4+depend_len:]    #Strip the string from the data
-    returnInfo['depend_val'] = packet_data[0:1]
+    depend_len = st.uint32(packet_data, offset)[0]    # How long is the string?
+    depend_string = str(packet_data[offset+4:offset+4+depend_len], "utf-8")
+    offset += 4 + depend_len    #Skip the string
+    depend_val = packet_data[offset] if offset < len(packet_data) else None
     
-    return returnInfo
+    return DependencyMsg(ros_header[0], ros_header[1], ros_header[2] + ros_header[3] * 1e-9, ros_seq_num,
+                         depend_string, depend_val)
     
     
-def dissectGripperMsg(unpack_header, d):
+def dissectGripperMsg(unpack_header, d, offset=0):
     # The gripper message is the same as the joint message, so let it handle the dissection
-    returnInfo = dissectBricsActuatorJointValueMsg(unpack_header, d)
-    # Rewrite the message type
-    returnInfo['ros_msg_type'] = ROS_PACKET_TYPES[4]
-    return returnInfo
+    return dissectBricsActuatorJointValueMsg(unpack_header, d, offset, GripperMsg)
     
     
 
 # For now we are going to just discard this message type
-def dissectDebugMsg(unpack_header, d):
-    returnInfo = {'ros_msg_type': ROS_PACKET_TYPES[2]}
-    return returnInfo
+def dissectDebugMsg(unpack_header, d, offset=0):
+    return RosgraphDebugMsg()
     
     
     
     
     
+# Message dissectors, indexed by the type id used in ROS_PACKETS
+DISSECTORS = [dissectJointStateMsg,                 # 0: JointStateMsg
+              dissectBricsActuatorJointValueMsg,    # 1: BricsPositionMsg
+              dissectDebugMsg,                      # 2: rosgraphDebugMsg
+              dissectDependencyMsg,                 # 3: DependencyMsg
+              dissectGripperMsg]                    # 4: GripperMsg
+
+def compileSignatures(rosPackets):
+    # Compile the ROS_PACKETS list into a dispatch table. The signatures are
+    # grouped by the offset of their first idx&text pair, and within a group
+    # keyed by the leading bytes that all texts at that offset have room for,
+    # so a message is identified with one dict lookup per distinct offset
+    # instead of comparing it against every signature in turn. Returns
+    # [(offset, key length, {key bytes: [(order, id, [(idx, bytes), ...])]})]
+    groups = {}
+    for order, rosIdentifier in enumerate(rosPackets):
+        patterns = [(idx, text.encode()) for idx, text in rosIdentifier[1:]]
+        groups.setdefault(patterns[0][0], []).append((order, rosIdentifier[0], patterns))
+
+    table = []
+    for idx in sorted(groups):
+        keyLen = min(len(patterns[0][1]) for order, typeId, patterns in groups[idx])
+        candidates = {}
+        for order, typeId, patterns in groups[idx]:
+            candidates.setdefault(patterns[0][1][:keyLen], []).append((order, typeId, patterns))
+        table.append((idx, keyLen, candidates))
+    return table
+
+SIGNATURE_TABLE = compileSignatures(ROS_PACKETS)
+
+def identifyMessage(d, offset=0, table=SIGNATURE_TABLE):
+    # Return the type id of the message starting at offset, or None. When
+    # several signatures match, the one listed first in ROS_PACKETS wins.
+    found = None
+    for idx, keyLen, candidates in table:
+        start = offset + idx
+        for order, typeId, patterns in candidates.get(bytes(d[start:start+keyLen]), ()):
+            if found is not None and found[0] < order:
+                break
+            for currIdx, currStr in patterns:
+                if d[offset+currIdx:offset+currIdx+len(currStr)] != currStr:
+                    break
+            else:
+                found = (order, typeId)
+                break
+    return found[1] if found is not None else None
+
 def dissectPacket(unpack_header, d):
 
+    uint32 = STRUCTS[unpack_header].uint32
+    d = memoryview(d)
+    end = len(d)
+    offset = 0
+
     # Clear the foundMessages list (returned later)
     foundMessages = []
     
     # Is there data in this packet?
-    while len(d) >= 4:
+    while end - offset >= 4:
         # Anticipating that this is a ROS message, grab the first four
         # bytes, which should be the length of the packet
-        msg_len = unpack(unpack_header + 'I', d[0:4])[0]
+        msg_len = uint32(d, offset)[0]
         # Is there data left in this packet?
         if msg_len > 0:
-            # Iterate through the packet identifiers
-            for rosIdentifier in ROS_PACKETS:
-                # Determine the number of indices provided in the ROS_PACKETS list
-                numIDXs = len(rosIdentifier) - 1
-                # Clear the number of matches found
-                matchesFound = 0
-                # Iterate through each IDX to find a match
-                for x in range(numIDXs):
-                    currIdx = rosIdentifier[x+1][0]
-                    currStr = rosIdentifier[x+1][1]
-                    #print("\nCurr IDX = " + str(currIdx) + "\nCurr Str = " + str(currStr) + "\nData = " + str(d[currIdx:len(currStr)+currIdx]))
-                    if d[currIdx:len(currStr)+currIdx] == currStr.encode():
-                        matchesFound += 1
-                    else:
-                        break;
-                # If the matches found equal the idx's and text provided, then
-                # skip searching for the rest of the packet types
-                if matchesFound == numIDXs:
-                    # Process the packet based on the type found
-                    if rosIdentifier[0] == 0:
-                        # Send the data to the JointMsg dissector, and append the returned data
-                        foundMessages.append(dissectJointStateMsg(unpack_header, d))
-                    elif rosIdentifier[0] == 1:
-                        # Send the data to the BricsMsg dissector, and append the returned data
-                        foundMessages.append(dissectBricsActuatorJointValueMsg(unpack_header, d))
-                    elif rosIdentifier[0] == 2:
-                        foundMessages.append(dissectDebugMsg(unpack_header, d))
-                    elif rosIdentifier[0] == 3:
-                        foundMessages.append(dissectDependencyMsg(unpack_header, d))
-                    elif rosIdentifier[0] == 4:
-                        foundMessages.append(dissectGripperMsg(unpack_header, d))
-                    break
-            # Remove the message we just parsed.
-            d = d[4+msg_len:]
+            # Identify the message from its signature and process it with
+            # the matching dissector
+            typeId = identifyMessage(d, offset)
+            if typeId is not None:
+                msg = DISSECTORS[typeId](unpack_header, d, offset)
+                # Dissectors return None for false positives
+                if msg is not None:
+                    foundMessages.append(msg)
+            # Skip the message we just parsed.
+            offset += 4 + msg_len
             
         else:
-            # Some messages may have padding, so remove it
-            d = d[4:]
+            # Some messages may have padding, so skip it
+            offset += 4
         
         
     return foundMessages  # Return the list of messages
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
\ No newline at end of file
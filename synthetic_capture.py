@@ -0,0 +1,415 @@
+#
+# Author:       Timothy Zimmerman (timothy.zimmerman@nist.gov)
+# Organization: National Institute of Standards and Technology
+#               U.S. Department of Commerce
+# License:      Public Domain
+#
+# Description:  Generator of synthetic YouBot captures, for benchmarks and
+#               for testing without the production captures. Two arms are
+#               simulated: a controller sends Brics position commands (new
+#               targets or repeats of the last one) and gripper commands, and
+#               each arm publishes JointStates that start moving towards a
+#               new target after a short response delay. Dependency updates
+#               (identical every time) and rosout debug messages are sent
+#               periodically. Every message matches a ROS_PACKETS signature
+#               of ros_msg_dissector.
+#
+#               The ROS traffic runs over TCP connections that start with a
+#               handshake and are acknowledged by the receiver, and a few
+#               messages are split over two segments. As real TCP stacks do,
+#               only the last segment of a message has PSH set; the first one
+#               of a split message carries ACK alone, and the prefilter only
+#               lets it through when the streams are reassembled. The same
+#               segments are written to one capture per capture point, a
+#               little later at every point, each with its own noise:
+#               EtherCAT, ARP, NTP, SSH, HTTP and TCP payloads that are not
+#               ROS.
+#
+#               Usage: python synthetic_capture.py <directory> [packets] [capture points] [seed]
+#
+#               packets is the number of ROS segments in each capture.
+#
+
+import heapq
+import os
+import random
+import sys
+from struct import Struct
+
+DEFAULT_PACKETS = 100000
+DEFAULT_CAPTURE_POINTS = 2
+DEFAULT_SEED = 1
+# Noise frames per ROS segment, on average
+DEFAULT_NOISE_RATIO = 1.0
+# Share of ROS messages split over two TCP segments
+DEFAULT_SPLIT_RATIO = 0.02
+
+# Capture time of the first packet
+START_TIME = 1439926874.0
+
+# Message periods in seconds, per arm where it applies
+JOINT_STATE_PERIOD = 0.01
+BRICS_PERIOD = 0.5
+GRIPPER_PERIOD = 2.0
+DEPENDENCY_PERIOD = 1.0
+DEBUG_PERIOD = 0.2
+# Share of the Brics commands that set a new target instead of repeating
+NEW_TARGET_RATIO = 0.3
+# Seconds from a new target until the arm starts moving, and of the move
+RESPONSE_DELAY = (0.02, 0.08)
+MOVE_DURATION = 0.3
+
+# Every capture point sees a segment CAPTURE_DELAY seconds after the
+# previous point, give or take CAPTURE_JITTER
+CAPTURE_DELAY = 0.0002
+CAPTURE_JITTER = 0.00005
+# Frames are written in time order within this many seconds
+REORDER_WINDOW = 0.001
+
+ARMS = (1, 2)
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_ARP = 0x0806
+ETHERTYPE_ETHERCAT = 0x88a4
+TCP_SYN = 0x02
+TCP_ACK = 0x10
+TCP_PSH_ACK = 0x18
+TCP_SYN_ACK = 0x12
+# Payload bytes of the first segment of a split message
+SPLIT_SIZE = 64
+MIN_FRAME_LEN = 60
+
+# Hosts: (MAC, IPv4). The controller runs the ROS master and commands both
+# arms, each arm has its own host.
+CONTROLLER = (bytes([0x00, 0x1b, 0x21, 0x00, 0x00, 0x01]), bytes([10, 0, 0, 1]))
+ARM_HOSTS = {
+    1: (bytes([0x00, 0x1b, 0x21, 0x00, 0x00, 0x11]), bytes([10, 0, 0, 11])),
+    2: (bytes([0x00, 0x1b, 0x21, 0x00, 0x00, 0x12]), bytes([10, 0, 0, 12])),
+}
+OTHER_HOST = (bytes([0x00, 0x1b, 0x21, 0x00, 0x00, 0x99]), bytes([10, 0, 0, 99]))
+
+ETH_HEADER = Struct('>6s6sH')
+IPV4_HEADER = Struct('>BBHHHBBH4s4s')
+TCP_HEADER = Struct('>HHIIBBHHH')
+UDP_HEADER = Struct('>HHHH')
+IP_TOTAL_LEN = Struct('>H')
+
+
+class Encoder:
+    # ROS serialization in the byte order of the capture, which is what
+    # ros_msg_dissector assumes for the payloads
+
+    def __init__(self, unpack_header):
+        self.uint32 = Struct(unpack_header + 'I').pack
+        self.uint64 = Struct(unpack_header + 'Q').pack
+        self.header = Struct(unpack_header + 'III').pack
+        self.unpack_header = unpack_header
+
+    def string(self, text):
+        data = text.encode()
+        return self.uint32(len(data)) + data
+
+    def doubles(self, values):
+        return self.uint32(len(values)) + Struct(self.unpack_header + str(len(values)) + 'd').pack(*values)
+
+    def message(self, body):
+        return self.uint32(len(body)) + body
+
+    def rosHeader(self, seq, stamp, frame_id=""):
+        sec = int(stamp)
+        return self.header(seq, sec, int((stamp - sec) * 1e9)) + self.string(frame_id)
+
+
+def armJointNames(arm):
+    # Joint names as the arm publishes them; the second arm has "_2_"
+    infix = "_" if arm == 1 else "_2_"
+    return ["arm" + infix + "joint_" + str(j) for j in range(1, 6)] + \
+           ["gripper" + infix + "finger_joint_l", "gripper" + infix + "finger_joint_r"]
+
+
+def jointStatePayload(enc, arm, seq, stamp, positions, velocities, efforts):
+    # sensor_msgs/JointState with an empty frame_id
+    body = enc.rosHeader(seq, stamp) + enc.uint32(7) + b''.join(enc.string(n) for n in armJointNames(arm)) + \
+           enc.doubles(positions) + enc.doubles(velocities) + enc.doubles(efforts)
+    return enc.message(body)
+
+
+def jointValuesPayload(enc, names, unit, values):
+    # brics_actuator/JointPositions: empty poisonStamp (originator and
+    # description), QoS, then one timestamped value per joint
+    body = enc.string("") + enc.string("") + enc.uint32(0) + enc.uint32(len(names))
+    for name, value in zip(names, values):
+        body += enc.uint64(0) + enc.string(name) + enc.string(unit) + Struct(enc.unpack_header + 'd').pack(value)
+    return enc.message(body)
+
+
+def bricsPositionPayload(enc, arm, values):
+    return jointValuesPayload(enc, armJointNames(arm)[:5], "rad", values)
+
+
+def gripperPayload(enc, arm, values):
+    return jointValuesPayload(enc, armJointNames(arm)[5:], "m", values)
+
+
+def dependencyPayload(enc, name, value):
+    # The same bytes every time: no sequence number or stamp
+    return enc.message(enc.rosHeader(0, 0.0, "youbot_dependency_update") + enc.string(name) + bytes([value]))
+
+
+def debugPayload(enc, arm, seq, stamp, text):
+    # rosgraph_msgs/Log from the robot proxy of an arm
+    body = enc.rosHeader(seq, stamp) + bytes([2]) + enc.string("/robot_proxy_" + str(arm)) + \
+           enc.string(text) + enc.string("robot_proxy.cpp") + enc.string("publishState") + \
+           enc.uint32(120 + arm) + enc.uint32(1) + enc.string("/rosout")
+    return enc.message(body)
+
+
+def ethernetFrame(dst, src, ethertype, payload):
+    frame = ETH_HEADER.pack(dst, src, ethertype) + payload
+    if len(frame) < MIN_FRAME_LEN:
+        frame += b'\x00' * (MIN_FRAME_LEN - len(frame))
+    return frame
+
+
+def ipv4Frame(src, dst, proto, transport, ident):
+    ip = IPV4_HEADER.pack(0x45, 0, 20 + len(transport), ident & 0xffff, 0x4000, 64, proto, 0, src[1], dst[1])
+    return ethernetFrame(dst[0], src[0], ETHERTYPE_IPV4, ip + transport)
+
+
+def tcpFrame(src, dst, sport, dport, seq, ack, flags, payload, ident=0):
+    tcp = TCP_HEADER.pack(sport, dport, seq, ack, 5 << 4, flags, 29200, (seq ^ ack ^ len(payload)) & 0xffff, 0)
+    return ipv4Frame(src, dst, 6, tcp + payload, ident)
+
+
+class Connection:
+    # One TCPROS connection from a publisher to a subscriber
+
+    def __init__(self, rng, publisher, subscriber, sport, dport):
+        self.publisher = publisher
+        self.subscriber = subscriber
+        self.sport = sport
+        self.dport = dport
+        self.seq = rng.getrandbits(32)
+        self.ack = rng.getrandbits(32)
+        self.open = False
+        self.unacked = 0
+
+    def handshake(self, t):
+        # The subscriber connects to the publisher's port
+        frames = [(t - 0.0003, tcpFrame(self.subscriber, self.publisher, self.dport, self.sport,
+                                        self.ack, 0, TCP_SYN, b'')),
+                  (t - 0.0002, tcpFrame(self.publisher, self.subscriber, self.sport, self.dport,
+                                        self.seq, (self.ack + 1) & 0xffffffff, TCP_SYN_ACK, b'')),
+                  (t - 0.0001, tcpFrame(self.subscriber, self.publisher, self.dport, self.sport,
+                                        (self.ack + 1) & 0xffffffff, (self.seq + 1) & 0xffffffff, TCP_ACK, b''))]
+        self.seq = (self.seq + 1) & 0xffffffff
+        self.ack = (self.ack + 1) & 0xffffffff
+        self.open = True
+        return frames
+
+    def send(self, t, payload, split=False):
+        # Frames carrying payload, with the subscriber's ACK for every other
+        # segment
+        frames = self.handshake(t) if not self.open else []
+        parts = [payload[:SPLIT_SIZE], payload[SPLIT_SIZE:]] if split and len(payload) > SPLIT_SIZE else [payload]
+        for n, part in enumerate(parts):
+            # PSH only on the segment that ends the message
+            flags = TCP_PSH_ACK if n + 1 == len(parts) else TCP_ACK
+            frames.append((t + n * 0.00005, tcpFrame(self.publisher, self.subscriber, self.sport, self.dport,
+                                                     self.seq, self.ack, flags, part, self.seq)))
+            self.seq = (self.seq + len(part)) & 0xffffffff
+            self.unacked += 1
+            if self.unacked >= 2:
+                self.unacked = 0
+                frames.append((t + n * 0.00005 + 0.00003, tcpFrame(self.subscriber, self.publisher, self.dport,
+                                                                   self.sport, self.ack, self.seq, TCP_ACK, b'')))
+        return frames
+
+
+class ArmState:
+    # Joint positions of one arm moving linearly to its latest target
+
+    def __init__(self, rng):
+        self.start = [rng.uniform(0.5, 2.5) for j in range(5)] + [0.0, 0.0]
+        self.target = list(self.start)
+        self.moveStart = 0.0
+        self.moveEnd = 0.0
+
+    def setTarget(self, t, target, delay):
+        self.start = self.positions(t)
+        self.target = list(target)
+        self.moveStart = t + delay
+        self.moveEnd = self.moveStart + MOVE_DURATION
+
+    def positions(self, t):
+        if t <= self.moveStart:
+            return list(self.start)
+        if t >= self.moveEnd:
+            return list(self.target)
+        f = (t - self.moveStart) / (self.moveEnd - self.moveStart)
+        return [a + (b - a) * f for a, b in zip(self.start, self.target)]
+
+    def velocities(self, t):
+        if self.moveStart < t < self.moveEnd:
+            return [(b - a) / MOVE_DURATION for a, b in zip(self.start, self.target)]
+        return [0.0] * 7
+
+
+def noiseFrame(rng, point, ident, streams):
+    # One frame of non-ROS traffic seen by a capture point. streams holds the
+    # next sequence number of every noise TCP stream.
+    kind = rng.random()
+    host = ARM_HOSTS[1 + point % 2]
+    if kind < 0.35:
+        # EtherCAT between an arm host and its motor controllers
+        return ethernetFrame(b'\xff' * 6, host[0], ETHERTYPE_ETHERCAT,
+                             bytes([0x2c, 0x10]) + bytes(rng.getrandbits(8) for i in range(44)))
+    if kind < 0.45:
+        arp = bytes([0, 1, 8, 0, 6, 4, 0, 1]) + host[0] + host[1] + b'\x00' * 6 + CONTROLLER[1]
+        return ethernetFrame(b'\xff' * 6, host[0], ETHERTYPE_ARP, arp)
+    if kind < 0.55:
+        ntp = bytes([0x23, 2, 6, 0xe9]) + bytes(rng.getrandbits(8) for i in range(44))
+        return ipv4Frame(host, OTHER_HOST, 17, UDP_HEADER.pack(123, 123, 8 + len(ntp), 0) + ntp, ident)
+    payload = bytes(rng.getrandbits(8) for i in range(rng.randint(8, 200)))
+    if kind < 0.75:
+        ports = (22, 50022)
+    elif kind < 0.85:
+        ports = (80, 50080)
+    else:
+        # Not ROS, but it gets past the prefilter and is stored unclassified
+        ports = (5555, 55555)
+    key = (point,) + ports
+    seq = streams.get(key)
+    if seq is None:
+        seq = rng.getrandbits(32)
+    streams[key] = (seq + len(payload)) & 0xffffffff
+    return tcpFrame(OTHER_HOST, host, ports[0], ports[1], seq, 1, TCP_PSH_ACK, payload, ident)
+
+
+class PcapWriter:
+    # Writes frames in time order, holding them for REORDER_WINDOW seconds
+
+    def __init__(self, filename, unpack_header):
+        self.f = open(filename, 'wb')
+        self.record = Struct(unpack_header + 'IIII').pack
+        self.f.write(Struct(unpack_header + 'IHHiIII').pack(0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+        self.pending = []
+        self.order = 0
+        self.frames = 0
+
+    def add(self, t, frame):
+        self.order += 1
+        heapq.heappush(self.pending, (t, self.order, frame))
+
+    def flushBefore(self, t):
+        while self.pending and self.pending[0][0] < t:
+            ts, order, frame = heapq.heappop(self.pending)
+            sec = int(ts)
+            usec = min(int(round((ts - sec) * 1e6)), 999999)
+            self.f.write(self.record(sec, usec, len(frame), len(frame)) + frame)
+            self.frames += 1
+
+    def close(self):
+        self.flushBefore(float('inf'))
+        self.f.close()
+
+
+def rosEvents(rng, enc, packets, split_ratio=DEFAULT_SPLIT_RATIO):
+    # Yield (time, frame, is ROS payload) for the wire traffic of both arms,
+    # until packets ROS segments have been sent
+    c = CONTROLLER
+    conns = {}
+    for arm in ARMS:
+        host = ARM_HOSTS[arm]
+        conns['joint', arm] = Connection(rng, host, c, 40000 + arm, 50000 + arm)
+        conns['brics', arm] = Connection(rng, c, host, 41000 + arm, 51000 + arm)
+        conns['gripper', arm] = Connection(rng, c, host, 42000 + arm, 52000 + arm)
+        conns['dependency', arm] = Connection(rng, c, host, 43000 + arm, 53000 + arm)
+        conns['debug', arm] = Connection(rng, host, c, 44000 + arm, 54000 + arm)
+    arms = dict((arm, ArmState(rng)) for arm in ARMS)
+    bricsTargets = dict((arm, arms[arm].positions(0.0)[:5]) for arm in ARMS)
+    seqs = dict(((kind, arm), 0) for kind, arm in conns)
+
+    events = []
+    for arm in ARMS:
+        for kind, period in (('joint', JOINT_STATE_PERIOD), ('brics', BRICS_PERIOD), ('gripper', GRIPPER_PERIOD),
+                             ('dependency', DEPENDENCY_PERIOD), ('debug', DEBUG_PERIOD)):
+            heapq.heappush(events, (START_TIME + rng.uniform(0.001, period), kind, arm, period))
+
+    sent = 0
+    while sent < packets:
+        t, kind, arm, period = heapq.heappop(events)
+        heapq.heappush(events, (t + period * rng.uniform(0.95, 1.05), kind, arm, period))
+        state = arms[arm]
+        local = t - START_TIME
+        seqs[kind, arm] += 1
+        if kind == 'joint':
+            efforts = [rng.uniform(-0.5, 0.5) for j in range(7)]
+            payload = jointStatePayload(enc, arm, seqs[kind, arm], t, state.positions(local),
+                                        state.velocities(local), efforts)
+        elif kind == 'brics':
+            if rng.random() < NEW_TARGET_RATIO:
+                bricsTargets[arm] = [rng.uniform(0.1, 2.9) for j in range(5)]
+                state.setTarget(local, bricsTargets[arm] + state.target[5:], rng.uniform(*RESPONSE_DELAY))
+            payload = bricsPositionPayload(enc, arm, bricsTargets[arm])
+        elif kind == 'gripper':
+            grip = rng.choice((0.0, 0.0115))
+            state.setTarget(local, state.target[:5] + [grip, grip], rng.uniform(*RESPONSE_DELAY))
+            payload = gripperPayload(enc, arm, [grip, grip])
+        elif kind == 'dependency':
+            payload = dependencyPayload(enc, "arm_" + str(arm) + "_ready", 1)
+        else:
+            payload = debugPayload(enc, arm, seqs[kind, arm], t, "Arm " + str(arm) + " state published")
+
+        for frameTime, frame in conns[kind, arm].send(t, payload, rng.random() < split_ratio):
+            # The subscriber's ACKs are the only segments without payload:
+            # their IPv4 total length (bytes 16-17) is just the headers
+            isRos = IP_TOTAL_LEN.unpack_from(frame, 16)[0] > 40
+            if isRos:
+                sent += 1
+            yield frameTime, frame, isRos
+
+
+def generate(directory, packets=DEFAULT_PACKETS, capture_points=DEFAULT_CAPTURE_POINTS, seed=DEFAULT_SEED,
+             noise_ratio=DEFAULT_NOISE_RATIO, split_ratio=DEFAULT_SPLIT_RATIO, unpack_header='<'):
+    # Write one capture per capture point into directory. Returns the
+    # filenames.
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    rng = random.Random(seed)
+    enc = Encoder(unpack_header)
+    filenames = [os.path.join(directory, "robot" + str(point + 1) + "_synthetic.pcap")
+                 for point in range(capture_points)]
+    writers = [PcapWriter(filename, unpack_header) for filename in filenames]
+    noiseChance = noise_ratio / (1.0 + noise_ratio)
+    lastTime = START_TIME
+    ident = 0
+    streams = {}
+    try:
+        for t, frame, isRos in rosEvents(rng, enc, packets, split_ratio):
+            for point, writer in enumerate(writers):
+                seen = t + point * CAPTURE_DELAY + rng.uniform(0, CAPTURE_JITTER)
+                writer.add(seen, frame)
+                while rng.random() < noiseChance:
+                    ident += 1
+                    writer.add(rng.uniform(lastTime, t), noiseFrame(rng, point, ident, streams))
+                writer.flushBefore(t - REORDER_WINDOW)
+            lastTime = t
+    finally:
+        for writer in writers:
+            writer.close()
+    return filenames
+
+
+def main(argv):
+    if len(argv) < 2:
+        print ("Usage: python synthetic_capture.py <directory> [packets] [capture points] [seed]")
+        return
+    packets = int(argv[2]) if len(argv) > 2 else DEFAULT_PACKETS
+    capture_points = int(argv[3]) if len(argv) > 3 else DEFAULT_CAPTURE_POINTS
+    seed = int(argv[4]) if len(argv) > 4 else DEFAULT_SEED
+    for filename in generate(argv[1], packets, capture_points, seed):
+        print (filename + ": " + str(os.path.getsize(filename)) + " bytes")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
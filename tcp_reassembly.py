@@ -0,0 +1,243 @@
+#
+# Author:       Timothy Zimmerman (timothy.zimmerman@nist.gov)
+# Organization: National Institute of Standards and Technology
+#               U.S. Department of Commerce
+# License:      Public Domain
+#
+# Description:  TCP stream reassembly in front of the ROS dissector. TCPROS
+#               frames every message with a 4-byte length, and a message
+#               (e.g. a burst of JointStates) may be split over several
+#               segments. Each direction of a connection gets a buffer that
+#               is filled in sequence-number order, and every complete
+#               message in it is dissected and attributed to the segment
+#               that completed it.
+#
+#               Memory is bounded: a message longer than MAX_MESSAGE_LEN
+#               means the stream is not on a message boundary and the buffer
+#               is dropped, segments that arrive ahead of a gap are held up
+#               to MAX_PENDING_BYTES per flow and GAP_TIMEOUT seconds of
+#               capture time, and at most MAX_FLOWS flows are tracked, the
+#               ones idle the longest being evicted first.
+#
+#               The complete messages go through a dissect_cache
+#               DissectionCache when one is given.
+#
+
+from collections import OrderedDict
+import ros_msg_dissector as rosDisector
+
+# Longest message accepted before the buffer is considered out of sync. The
+# dissectors treat longer messages as false positives anyway.
+MAX_MESSAGE_LEN = 3500
+# Bytes held per flow for segments received ahead of a gap
+MAX_PENDING_BYTES = 256 * 1024
+# Seconds (capture time) to wait for a gap to be filled
+GAP_TIMEOUT = 1.0
+# Seconds (capture time) after which an idle flow is forgotten
+IDLE_TIMEOUT = 60.0
+# Flows tracked at the same time
+MAX_FLOWS = 4096
+
+SEQ_MOD = 0x100000000
+SEQ_HALF = 0x80000000
+
+
+class Flow:
+    # One direction of a TCP connection
+    __slots__ = ('expected', 'buffer', 'pending', 'pendingBytes', 'gapSince', 'lastSeen')
+
+    def __init__(self, seq, timestamp):
+        self.expected = seq
+        self.buffer = b''
+        self.pending = {}
+        self.pendingBytes = 0
+        self.gapSince = None
+        self.lastSeen = timestamp
+
+
+class StreamReassembler:
+
+    def __init__(self, max_message_len=MAX_MESSAGE_LEN, max_pending_bytes=MAX_PENDING_BYTES,
+                 gap_timeout=GAP_TIMEOUT, idle_timeout=IDLE_TIMEOUT, max_flows=MAX_FLOWS, cache=None):
+        self.cache = cache
+        self.max_message_len = max_message_len
+        self.max_pending_bytes = max_pending_bytes
+        self.gap_timeout = gap_timeout
+        self.idle_timeout = idle_timeout
+        self.max_flows = max_flows
+        self.flows = OrderedDict()
+        self.resetCounters()
+
+    def resetCounters(self):
+        self.segments = 0
+        self.messages = 0
+        self.reassembledMessages = 0
+        self.reassembledBytes = 0
+        self.outOfOrderBytes = 0
+        self.retransmittedBytes = 0
+        self.droppedBytes = 0
+        self.failedMessages = 0
+        self.evictedFlows = 0
+
+    def addCounters(self, other):
+        # Add the counters of a reassembler that ran elsewhere, e.g. on one
+        # chunk in a worker process
+        for counter in ('segments', 'messages', 'reassembledMessages', 'reassembledBytes', 'outOfOrderBytes',
+                        'retransmittedBytes', 'droppedBytes', 'failedMessages', 'evictedFlows'):
+            setattr(self, counter, getattr(self, counter) + getattr(other, counter))
+
+    def feed(self, unpack_header, packet):
+        # Add one segment and return the messages it completed, in the same
+        # form as ros_msg_dissector.dissectPacket. A segment that completed no
+        # message (its bytes are buffered, retransmitted or dropped) gets an
+        # empty list and is stored as unclassified, like a segment the
+        # dissector found nothing in.
+        self.segments += 1
+        key = (packet.ip_src, packet.tcp_srcport, packet.ip_dst, packet.tcp_dstport)
+        flow = self.flows.pop(key, None)
+        timestamp = packet.timestamp
+        if flow is None:
+            flow = Flow(packet.tcp_seq, timestamp)
+            self.evictIdle(timestamp)
+        self.flows[key] = flow
+        flow.lastSeen = timestamp
+
+        data = packet.data
+        offset = (packet.tcp_seq - flow.expected) % SEQ_MOD
+        if offset >= SEQ_HALF:
+            # Starts before the expected byte: keep only the new part, if any
+            behind = SEQ_MOD - offset
+            if behind >= len(data):
+                self.retransmittedBytes += len(data)
+                return []
+            self.retransmittedBytes += behind
+            data = data[behind:]
+        elif offset > 0:
+            # Ahead of a gap: hold it until the gap is filled
+            if packet.tcp_seq not in flow.pending:
+                flow.pending[packet.tcp_seq] = bytes(data)
+                flow.pendingBytes += len(data)
+                self.outOfOrderBytes += len(data)
+            if flow.gapSince is None:
+                flow.gapSince = timestamp
+            if flow.pendingBytes > self.max_pending_bytes or timestamp - flow.gapSince > self.gap_timeout:
+                return self.skipGap(unpack_header, flow)
+            return []
+
+        carried = len(flow.buffer)
+        if carried and rosDisector.identifyMessage(data) is not None:
+            # The segment starts a known message, so the partial message in
+            # the buffer was not ROS traffic after all
+            self.droppedBytes += carried
+            carried = 0
+        if carried:
+            stream = flow.buffer + bytes(data)
+        else:
+            stream = data
+        flow.expected = (flow.expected + len(data)) % SEQ_MOD
+        stream, carried = self.drainPending(flow, stream, carried)
+        return self.parse(unpack_header, flow, stream, carried)
+
+    def drainPending(self, flow, stream, carried):
+        # Append the held segments that are now contiguous
+        while flow.pending:
+            nextSeg = None
+            for seq in list(flow.pending):
+                offset = (seq - flow.expected) % SEQ_MOD
+                if offset == 0 or offset >= SEQ_HALF:
+                    nextSeg = seq
+                    break
+            if nextSeg is None:
+                break
+            data = flow.pending.pop(nextSeg)
+            flow.pendingBytes -= len(data)
+            behind = (flow.expected - nextSeg) % SEQ_MOD
+            if behind >= len(data):
+                continue
+            stream = bytes(stream) + data[behind:]
+            flow.expected = (flow.expected + len(data) - behind) % SEQ_MOD
+        if not flow.pending:
+            flow.gapSince = None
+        return stream, carried
+
+    def skipGap(self, unpack_header, flow):
+        # Give up on the missing bytes: drop the partial message and the held
+        # segments that continue a message whose start was lost, and carry
+        # on from the first held segment that starts a known message
+        self.droppedBytes += len(flow.buffer)
+        flow.buffer = b''
+        for seq in sorted(flow.pending, key=lambda seq: (seq - flow.expected) % SEQ_MOD):
+            data = flow.pending[seq]
+            if rosDisector.identifyMessage(data) is not None:
+                flow.expected = seq
+                break
+            del flow.pending[seq]
+            flow.pendingBytes -= len(data)
+            self.droppedBytes += len(data)
+            flow.expected = (seq + len(data)) % SEQ_MOD
+        stream, carried = self.drainPending(flow, b'', 0)
+        return self.parse(unpack_header, flow, stream, 0)
+
+    def parse(self, unpack_header, flow, stream, carried):
+        # Dissect every complete message at the start of stream and keep the
+        # rest in the flow buffer. Messages starting in the carried-over bytes
+        # were split across segments.
+        uint32 = rosDisector.STRUCTS[unpack_header].uint32
+        end = len(stream)
+        pos = 0
+        foundMessages = []
+        while end - pos >= 4:
+            msg_len = uint32(stream, pos)[0]
+            if msg_len == 0:
+                # Padding
+                pos += 4
+                continue
+            if msg_len > self.max_message_len:
+                # Not on a message boundary: drop what we have and resync on
+                # the next segment
+                self.droppedBytes += end - pos
+                pos = end
+                break
+            if end - pos < 4 + msg_len:
+                break
+            self.messages += 1
+            if pos < carried:
+                self.reassembledMessages += 1
+                self.reassembledBytes += 4 + msg_len
+            message = stream[pos:pos + 4 + msg_len]
+            try:
+                if self.cache is not None:
+                    foundMessages.extend(self.cache.dissect(unpack_header, message))
+                else:
+                    foundMessages.extend(rosDisector.dissectPacket(unpack_header, message))
+            except:
+                self.failedMessages += 1
+            pos += 4 + msg_len
+        flow.buffer = bytes(stream[pos:])
+        return foundMessages
+
+    def evictIdle(self, timestamp):
+        # Flows are kept in order of last use, so the idle ones are in front
+        while self.flows:
+            key, flow = next(iter(self.flows.items()))
+            if len(self.flows) < self.max_flows and timestamp - flow.lastSeen <= self.idle_timeout:
+                break
+            self.evict(key)
+
+    def evict(self, key):
+        flow = self.flows.pop(key)
+        self.droppedBytes += len(flow.buffer) + flow.pendingBytes
+        self.evictedFlows += 1
+
+    def close(self):
+        # End of the capture: whatever is still buffered is incomplete
+        for flow in self.flows.values():
+            self.droppedBytes += len(flow.buffer) + flow.pendingBytes
+        self.flows.clear()
+
+    def summary(self):
+        return ("Reassembly: " + str(self.messages) + " messages from " + str(self.segments) + " segments, " + \
+                str(self.reassembledMessages) + " reassembled (" + str(self.reassembledBytes) + " bytes), " + \
+                str(self.outOfOrderBytes) + " bytes out of order, " + str(self.retransmittedBytes) + \
+                " retransmitted, " + str(self.droppedBytes) + " dropped, " + str(self.failedMessages) + \
+                " failed to dissect, " + str(self.evictedFlows) + " flows evicted")
@@ -0,0 +1,85 @@
+#
+# Author:       Timothy Zimmerman (timothy.zimmerman@nist.gov)
+# Organization: National Institute of Standards and Technology
+#               U.S. Department of Commerce
+# License:      Public Domain
+#
+# Description:  Tests of the series files of joint_series.py: a series
+#               written a chunk at a time by JointSeriesWriter, with samples
+#               out of order across the chunks, holds what
+#               JointSeriesBuilder.build gives for the same samples, with
+#               and without NumPy.
+#
+#               Usage: python -m pytest test_joint_series.py
+#                      python -m unittest test_joint_series
+#
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import joint_series
+
+JOINTS = joint_series.JOINTS
+
+
+def samples(count, seed=1):
+    # (timestamp, ROS time, frame, positions, velocities, efforts), in frame
+    # order with the capture times jittered and some repeated
+    rng = random.Random(seed)
+    result = []
+    for frame in range(1, count + 1):
+        timestamp = round(frame * 0.01 + rng.uniform(-0.03, 0.03), 2)
+        result.append((timestamp, frame * 0.01, frame, [rng.random() for joint in range(JOINTS)],
+                       [rng.random() for joint in range(JOINTS)], [float('nan')] * JOINTS))
+    return result
+
+
+class JointSeriesWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.numpy = joint_series.numpy
+
+    def tearDown(self):
+        joint_series.numpy = self.numpy
+        shutil.rmtree(self.directory)
+
+    def writeAndRead(self, data, chunk_size):
+        path = joint_series.seriesPath(self.directory, 3, 1)
+        writer = joint_series.JointSeriesWriter(path, 3, 1, chunk_size)
+        builder = joint_series.JointSeriesBuilder(3, 1)
+        for sample in data:
+            writer.add(*sample)
+            builder.add(*sample)
+        self.assertEqual(writer.close(), len(data))
+        self.assertEqual(sorted(os.listdir(self.directory)), [os.path.basename(path)])
+        expected = builder.build()
+        series = joint_series.openSeries(path)
+        try:
+            self.assertEqual((series.file_id, series.arm, len(series)), (3, 1, len(data)))
+            self.assertEqual(list(series.timestamps), list(expected.timestamps))
+            self.assertEqual(list(series.ros_times), list(expected.ros_times))
+            self.assertEqual(list(series.frames), list(expected.frames))
+            for i in range(len(series)):
+                for joint in range(JOINTS):
+                    self.assertEqual(series.value(i, joint, 0), expected.value(i, joint, 0))
+                    self.assertEqual(series.value(i, joint, 1), expected.value(i, joint, 1))
+        finally:
+            series.close()
+
+    def testChunksOutOfOrder(self):
+        for chunk_size in (1, 7, 100, 1000):
+            self.writeAndRead(samples(300), chunk_size)
+
+    def testWithoutNumpy(self):
+        joint_series.numpy = None
+        self.writeAndRead(samples(300), 7)
+
+    def testEmptySeries(self):
+        self.writeAndRead([], 7)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+#
+# Author:       Timothy Zimmerman (timothy.zimmerman@nist.gov)
+# Organization: National Institute of Standards and Technology
+#               U.S. Department of Commerce
+# License:      Public Domain
+#
+# Description:  The stages of parquet_analysis.py give the rows that the
+#               ros_analysis.py stages store in the unified DB. The DB of
+#               test_ros_analysis.py, with packets seen at several capture
+#               points, is analyzed both ways and the tables compared.
+#
+#               Usage: python -m pytest test_parquet_analysis.py
+#                      python -m unittest test_parquet_analysis
+#
+
+import shutil
+import tempfile
+import unittest
+import parquet_store
+import ros_analysis
+import test_ros_analysis
+
+try:
+    import pyarrow.parquet
+    import parquet_analysis
+except ImportError:
+    pyarrow = None
+
+# (packet id, timestamp, file id, fingerprint) of the copies of the packets
+# of test_ros_analysis: seen once, twice at the same capture point, and at
+# three capture points with a repeat
+COPIES = ((13, 0.15, 2, 2), (14, 0.25, 2, 2), (15, 0.45, 2, 4), (16, 0.46, 3, 4), (17, 0.47, 2, 4),
+          (18, 0.75, 3, 7), (19, 0.05, 1, 6))
+
+
+@unittest.skipIf(pyarrow is None, "requires pyarrow")
+class ParquetAnalysisTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.conn = test_ros_analysis.createDatabase()
+        c = self.conn.cursor()
+        c.executemany('''INSERT INTO packets (id, shark_timestamp, shark_file_id, fingerprint) VALUES (?,?,?,?)''',
+                      COPIES)
+        c.execute('''UPDATE packets SET md5_hash = printf('%032x', fingerprint)''')
+        self.conn.commit()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def analyze(self):
+        parquet_store.exportDatabase(self.conn, self.directory)
+        results = (parquet_analysis.matchPackets(self.directory), parquet_analysis.markUniqueBrics(self.directory),
+                   parquet_analysis.responseTimes(self.directory))
+        self.assertEqual(results, (ros_analysis.matchPackets(self.conn), ros_analysis.markUniqueBrics(self.conn),
+                                   ros_analysis.responseTimes(self.conn)))
+        for table in parquet_store.ANALYSIS_OUTPUT_TABLES:
+            data = pyarrow.parquet.read_table(parquet_store.tablePath(self.directory, table))
+            rows = self.conn.execute('''SELECT ''' + ', '.join(data.column_names) + ''' FROM ''' + table + \
+                                     ''' ORDER BY id''').fetchall()
+            self.assertEqual(list(zip(*[data.column(column).to_pylist() for column in data.column_names])), rows,
+                             table)
+
+    def testSameRowsAsTheDatabase(self):
+        self.analyze()
+
+    def testMd5Hash(self):
+        # Some fingerprints are missing, so every packet is matched by md5_hash
+        self.conn.execute('''UPDATE packets SET fingerprint = NULL WHERE id = 1''')
+        self.conn.execute('''UPDATE packets SET md5_hash = NULL WHERE id IN (2, 3)''')
+        self.analyze()
+
+
+if __name__ == "__main__":
+    unittest.main()
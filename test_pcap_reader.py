@@ -0,0 +1,179 @@
+#
+# Author:       Timothy Zimmerman (timothy.zimmerman@nist.gov)
+# Organization: National Institute of Standards and Technology
+#               U.S. Department of Commerce
+# License:      Public Domain
+#
+# Description:  Tests of the native PCAP reader: the TCP handshake tracker
+#               behind the initial RTTs, with and without the bounds a
+#               PcapStream runs with, the map of a capture being closed
+#               however iterFrames is left, and 802.1Q tagged frames.
+#
+#               Usage: python -m pytest test_pcap_reader.py
+#                      python -m unittest test_pcap_reader
+#
+
+import shutil
+import tempfile
+import unittest
+import os
+import pcap_filter
+import pcap_reader
+import synthetic_capture
+from pcap_filter import TCP_FLAG_SYN, TCP_FLAG_ACK
+
+CLIENT = (b'\x0a\x00\x00\x01', 50000)
+SERVER = (b'\x0a\x00\x00\x0b', 40000)
+
+
+def handshake(tracker, frameNum, timestamp, client=CLIENT, server=SERVER, rtt=0.001):
+    # Observe the three segments of a handshake starting at frameNum
+    tracker.observe(frameNum, timestamp, client[0], client[1], server[0], server[1], TCP_FLAG_SYN)
+    tracker.observe(frameNum + 1, timestamp + rtt / 2, server[0], server[1], client[0], client[1],
+                    TCP_FLAG_SYN | TCP_FLAG_ACK)
+    tracker.observe(frameNum + 2, timestamp + rtt, client[0], client[1], server[0], server[1], TCP_FLAG_ACK)
+
+
+def lookup(tracker, frameNum, client=CLIENT, server=SERVER):
+    return tracker.lookup(frameNum, server[0], server[1], client[0], client[1])
+
+
+class HandshakeTrackerTest(unittest.TestCase):
+
+    def testInitialRtt(self):
+        tracker = pcap_reader.TcpHandshakeTracker()
+        handshake(tracker, 1, 100.0, rtt=0.004)
+        handshake(tracker, 10, 200.0, rtt=0.002)
+        self.assertIsNone(lookup(tracker, 2))
+        self.assertAlmostEqual(lookup(tracker, 3), 0.004)
+        self.assertAlmostEqual(lookup(tracker, 11), 0.004)
+        self.assertAlmostEqual(lookup(tracker, 12), 0.002)
+
+    def testUnansweredSynsExpire(self):
+        tracker = pcap_reader.TcpHandshakeTracker(syn_timeout=10.0)
+        for port in range(1000):
+            tracker.observe(port + 1, 100.0 + port * 0.001, CLIENT[0], port, SERVER[0], SERVER[1], TCP_FLAG_SYN)
+        self.assertEqual(len(tracker.synTimes), 1000)
+        handshake(tracker, 2000, 200.0)
+        self.assertEqual(len(tracker.synTimes), 0)
+        self.assertEqual(len(tracker.synAckSeen), 0)
+        self.assertIsNotNone(lookup(tracker, 2002))
+
+    def testConnectionsAndHandshakesAreBounded(self):
+        tracker = pcap_reader.TcpHandshakeTracker(syn_timeout=10.0, max_connections=8, max_handshakes=2)
+        for n in range(100):
+            handshake(tracker, n * 3 + 1, 100.0 + n, client=(CLIENT[0], 50001 + n))
+        for n in range(5):
+            handshake(tracker, 1000 + n * 3, 300.0 + n, rtt=0.001 * (n + 1))
+        self.assertEqual(len(tracker.initialRtt), 8)
+        self.assertTrue(all(len(completions) <= 2 for completions in tracker.initialRtt.values()))
+        # The latest handshakes are kept
+        self.assertAlmostEqual(lookup(tracker, 2000), 0.005)
+        self.assertIsNone(lookup(tracker, 2000, client=(CLIENT[0], 50001)))
+
+
+
+class IterFramesTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.path, = synthetic_capture.generate(cls.directory, packets=200, capture_points=1)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        # Keep the maps iterFrames opens
+        self.maps = []
+        self.openCapture = pcap_reader.openCapture
+
+        def openCapture(filename):
+            mm = self.openCapture(filename)
+            self.maps.append(mm)
+            return mm
+        pcap_reader.openCapture = openCapture
+
+    def tearDown(self):
+        pcap_reader.openCapture = self.openCapture
+
+    def testReadToTheEnd(self):
+        frames = 0
+        for frame in pcap_reader.iterFrames(self.path):
+            frames += 1
+            del frame
+        self.assertGreater(frames, 0)
+        self.assertTrue(self.maps[0].closed)
+
+    def testClosedEarly(self):
+        frames = pcap_reader.iterFrames(self.path)
+        self.assertGreater(next(frames).data_len, 0)
+        frames.close()
+        self.assertTrue(self.maps[0].closed)
+
+    def testConsumerRaises(self):
+        frames = pcap_reader.iterFrames(self.path)
+        next(frames)
+        self.assertRaises(KeyError, frames.throw, KeyError("stop"))
+        self.assertTrue(self.maps[0].closed)
+
+    def testPayloadOutlivesTheCapture(self):
+        # A payload still referenced keeps the map open, without an error
+        frames = pcap_reader.iterFrames(self.path)
+        frame = next(frames)
+        payload = bytes(frame.data)
+        frames.close()
+        self.assertEqual(bytes(frame.data), payload)
+        self.assertFalse(self.maps[0].closed)
+        del frame
+        pcap_reader.closeCapture(self.maps[0])
+        self.assertTrue(self.maps[0].closed)
+
+
+
+class VlanTest(unittest.TestCase):
+
+    def setUp(self):
+        # A capture with the same segment untagged and in VLAN 5
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "vlan.pcap")
+        frame = synthetic_capture.tcpFrame(synthetic_capture.ARM_HOSTS[1], synthetic_capture.CONTROLLER, 40001,
+                                           50001, 1000, 2000, synthetic_capture.TCP_PSH_ACK, b'\x04\x00\x00\x00data')
+        writer = synthetic_capture.PcapWriter(self.path, '<')
+        writer.add(1.0, frame)
+        writer.add(2.0, frame[:12] + b'\x81\x00\x00\x05' + frame[12:])
+        writer.flushBefore(float('inf'))
+        writer.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def frames(self, strip_vlan):
+        packetFilter = pcap_filter.PacketFilter(pcap_filter.FilterRules(strip_vlan=strip_vlan))
+        frames = [(frame.number, frame.tcp_srcport, frame.tcp_dstport, frame.tcp_seq, bytes(frame.data))
+                  for frame in pcap_reader.iterFrames(self.path, packetFilter)]
+        return frames, packetFilter.rejected[pcap_filter.REJECT_ETHERTYPE]
+
+    def testStripVlan(self):
+        self.assertEqual(self.frames(True), ([(1, 40001, 50001, 1000, b'\x04\x00\x00\x00data'),
+                                             (2, 40001, 50001, 1000, b'\x04\x00\x00\x00data')], 0))
+
+    def testKeepVlan(self):
+        # Tagged frames are not looked into
+        self.assertEqual(self.frames(False), ([(1, 40001, 50001, 1000, b'\x04\x00\x00\x00data')], 1))
+
+    def testDecodeTcp(self):
+        with open(self.path, 'rb') as f:
+            buf = f.read()
+        # (data offset, captured length) of the two frames
+        (first, len1), (second, len2) = [record[3:] for record in pcap_reader.iterRecords(buf, '<')]
+        untagged = pcap_filter.decodeTcp(buf, first, len1, strip_vlan=False)
+        self.assertEqual(pcap_filter.decodeTcp(buf, first, len1), untagged)
+        tagged = pcap_filter.decodeTcp(buf, second, len2)
+        self.assertEqual(tagged[:8], untagged[:8])
+        self.assertEqual(buf[tagged[8]:tagged[9]], b'\x04\x00\x00\x00data')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+#
+# Author:       Timothy Zimmerman (timothy.zimmerman@nist.gov)
+# Organization: National Institute of Standards and Technology
+#               U.S. Department of Commerce
+# License:      Public Domain
+#
+# Description:  Tests of the analysis stages of ros_analysis.py on a small
+#               unified DB: one arm commanded by Brics messages and
+#               publishing JointStates, some of them without positions. A
+#               DB ingested from synthetic captures, part of it as it was
+#               stored before the fingerprint, is matched by fingerprint
+#               once prepared.
+#
+#               Usage: python -m pytest test_ros_analysis.py
+#                      python -m unittest test_ros_analysis
+#
+
+import shutil
+import tempfile
+import unittest
+import db_schema
+import db_writer
+import ingest
+import pipeline
+import ros_analysis
+import ros_msg_dissector as rosDisector
+import synthetic_capture
+
+JOINTS = tuple(j + '_value' for j in db_schema.JOINT_NAMES[:5])
+
+# (packet id, Brics joint values) of the commands of arm 1; the repeat of
+# the first command is not unique
+COMMANDS = ((1, (1.0, 1.0, 1.0, 1.0, 1.0)),
+            (3, (1.0, 1.0, 1.0, 1.0, 1.0)),
+            (8, (2.0, 2.0, 2.0, 2.0, 2.0)),
+            (12, (1.5, 1.5, 1.5, 1.5, 1.5)))
+
+# (packet id, joint values) of the JointStates of arm 1. None stands for the
+# NULL positions of a JointState with a short positions array.
+JOINT_STATES = ((2, (0.5, 0.5, 0.5, 0.5, 0.5)),
+                (4, (0.5, 0.5, 0.5, 0.5, 0.5)),
+                (5, None),
+                (6, (0.5, 0.5, 0.9, 0.5, 0.5)),
+                (7, (0.5, 0.5, 1.0, 0.5, 0.5)),
+                (9, None),
+                (10, (1.0, 0.5, 1.0, 0.5, 0.5)),
+                (11, (1.5, 0.5, 1.0, 0.5, 0.5)))
+
+
+def createDatabase():
+    conn = ingest.createDatabase(":memory:")
+    c = conn.cursor()
+    db_schema.createAnalysisTables(c)
+    for packet_id in range(1, 13):
+        c.execute('''INSERT INTO packets (id, shark_timestamp, shark_file_id, fingerprint) VALUES (?,?,?,?)''',
+                  (packet_id, packet_id * 0.1, 1, packet_id))
+    for packet_id, values in COMMANDS:
+        c.execute('''INSERT INTO ros_BricsPositionMessages (parent_id, ros_arm_num, delta, ''' + \
+                  ', '.join(JOINTS) + ''') VALUES (?,1,0,?,?,?,?,?)''', (packet_id,) + values)
+    for packet_id, values in JOINT_STATES:
+        c.execute('''INSERT INTO ros_JointStateMessages (parent_id, ros_arm_num, ''' + ', '.join(JOINTS) + \
+                  ''') VALUES (?,1,?,?,?,?,?)''', (packet_id,) + (values or (None,) * 5))
+    conn.commit()
+    return conn
+
+
+class TypedRowTest(unittest.TestCase):
+
+    def dissect(self, positions, velocities):
+        enc = synthetic_capture.Encoder('<')
+        payload = synthetic_capture.jointStatePayload(enc, 1, 1, 1.0, positions, velocities, [])
+        return rosDisector.dissectPacket('<', payload)[0]
+
+    def testShortVelocitiesAreNull(self):
+        table, row = ingest.typedRow(1, self.dissect([0.1] * 7, [0.2] * 3))
+        velocities = row[5 + 7:5 + 14]
+        self.assertEqual(velocities, (0.2,) * 3 + (None,) * 4)
+
+    def testShortPositionsAreDropped(self):
+        self.assertIsNone(ingest.typedRow(1, self.dissect([0.1] * 3, [0.2] * 7)))
+        self.assertIsNone(ingest.typedRow(1, self.dissect([], [])))
+
+
+class AnalysisTest(unittest.TestCase):
+
+    def testMarkUniqueBrics(self):
+        conn = createDatabase()
+        self.assertEqual(ros_analysis.markUniqueBrics(conn), 3)
+        self.assertEqual(conn.execute('''SELECT parent_id, delta FROM ros_BricsPositionMessages ORDER BY id''').fetchall(),
+                         [(1, 1), (3, 0), (8, 1), (12, 1)])
+
+    def testResponseTimesSkipNullPositions(self):
+        conn = createDatabase()
+        ros_analysis.markUniqueBrics(conn)
+        self.assertEqual(ros_analysis.responseTimes(conn), 2)
+        rows = conn.execute('''SELECT brics_message_id, joint_state_message_id, delay \
+                               FROM analyze_JointResponseTimes ORDER BY id''').fetchall()
+        self.assertEqual([row[:2] for row in rows], [(1, 6), (8, 11)])
+        self.assertAlmostEqual(rows[0][2], 0.5)
+        self.assertAlmostEqual(rows[1][2], 0.3)
+
+
+class PrepareDatabaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.conn = ingest.createDatabase(":memory:")
+        paths = synthetic_capture.generate(self.directory, packets=500, capture_points=2)
+        pipeline.run(paths, [pipeline.SqliteSink(db_writer.BatchWriter(self.conn))])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def matches(self):
+        ros_analysis.matchPackets(self.conn)
+        return (self.conn.execute('''SELECT packet_1_id, packet_2_id, delta_t FROM matchingPackets''').fetchall(),
+                self.conn.execute('''SELECT packet_id_1 FROM misplacedPackets''').fetchall())
+
+    def testMixedDatabase(self):
+        expected = self.matches()
+        self.assertGreater(len(expected[0]), 0)
+        # The packets of the first capture as a DB from before the
+        # fingerprint stored them, with only an md5_hash
+        self.conn.execute('''UPDATE packets SET md5_hash = printf('%x', fingerprint), fingerprint = NULL \
+                             WHERE shark_file_id = 1''')
+        self.conn.execute('''UPDATE rosPackets SET fingerprint = NULL WHERE parent_id IN \
+                             (SELECT id FROM packets WHERE fingerprint IS NULL)''')
+        self.assertEqual(ros_analysis.matchKey(self.conn), 'md5_hash')
+        stored = self.conn.execute('''SELECT COUNT(*) FROM packets WHERE shark_file_id = 1''').fetchone()[0]
+        self.assertEqual(ros_analysis.prepareDatabase(self.conn), stored)
+        self.assertEqual(ros_analysis.matchKey(self.conn), 'fingerprint')
+        self.assertEqual(self.matches(), expected)
+        self.assertEqual(self.conn.execute('''SELECT COUNT(*) FROM rosPackets WHERE fingerprint IS NULL''').fetchone(),
+                         (0,))
+
+
+if __name__ == "__main__":
+    unittest.main()
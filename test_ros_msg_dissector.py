@@ -0,0 +1,467 @@
+#
+# Author:       Timothy Zimmerman (timothy.zimmerman@nist.gov)
+# Organization: National Institute of Standards and Technology
+#               U.S. Department of Commerce
+# License:      Public Domain
+#
+# Description:  Regression test of ros_msg_dissector against a frozen copy of
+#               the slicing dissector it replaced, which re-sliced the rest of
+#               the payload after every field and returned one dict per
+#               message. Fixed payloads of every message type, in both byte
+#               orders, are run through both, whole, truncated at every
+#               length and with bytes corrupted, and must give the same
+#               messages or fail with the same exception type.
+#
+#               The records of the current dissector are converted to the old
+#               dicts for the comparison. Joint names are compared without
+#               the "_2_" of the second arm, which the records drop. Where the
+#               old dissectors raised on a gripper false positive or on short
+#               JointState arrays, the fixed behaviour is checked instead.
+#
+#               Usage: python -m pytest test_ros_msg_dissector.py
+#                      python -m unittest test_ros_msg_dissector
+#
+
+import random
+import unittest
+import unittest.mock
+from struct import unpack
+import ros_msg_dissector as rosDisector
+import synthetic_capture
+
+BYTE_ORDERS = ('<', '>')
+
+# Suffixes of the keys the old dissectors made from the joint names
+JOINT_FIELDS = ('_value', '_velocity', '_effort', '_unit')
+
+# Corrupted copies of every payload
+CORRUPTIONS = 200
+SEED = 7
+
+
+###############################################################################
+# Frozen copy of the slicing dissector (ros_msg_dissector.py before the
+# memoryview rewrite). Do not change.
+###############################################################################
+
+LEGACY_PACKETS = [ [0, [28, "arm_joint_1"], [43, "arm_joint_2"]],      # JointState Message
+                   [0, [28, "arm_2_joint_1"], [45, "arm_2_joint_2"]],  # JointState Message
+
+                   [1, [32, "arm_joint_1"], [47, "rad"]],              # Brics Action Message
+                   [1, [32, "arm_2_joint_1"], [49, "rad"]],            # Brics Action Message
+
+                   [2, [25, "/robot_proxy_1"]],                        # Debug Message
+                   [2, [25, "/robot_proxy_2"]],                        # Debug Message
+
+                   [3, [20, "youbot_dependency_update"]],              # Dependency
+
+                   [4, [32, "gripper_finger_joint_"]],                 # Gripper Message
+                   [4, [32, "gripper_2_finger_joint_"]]                # Gripper Message
+]
+LEGACY_TYPES = "JointStateMsg", "BricsPositionMsg", "rosgraphDebugMsg", "DependencyMsg", "GripperMsg"
+
+def legacyJointStateMsg(unpack_header, packet_data):
+
+    # Clear the output dictionary, and add the msg type
+    returnInfo = {'ros_msg_type': LEGACY_TYPES[0]}
+
+    # Unpack the header
+    ros_header = unpack(unpack_header + 'IIIII', packet_data[0:20])
+
+    # If our packet size is larger than 3500, we can guess it's a false positive
+    if ros_header[0] > 3500:
+        return {}
+
+    returnInfo['ros_msg_len'] = str(ros_header[0])
+    returnInfo['ros_frame_id'] = str(ros_header[1])
+    returnInfo['ros_time'] = str(ros_header[2]) + "." + str(ros_header[3])
+
+    # Is there a sequence number?
+    if ros_header[4] > 0:
+        # If so, let's store the value
+        returnInfo['ros_seq_num'] = str(packet_data[20:20+ros_header[4]])
+    # Remove the ROS header
+    packet_data = packet_data[20 + ros_header[4]:]
+
+    # What size is this array?
+    array_size = unpack(unpack_header + 'I', packet_data[0:4])[0]
+    packet_data = packet_data[4:]
+    joint_names = []
+    for i in range(0,array_size):
+        string_len = unpack(unpack_header + 'I', packet_data[0:4])[0]
+        joint_names.append(packet_data[4:4+string_len])
+        joint_names[i] = joint_names[i].decode("utf-8")
+        packet_data = packet_data[4+string_len:]
+
+    # What size is this array?
+    array_size = unpack(unpack_header + 'I', packet_data[0:4])[0]
+    packet_data = packet_data[4:]
+    joint_values = []
+    for i in range(0,array_size):
+        joint_values.append(unpack(unpack_header + 'd', packet_data[0:8])[0])
+        packet_data = packet_data[8:]
+
+    # What size is this array?
+    array_size = unpack(unpack_header + 'I', packet_data[0:4])[0]
+    packet_data = packet_data[4:]
+    joint_velocities = []
+    for i in range(0,array_size):
+        joint_velocities.append(unpack(unpack_header + 'd', packet_data[0:8])[0])
+        packet_data = packet_data[8:]
+
+    # What size is this array?
+    array_size = unpack(unpack_header + 'I', packet_data[0:4])[0]
+    packet_data = packet_data[4:]
+    joint_efforts = []
+    if array_size > 0:
+        for i in range(0,array_size):
+            joint_efforts.append(unpack(unpack_header + 'd', packet_data[0:8])[0])
+            packet_data = packet_data[8:]
+    else:
+        joint_efforts = [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
+
+    for idx, j in enumerate(joint_names):
+        returnInfo[str(j) + "_value"] = joint_values[idx]
+        returnInfo[str(j) + "_velocity"] = joint_velocities[idx]
+        returnInfo[str(j) + "_effort"] = joint_efforts[idx]
+
+    return returnInfo
+
+def legacyBricsActuatorJointValueMsg(unpack_header, packet_data):
+
+    # Clear the output dictionary, and add the msg type
+    returnInfo = {'ros_msg_type': LEGACY_TYPES[1]}
+
+    ros_pkt_len = unpack(unpack_header + 'I', packet_data[0:4])[0]
+    returnInfo['ros_msg_len'] = str(ros_pkt_len)
+    packet_data = packet_data[4:]
+
+    # If our packet size is later than 3500, we can guess it's a false positive
+    if ros_pkt_len > 3500:
+        return ""
+
+    originator_len = unpack(unpack_header + 'I', packet_data[0:4])[0]
+    if originator_len > 0:
+        returnInfo['ros_originator'] = str(packet_data[4:4+originator_len])
+    packet_data = packet_data[4+originator_len:]
+
+    description_len = unpack(unpack_header + 'I', packet_data[0:4])[0]
+    if description_len > 0:
+         returnInfo['ros_desription'] = str(packet_data[4:4+description_len])
+    packet_data = packet_data[4+description_len:]
+
+    #Strip away the QoS (not used)
+    packet_data = packet_data[4:]
+
+    # What size is this array?
+    array_size = unpack(unpack_header + 'I', packet_data[0:4])[0]
+    packet_data = packet_data[4:]
+
+    for i in range(0,array_size):
+        packet_data = packet_data[8:]    #Strip the timestamp (not used)
+
+        joint_uri_len = unpack(unpack_header + 'I', packet_data[0:4])[0]    #How long is the string?
+        joint_uri = packet_data[4:4+joint_uri_len].decode("utf-8")
+        returnInfo["ros_arm_num"] = 0
+        if joint_uri.count("_2_") > 0 and returnInfo["ros_arm_num"] == 0:
+            returnInfo["ros_arm_num"] = 2
+            joint_uri = joint_uri.replace("_2_", "_")
+        else:
+            returnInfo["ros_arm_num"] = 1
+        packet_data = packet_data[4+joint_uri_len:]    #Strip the string from the data
+
+        joint_unit_len = unpack(unpack_header + 'I', packet_data[0:4])[0]    #How long is the string?
+        returnInfo[str(joint_uri) + '_unit'] = packet_data[4:4+joint_unit_len].decode("utf-8")
+        packet_data = packet_data[4+joint_unit_len:]    #Strip the string from the data
+
+        returnInfo[str(joint_uri) + '_value'] = unpack(unpack_header + 'd', packet_data[0:8])[0]
+        packet_data = packet_data[8:]    #Strip the value
+
+    return returnInfo
+
+def legacyDependencyMsg(unpack_header, packet_data):
+
+    # Clear the output dictionary, and add the msg type
+    returnInfo = {'ros_msg_type': LEGACY_TYPES[3]}
+
+    # Unpack the header
+    ros_header = unpack(unpack_header + 'IIIII', packet_data[0:20])
+
+    # If our packet size is larger than 3500, we can guess it's a false positive
+    if ros_header[0] > 3500:
+        return {}
+
+    returnInfo['ros_msg_len'] = str(ros_header[0])
+    returnInfo['ros_frame_id'] = str(ros_header[1])
+    returnInfo['ros_time'] = str(ros_header[2]) + "." + str(ros_header[3])
+
+    # Is there a sequence number?
+    if ros_header[4] > 0:
+        # If so, let's store the value
+        returnInfo['ros_seq_num'] = str(packet_data[20:20+ros_header[4]])
+    # Remove the ROS header
+    packet_data = packet_data[20 + ros_header[4]:]
+
+    depend_len = unpack(unpack_header + 'I', packet_data[0:4])[0]    # How long is the string?
+    returnInfo['depend_string'] = packet_data[4:4+depend_len].decode("utf-8")
+    packet_data = packet_data[4+depend_len:]    #Strip the string from the data
+    returnInfo['depend_val'] = packet_data[0:1]
+
+    return returnInfo
+
+def legacyGripperMsg(unpack_header, d):
+    # The gripper message is the same as the joint message, so let it handle the dissection
+    returnInfo = legacyBricsActuatorJointValueMsg(unpack_header, d)
+    # Rewrite the message type
+    returnInfo['ros_msg_type'] = LEGACY_TYPES[4]
+    return returnInfo
+
+# For now we are going to just discard this message type
+def legacyDebugMsg(unpack_header, d):
+    returnInfo = {'ros_msg_type': LEGACY_TYPES[2]}
+    return returnInfo
+
+def legacyPacket(unpack_header, d):
+
+    # Clear the foundMessages list (returned later)
+    foundMessages = []
+
+    # Is there data in this packet?
+    while len(d) >= 4:
+        # Anticipating that this is a ROS message, grab the first four
+        # bytes, which should be the length of the packet
+        msg_len = unpack(unpack_header + 'I', d[0:4])[0]
+        # Is there data left in this packet?
+        if msg_len > 0:
+            # Iterate through the packet identifiers
+            for rosIdentifier in LEGACY_PACKETS:
+                # Determine the number of indices provided in the ROS_PACKETS list
+                numIDXs = len(rosIdentifier) - 1
+                # Clear the number of matches found
+                matchesFound = 0
+                # Iterate through each IDX to find a match
+                for x in range(numIDXs):
+                    currIdx = rosIdentifier[x+1][0]
+                    currStr = rosIdentifier[x+1][1]
+                    if d[currIdx:len(currStr)+currIdx] == currStr.encode():
+                        matchesFound += 1
+                    else:
+                        break;
+                # If the matches found equal the idx's and text provided, then
+                # skip searching for the rest of the packet types
+                if matchesFound == numIDXs:
+                    # Process the packet based on the type found
+                    if rosIdentifier[0] == 0:
+                        foundMessages.append(legacyJointStateMsg(unpack_header, d))
+                    elif rosIdentifier[0] == 1:
+                        foundMessages.append(legacyBricsActuatorJointValueMsg(unpack_header, d))
+                    elif rosIdentifier[0] == 2:
+                        foundMessages.append(legacyDebugMsg(unpack_header, d))
+                    elif rosIdentifier[0] == 3:
+                        foundMessages.append(legacyDependencyMsg(unpack_header, d))
+                    elif rosIdentifier[0] == 4:
+                        foundMessages.append(legacyGripperMsg(unpack_header, d))
+                    break
+            # Remove the message we just parsed.
+            d = d[4+msg_len:]
+
+        else:
+            # Some messages may have padding, so remove it
+            d = d[4:]
+
+    return foundMessages  # Return the list of messages
+
+###############################################################################
+
+
+def legacyRecord(msg):
+    # The dict the slicing dissector returned for a record, or None for a
+    # false positive (the old dissectors returned an empty dict or string)
+    if msg is None:
+        return None
+    msgType = msg.ros_msg_type
+    info = {'ros_msg_type': msgType}
+    if msgType == "JointStateMsg" or msgType == "DependencyMsg":
+        info['ros_msg_len'] = str(msg.ros_msg_len)
+        info['ros_frame_id'] = str(msg.ros_frame_id)
+        info['ros_time'] = msg.ros_time
+        if msg.ros_seq_num is not None:
+            info['ros_seq_num'] = str(msg.ros_seq_num)
+    if msgType == "JointStateMsg":
+        for idx, j in enumerate(msg.joint_names):
+            info[j + "_value"] = msg.positions[idx]
+            info[j + "_velocity"] = msg.velocities[idx]
+            info[j + "_effort"] = msg.efforts[idx]
+    elif msgType == "DependencyMsg":
+        info['depend_string'] = msg.depend_string
+        info['depend_val'] = bytes([msg.depend_val]) if msg.depend_val is not None else b''
+    elif msgType == "BricsPositionMsg" or msgType == "GripperMsg":
+        info['ros_msg_len'] = str(msg.ros_msg_len)
+        if msg.ros_originator is not None:
+            info['ros_originator'] = str(msg.ros_originator)
+        if msg.ros_description is not None:
+            info['ros_desription'] = str(msg.ros_description)
+        if msg.ros_arm_num is not None:
+            info['ros_arm_num'] = msg.ros_arm_num
+        for name, unit, value in zip(msg.joint_names, msg.units, msg.values):
+            info[name + '_unit'] = unit
+            info[name + '_value'] = value
+    return info
+
+
+def normalizeLegacy(info):
+    # The old dict with the joint names of the second arm written like
+    # the first arm's, and the ROS time as the float the records hold
+    if not info:
+        return None
+    normalized = {}
+    for key, value in info.items():
+        if key == 'ros_time':
+            sec, nsec = value.split('.')
+            value = int(sec) + int(nsec) * 1e-9
+        elif key.endswith(JOINT_FIELDS):
+            joint, field = key.rsplit('_', 1)
+            key = joint.replace("_2_", "_") + '_' + field
+        normalized[key] = value
+    return normalized
+
+
+def skippingGripperMsg(unpack_header, d):
+    # legacyGripperMsg, returning the empty result of the old Brics
+    # dissector for a false positive
+    returnInfo = legacyBricsActuatorJointValueMsg(unpack_header, d)
+    if returnInfo:
+        returnInfo['ros_msg_type'] = LEGACY_TYPES[4]
+    return returnInfo
+
+
+def outcome(dissector, *args):
+    # ('ok', result) or ('error', exception type)
+    try:
+        return 'ok', dissector(*args)
+    except Exception as e:
+        return 'error', type(e)
+
+
+def basePayloads(unpack_header):
+    # One message of every type, plus packets holding several messages and
+    # padding, in the given byte order
+    enc = synthetic_capture.Encoder(unpack_header)
+    joints = [0.25 * j - 0.5 for j in range(7)]
+    payloads = {}
+    for arm in (1, 2):
+        payloads['joint_state_' + str(arm)] = synthetic_capture.jointStatePayload(
+            enc, arm, 1234 + arm, 1439926874.123456, joints, [0.01 * j for j in range(7)],
+            [-0.1 * j for j in range(7)])
+        payloads['joint_state_no_effort_' + str(arm)] = synthetic_capture.jointStatePayload(
+            enc, arm, 99, 1439926875.5, joints, [0.0] * 7, [])
+        payloads['brics_' + str(arm)] = synthetic_capture.bricsPositionPayload(enc, arm, joints[:5])
+        payloads['gripper_' + str(arm)] = synthetic_capture.gripperPayload(enc, arm, [0.01, 0.011])
+        payloads['debug_' + str(arm)] = synthetic_capture.debugPayload(enc, arm, 7, 1439926876.25, "state")
+    payloads['dependency'] = synthetic_capture.dependencyPayload(enc, "arm_controller", 1)
+    # A header with a frame id, which dissectPacket does not identify but
+    # the sub-dissectors decode
+    payloads['joint_state_frame_id'] = enc.message(
+        enc.rosHeader(5, 1439926877.75, "base_link") + enc.uint32(7) +
+        b''.join(enc.string(n) for n in synthetic_capture.armJointNames(1)) +
+        enc.doubles(joints) + enc.doubles(joints) + enc.doubles(joints))
+    payloads['several'] = payloads['joint_state_1'] + payloads['brics_2'] + enc.uint32(0) + \
+                          payloads['dependency'] + payloads['gripper_1']
+    return payloads
+
+
+def corruptedPayloads(payload, rng, count=CORRUPTIONS):
+    # Copies with a few bytes overwritten, some of them in the length fields
+    for n in range(count):
+        data = bytearray(payload)
+        for k in range(1 + n % 3):
+            data[rng.randrange(len(data))] = rng.randrange(256)
+        yield bytes(data)
+
+
+DISSECTORS = (
+    ('dissectPacket', legacyPacket, rosDisector.dissectPacket),
+    ('dissectJointStateMsg', legacyJointStateMsg, rosDisector.dissectJointStateMsg),
+    ('dissectBricsActuatorJointValueMsg', legacyBricsActuatorJointValueMsg,
+     rosDisector.dissectBricsActuatorJointValueMsg),
+    ('dissectDependencyMsg', legacyDependencyMsg, rosDisector.dissectDependencyMsg),
+    ('dissectGripperMsg', legacyGripperMsg, rosDisector.dissectGripperMsg),
+    ('dissectDebugMsg', legacyDebugMsg, rosDisector.dissectDebugMsg),
+)
+
+
+class DissectorEquivalenceTest(unittest.TestCase):
+
+    def assertEquivalent(self, name, legacy, current, unpack_header, payload):
+        old = outcome(legacy, unpack_header, payload)
+        new = outcome(current, unpack_header, payload)
+        context = name + " " + unpack_header + " " + payload.hex()
+        if old == ('error', TypeError) and new[0] == 'ok' and name in ('dissectPacket', 'dissectGripperMsg'):
+            # The old gripper dissector failed on a false positive instead of
+            # skipping it like the others
+            if legacy is legacyGripperMsg:
+                legacy = skippingGripperMsg
+            with unittest.mock.patch(__name__ + '.legacyGripperMsg', skippingGripperMsg):
+                old = outcome(legacy, unpack_header, payload)
+        if old == ('error', IndexError) and new[0] == 'ok' and name in ('dissectPacket', 'dissectJointStateMsg'):
+            # The old dissector failed on a JointState with fewer velocities
+            # or efforts than names, which now keeps the values it has
+            messages = new[1] if name == 'dissectPacket' else [new[1]]
+            self.assertTrue(any(msg.ros_msg_type == "JointStateMsg" and
+                                min(len(msg.velocities), len(msg.efforts)) < len(msg.joint_names)
+                                for msg in messages), context)
+            return
+        if old[0] == 'error' or new[0] == 'error':
+            self.assertEqual(old, new, context)
+        elif name == 'dissectPacket':
+            self.assertEqual([m for m in (normalizeLegacy(info) for info in old[1]) if m is not None],
+                             [legacyRecord(msg) for msg in new[1]], context)
+        else:
+            self.assertEqual(normalizeLegacy(old[1]), legacyRecord(new[1]), context)
+
+    def checkPayloads(self, payloads):
+        for unpack_header in BYTE_ORDERS:
+            for payloadName, payload in sorted(payloads(unpack_header).items()):
+                for name, legacy, current in DISSECTORS:
+                    with self.subTest(dissector=name, payload=payloadName, byte_order=unpack_header):
+                        self.assertEquivalent(name, legacy, current, unpack_header, payload)
+
+    def testWholePayloads(self):
+        self.checkPayloads(basePayloads)
+
+    def testMessagesAreFound(self):
+        # The fixed payloads exercise every dissector through dissectPacket
+        for unpack_header in BYTE_ORDERS:
+            found = set()
+            for payload in basePayloads(unpack_header).values():
+                found.update(msg.ros_msg_type for msg in rosDisector.dissectPacket(unpack_header, payload))
+            self.assertEqual(found, set(rosDisector.ROS_PACKET_TYPES))
+
+    def testTruncatedPayloads(self):
+        for unpack_header in BYTE_ORDERS:
+            for payloadName, payload in sorted(basePayloads(unpack_header).items()):
+                for name, legacy, current in DISSECTORS:
+                    with self.subTest(dissector=name, payload=payloadName, byte_order=unpack_header):
+                        for length in range(len(payload)):
+                            self.assertEquivalent(name, legacy, current, unpack_header, payload[:length])
+
+    def testCorruptedPayloads(self):
+        rng = random.Random(SEED)
+        for unpack_header in BYTE_ORDERS:
+            for payloadName, payload in sorted(basePayloads(unpack_header).items()):
+                corrupted = list(corruptedPayloads(payload, rng))
+                for name, legacy, current in DISSECTORS:
+                    with self.subTest(dissector=name, payload=payloadName, byte_order=unpack_header):
+                        for data in corrupted:
+                            self.assertEquivalent(name, legacy, current, unpack_header, data)
+
+    def testMemoryviewInput(self):
+        # The ingest passes views into the memory-mapped capture
+        for unpack_header in BYTE_ORDERS:
+            for payload in basePayloads(unpack_header).values():
+                self.assertEqual(rosDisector.dissectPacket(unpack_header, memoryview(payload)),
+                                 rosDisector.dissectPacket(unpack_header, payload))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,168 @@
+#
+# Author:       Timothy Zimmerman (timothy.zimmerman@nist.gov)
+# Organization: National Institute of Standards and Technology
+#               U.S. Department of Commerce
+# License:      Public Domain
+#
+# Description:  Tests of the TCP reassembly behind the prefilter. Small
+#               captures are written with synthetic_capture: a TCPROS
+#               connection whose messages are split the way real TCP stacks
+#               send them (the leading segments with ACK alone, PSH on the
+#               last one), delivered in order, out of order and with a
+#               segment missing. They are read through pcap_reader and the
+#               pipeline as the ingest does.
+#
+#               Usage: python -m pytest test_tcp_reassembly.py
+#                      python -m unittest test_tcp_reassembly
+#
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import pcap_filter
+import pipeline
+import synthetic_capture
+import tcp_reassembly
+
+START = synthetic_capture.START_TIME
+PUBLISHER = synthetic_capture.ARM_HOSTS[1]
+SUBSCRIBER = synthetic_capture.CONTROLLER
+PUBLISHER_PORT = 40001
+SUBSCRIBER_PORT = 50001
+
+
+class Segments:
+    # The frames of one TCPROS connection, in the order they are sent
+
+    def __init__(self, unpack_header='<', seed=1):
+        self.enc = synthetic_capture.Encoder(unpack_header)
+        self.conn = synthetic_capture.Connection(random.Random(seed), PUBLISHER, SUBSCRIBER,
+                                                 PUBLISHER_PORT, SUBSCRIBER_PORT)
+        self.frames = self.conn.handshake(START)
+        self.t = START
+
+    def jointState(self, seq):
+        return synthetic_capture.jointStatePayload(self.enc, 1, seq, self.t, [0.1 * j for j in range(7)],
+                                                   [0.0] * 7, [0.0] * 7)
+
+    def send(self, payload, parts=1, gap=0.01):
+        # Send payload in parts segments, the leading ones with ACK alone.
+        # Returns the indexes of the payload segments in frames.
+        self.t += gap
+        size = -(-len(payload) // parts)
+        indexes = []
+        for n in range(parts):
+            part = payload[n * size:(n + 1) * size]
+            flags = synthetic_capture.TCP_PSH_ACK if n + 1 == parts else synthetic_capture.TCP_ACK
+            indexes.append(len(self.frames))
+            self.frames.append((self.t + n * 0.00005, synthetic_capture.tcpFrame(
+                PUBLISHER, SUBSCRIBER, PUBLISHER_PORT, SUBSCRIBER_PORT, self.conn.seq, self.conn.ack,
+                flags, part)))
+            self.conn.seq = (self.conn.seq + len(part)) & 0xffffffff
+        return indexes
+
+
+class ReassemblyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def writeCapture(self, frames, unpack_header='<'):
+        # frames are (time, frame) pairs, written in the order given
+        path = os.path.join(self.directory, "capture.pcap")
+        writer = synthetic_capture.PcapWriter(path, unpack_header)
+        for t, frame in frames:
+            writer.add(t, frame)
+            writer.flushBefore(float('inf'))
+        writer.close()
+        return path
+
+    def dissect(self, path, reassemble=True, reassembler=None):
+        # [(frame number, [message types]), ...] for the payload segments
+        packetFilter = pcap_filter.PacketFilter(reassemble=reassemble)
+        if reassemble and reassembler is None:
+            reassembler = tcp_reassembly.StreamReassembler()
+        items = pipeline.iterRosMessages(pipeline.iterTcpPayloads(pipeline.iterFrames(path, packetFilter)),
+                                         reassembler)
+        return [(item.packet.number, [msg.ros_msg_type for msg in item.messages]) for item in items]
+
+    def testAckOnlyLeadingSegment(self):
+        for unpack_header in ('<', '>'):
+            segments = Segments(unpack_header)
+            segments.send(segments.jointState(1), parts=2)
+            path = self.writeCapture(segments.frames, unpack_header)
+            # Frames 1-3 are the handshake
+            self.assertEqual(self.dissect(path), [(4, []), (5, ['JointStateMsg'])])
+            # Without reassembly the prefilter keeps only the PSH segment,
+            # as the pyshark display filter does
+            self.assertEqual(self.dissect(path, reassemble=False), [(5, [])])
+
+    def testMessageOverSeveralSegments(self):
+        segments = Segments()
+        segments.send(segments.jointState(1), parts=4)
+        segments.send(segments.jointState(2))
+        reassembler = tcp_reassembly.StreamReassembler()
+        path = self.writeCapture(segments.frames)
+        self.assertEqual(self.dissect(path, reassembler=reassembler),
+                         [(4, []), (5, []), (6, []), (7, ['JointStateMsg']), (8, ['JointStateMsg'])])
+        self.assertEqual(reassembler.reassembledMessages, 1)
+        self.assertEqual(reassembler.droppedBytes, 0)
+
+    def testOutOfOrderSegments(self):
+        segments = Segments()
+        first, second, third = segments.send(segments.jointState(1), parts=3)
+        frames = list(segments.frames)
+        # The middle segment is captured after the last one
+        frames[second], frames[third] = frames[third], frames[second]
+        reassembler = tcp_reassembly.StreamReassembler()
+        path = self.writeCapture(frames)
+        self.assertEqual(self.dissect(path, reassembler=reassembler), [(4, []), (5, []), (6, ['JointStateMsg'])])
+        self.assertGreater(reassembler.outOfOrderBytes, 0)
+        self.assertEqual(reassembler.reassembledMessages, 1)
+
+    def testRetransmittedSegment(self):
+        segments = Segments()
+        first, second = segments.send(segments.jointState(1), parts=2)
+        frames = segments.frames[:second] + [segments.frames[first]] + segments.frames[second:]
+        reassembler = tcp_reassembly.StreamReassembler()
+        path = self.writeCapture(frames)
+        self.assertEqual(self.dissect(path, reassembler=reassembler), [(4, []), (5, []), (6, ['JointStateMsg'])])
+        self.assertGreater(reassembler.retransmittedBytes, 0)
+
+    def testMissingSegment(self):
+        # The first segment of a split message is lost. Once the gap times
+        # out, the continuation is dropped rather than parsed as the start of
+        # a message, and the reassembler resyncs on the next message.
+        segments = Segments()
+        segments.send(segments.jointState(1))
+        lost, continuation = segments.send(segments.jointState(2), parts=2)
+        segments.send(segments.jointState(3), gap=2 * tcp_reassembly.GAP_TIMEOUT)
+        segments.send(segments.jointState(4))
+        frames = segments.frames[:lost] + segments.frames[lost + 1:]
+        reassembler = tcp_reassembly.StreamReassembler()
+        path = self.writeCapture(frames)
+        self.assertEqual(self.dissect(path, reassembler=reassembler),
+                         [(4, ['JointStateMsg']), (5, []), (6, ['JointStateMsg']), (7, ['JointStateMsg'])])
+        self.assertEqual(reassembler.failedMessages, 0)
+        self.assertGreater(reassembler.droppedBytes, 0)
+
+    def testSyntheticCaptureSplits(self):
+        # Every message of a generated capture is found with reassembly,
+        # including the split ones whose first segment has no PSH
+        path, = synthetic_capture.generate(self.directory, packets=2000, capture_points=1, noise_ratio=0.2,
+                                           split_ratio=0.1)
+        reassembler = tcp_reassembly.StreamReassembler()
+        found = sum(len(messages) for number, messages in self.dissect(path, reassembler=reassembler))
+        withoutReassembly = sum(len(messages) for number, messages in self.dissect(path, reassemble=False))
+        self.assertGreater(reassembler.reassembledMessages, 0)
+        self.assertEqual(reassembler.failedMessages, 0)
+        self.assertEqual(found, withoutReassembly + reassembler.reassembledMessages)
+
+
+if __name__ == "__main__":
+    unittest.main()